@@ -0,0 +1,245 @@
+import argparse
+import glob
+import gzip
+import json
+import logging
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from gzip import open as gunzip
+from multiprocessing import get_context
+from os import makedirs, path
+
+import pyarrow as pa
+
+from process_alb import (
+    DECOMPRESS_THREADS,
+    GROK,
+    GZIP_BACKENDS,
+    OUTPUT_PROFILE,
+    OUTPUT_PROFILES,
+    RECORD_BATCH_SIZE,
+    HttpActivityBatchBuilder,
+    RollingParquetWriter,
+    decompressGzip,
+    gzipBackend,
+    ocsfHttpActivitySchema,
+    tokenizeAlbLog
+)
+from duckdb_process_alb import convertAlbLogs
+from synthetic_alb_logs import writeSyntheticAlbLogFiles
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO)
+
+STAGES = ["decompress", "gzip_backends", "tokenize", "tokenize_grok", "map", "write", "sql"]
+# Members the gzip_backends stage splits the logs into to time parallel multi-member inflate
+GZIP_MEMBER_BYTES = 4 * 1024 * 1024
+RESULTS_DIR = "./benchmark_results"
+
+def peakRssMb() -> float:
+    """Peak resident set size of this process, ru_maxrss is reported in KiB on Linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def readLogLines(logFiles: list[str]) -> list[str]:
+    lines = []
+    for logFile in logFiles:
+        with gunzip(logFile, mode="rt") as logs:
+            lines.extend(logs)
+    return lines
+
+def buildBatches(lines: list[str], profile: str = OUTPUT_PROFILE) -> list[pa.RecordBatch]:
+    builder = HttpActivityBatchBuilder(profile=profile)
+    batches = []
+    for rawlog in lines:
+        try:
+            builder.append(rawlog, tokenizeAlbLog(rawlog))
+        except ValueError:
+            pass
+        if len(builder) >= RECORD_BATCH_SIZE:
+            batches.append(builder.flush())
+    if len(builder):
+        batches.append(builder.flush())
+    return batches
+
+def benchmarkGzipBackends(logFiles: list[str]) -> dict:
+    """
+    Times every installed gzip backend inflating the logs as they are (usually one member per file) and recompressed
+    into GZIP_MEMBER_BYTES members inflated on DECOMPRESS_THREADS threads, best of three runs each
+    """
+    compressed = []
+    for logFile in logFiles:
+        with open(logFile, "rb") as compressedFile:
+            compressed.append(compressedFile.read())
+    decompressed = [gzip.decompress(data) for data in compressed]
+    multiMember = [
+        b"".join(gzip.compress(data[start:start + GZIP_MEMBER_BYTES]) for start in range(0, len(data), GZIP_MEMBER_BYTES))
+        for data in decompressed
+    ]
+    decompressedBytes = sum(len(data) for data in decompressed)
+
+    backends = {}
+    for backend in GZIP_BACKENDS:
+        for variant, inputs, threads in (("single_member", compressed, 1), ("multi_member", multiMember, DECOMPRESS_THREADS)):
+            runs = []
+            for _ in range(3):
+                started = time.perf_counter()
+                for data in inputs:
+                    decompressGzip(data, backend=backend, threads=threads)
+                runs.append(time.perf_counter() - started)
+            backends.setdefault(backend, {})[f"{variant}_mb_per_sec"] = decompressedBytes / 1024 / 1024 / min(runs)
+            backends[backend][f"{variant}_seconds"] = min(runs)
+
+    winner = max(backends, key=lambda backend: backends[backend]["single_member_mb_per_sec"])
+    for backend, result in backends.items():
+        logger.info(
+            f"gzip {backend}: {result['single_member_mb_per_sec']:.1f} MB/sec, {result['multi_member_mb_per_sec']:.1f} MB/sec multi-member on {DECOMPRESS_THREADS} threads{' (winner)' if backend == winner else ''}"
+        )
+
+    return {"backends": backends, "winner": winner, "decompressed_bytes": decompressedBytes}
+
+def runStage(stage: str, logFiles: list[str], profile: str = OUTPUT_PROFILE) -> dict:
+    """
+    Runs one stage in isolation: its inputs are prepared untimed, then only the stage itself is timed.
+    This runs in a fresh process so the peak RSS belongs to this stage alone
+    """
+    compressedBytes = sum(path.getsize(logFile) for logFile in logFiles)
+    result = {"stage": stage}
+
+    if stage == "gzip_backends":
+        rssBefore = peakRssMb()
+        result.update(benchmarkGzipBackends(logFiles))
+        decompressedBytes = result.pop("decompressed_bytes")
+        seconds = result["backends"][result["winner"]]["single_member_seconds"]
+        lines = sum(len(readLogLines([logFile])) for logFile in logFiles)
+    elif stage == "decompress":
+        rssBefore = peakRssMb()
+        started = time.perf_counter()
+        lines = 0
+        decompressedBytes = 0
+        for logFile in logFiles:
+            # Same streaming inflate as streamS3LogLines, with the backend process_alb.py picked
+            with gzipBackend().open(logFile, mode="rt") as logs:
+                for rawlog in logs:
+                    lines += 1
+                    decompressedBytes += len(rawlog)
+        seconds = time.perf_counter() - started
+        result["compressed_mb_per_sec"] = compressedBytes / 1024 / 1024 / seconds
+    else:
+        lines = readLogLines(logFiles)
+        decompressedBytes = sum(len(rawlog) for rawlog in lines)
+
+        if stage == "tokenize":
+            rssBefore = peakRssMb()
+            started = time.perf_counter()
+            for rawlog in lines:
+                tokenizeAlbLog(rawlog)
+            seconds = time.perf_counter() - started
+        elif stage == "tokenize_grok":
+            rssBefore = peakRssMb()
+            started = time.perf_counter()
+            for rawlog in lines:
+                GROK.match(rawlog)
+            seconds = time.perf_counter() - started
+        elif stage == "map":
+            rssBefore = peakRssMb()
+            started = time.perf_counter()
+            batches = buildBatches(lines, profile)
+            seconds = time.perf_counter() - started
+            result["records"] = sum(batch.num_rows for batch in batches)
+        elif stage == "write":
+            batches = buildBatches(lines, profile)
+            with tempfile.TemporaryDirectory() as outputDir:
+                rssBefore = peakRssMb()
+                started = time.perf_counter()
+                with RollingParquetWriter(outputPrefix=path.join(outputDir, "part"), schema=ocsfHttpActivitySchema(profile=profile)) as writer:
+                    for batch in batches:
+                        writer.write(batch)
+                seconds = time.perf_counter() - started
+                result["records"] = writer.totalRecords
+                result["output_bytes"] = sum(path.getsize(filename) for filename in writer.files)
+        elif stage == "sql":
+            # Decompress, map and write end to end in DuckDB, compare against decompress + tokenize + map + write
+            with tempfile.TemporaryDirectory() as outputDir:
+                rssBefore = peakRssMb()
+                started = time.perf_counter()
+                result["records"] = convertAlbLogs(logFiles, outputDestination=outputDir, profile=profile)
+                seconds = time.perf_counter() - started
+        else:
+            raise ValueError(f"Unknown benchmark stage {stage}")
+
+        lines = len(lines)
+
+    result.update(
+        {
+            "seconds": seconds,
+            "lines": lines,
+            "lines_per_sec": lines / seconds,
+            "mb_per_sec": decompressedBytes / 1024 / 1024 / seconds,
+            "peak_rss_mb": peakRssMb(),
+            "stage_rss_mb": peakRssMb() - rssBefore
+        }
+    )
+
+    return result
+
+def compareResults(baseline: dict, current: dict):
+    """Logs the lines/sec change of every stage against an earlier results file"""
+    for stage, result in current["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        speedup = result["lines_per_sec"] / baseline["stages"][stage]["lines_per_sec"]
+        logger.info(f"{stage}: {speedup:.2f}x lines/sec vs baseline, peak RSS {result['peak_rss_mb']:.0f} MB (was {baseline['stages'][stage]['peak_rss_mb']:.0f} MB)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logs", help="Glob of gzipped ALB access logs, synthetic logs are generated when omitted")
+    parser.add_argument("--files", type=int, default=4, help="Synthetic log files to generate")
+    parser.add_argument("--lines", type=int, default=50_000, help="Lines per synthetic log file")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to benchmark")
+    parser.add_argument("--profile", choices=list(OUTPUT_PROFILES), default=OUTPUT_PROFILE, help="Output profile for the map and write stages")
+    parser.add_argument("--output", help="Results JSON path, defaults to benchmark_results/alb_benchmark_<timestamp>.json")
+    parser.add_argument("--compare", help="Earlier results JSON to compare this run against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as syntheticDir:
+        if args.logs:
+            logFiles = sorted(glob.glob(args.logs))
+        else:
+            logFiles = writeSyntheticAlbLogFiles(syntheticDir, args.files, args.lines, malformedRatio=0.001, lambdaRatio=0.1)
+
+        results = {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "pyarrow": pa.__version__,
+            "profile": args.profile,
+            "input": {
+                "files": len(logFiles),
+                "compressed_bytes": sum(path.getsize(logFile) for logFile in logFiles)
+            },
+            "stages": {}
+        }
+
+        for stage in args.stages:
+            # A fresh spawned process per stage keeps peak RSS from leaking between stages
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                result = pool.submit(runStage, stage, logFiles, args.profile).result()
+            results["stages"][stage] = result
+            logger.info(
+                f"{stage}: {result['lines_per_sec']:,.0f} lines/sec, {result['mb_per_sec']:.1f} MB/sec, peak RSS {result['peak_rss_mb']:.0f} MB"
+            )
+
+    outputPath = args.output or path.join(RESULTS_DIR, f"alb_benchmark_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json")
+    makedirs(path.dirname(outputPath) or ".", exist_ok=True)
+    with open(outputPath, "w") as resultsFile:
+        json.dump(results, resultsFile, indent=2)
+    logger.info(f"Wrote benchmark results to {outputPath}")
+
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            compareResults(json.load(baselineFile), results)
+
+# eof
@@ -0,0 +1,178 @@
+import argparse
+import logging
+import time
+
+import duckdb
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO)
+
+# Persistent DuckDB database holding the file registry and the summary tables
+CATALOG_PATH = "./awsalb_ocsf_http_activity.duckdb"
+# Parquet written by process_alb.py or duckdb_process_alb.py with the full or lean profile
+LOCAL_PARQUET = "awsalb_ocsf_http_activity/**/*.parquet.zstd"
+
+# Hive partition values stay the strings the writers produce, autocast would read account=012345678901 as a BIGINT
+# without its leading zero and event_date as a DATE
+READ_PARQUET_OPTIONS = "hive_partitioning = true, hive_types_autocast = false, union_by_name = true"
+
+# Summary tables kept in step with the Parquet files. "aggregates" summarize newly registered files, "merge"
+# folds those partial results into the existing rows, so a refresh only ever reads the files that landed since the last one
+SUMMARY_TABLES = {
+    "method_status_counts": {
+        "keys": ["activity_name AS http_method", "status_code"],
+        "aggregates": ["COUNT(*) AS total_requests"],
+        "merge": ["CAST(SUM(total_requests) AS BIGINT) AS total_requests"]
+    },
+    "src_ip_target_groups": {
+        "keys": ["src_endpoint.ip AS src_ip", "dst_endpoint.uid AS target_group_uid"],
+        "aggregates": ["COUNT(*) AS total_requests", "MIN(time) AS first_seen", "MAX(time) AS last_seen"],
+        "merge": ["CAST(SUM(total_requests) AS BIGINT) AS total_requests", "MIN(first_seen) AS first_seen", "MAX(last_seen) AS last_seen"]
+    },
+    "hourly_status_counts": {
+        "keys": ["cloud.account.uid AS account", "cloud.region AS region", "strftime(CAST(time AS TIMESTAMP), '%Y-%m-%d') AS event_date", "strftime(CAST(time AS TIMESTAMP), '%H') AS event_hour", "status_code"],
+        "aggregates": ["COUNT(*) AS total_requests", "CAST(SUM(traffic.bytes) AS BIGINT) AS total_bytes"],
+        "merge": ["CAST(SUM(total_requests) AS BIGINT) AS total_requests", "CAST(SUM(total_bytes) AS BIGINT) AS total_bytes"]
+    }
+}
+
+def sqlString(value: str) -> str:
+    """Quotes a Python string as a SQL string literal"""
+    return "'" + value.replace("'", "''") + "'"
+
+def keyName(keyExpression: str) -> str:
+    """Output column name of a summary key such as "activity_name AS http_method" """
+    return keyExpression.rsplit(" AS ", 1)[-1]
+
+def openOcsfCatalog(catalogPath: str = CATALOG_PATH, parquetGlob: str = LOCAL_PARQUET) -> duckdb.DuckDBPyConnection:
+    """
+    Opens (or creates) the catalog and registers the OCSF Parquet files once as the http_activity view,
+    the view and the summary tables persist in the .duckdb file between sessions
+    """
+    con = duckdb.connect(catalogPath)
+    con.execute("SET enable_progress_bar = false")
+    if parquetGlob.startswith("s3://"):
+        con.execute("INSTALL httpfs")
+        con.execute("LOAD httpfs")
+        con.execute("CREATE OR REPLACE SECRET alb_s3 (TYPE s3, PROVIDER credential_chain)")
+
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ocsf_files (
+            filename VARCHAR PRIMARY KEY,
+            size BIGINT,
+            last_modified TIMESTAMP,
+            registered_at TIMESTAMP
+        )
+        """
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE VIEW http_activity AS
+        SELECT * FROM read_parquet({sqlString(parquetGlob)}, {READ_PARQUET_OPTIONS})
+        """
+    )
+
+    return con
+
+def summaryDeltaSql(summary: dict, filenames: list[str]) -> str:
+    """Aggregates of one summary table over the given files only"""
+    fileList = "[" + ", ".join(sqlString(filename) for filename in filenames) + "]"
+    return f"""
+        SELECT {", ".join(summary["keys"] + summary["aggregates"])}
+        FROM read_parquet({fileList}, {READ_PARQUET_OPTIONS})
+        GROUP BY ALL
+    """
+
+def refreshOcsfCatalog(con: duckdb.DuckDBPyConnection, parquetGlob: str = LOCAL_PARQUET, rebuild: bool = False) -> dict:
+    """
+    Registers Parquet files that landed since the last refresh and folds only those into the summary tables.
+    Files that were removed or rewritten in place (compaction, a rerun over the same prefix) make the running
+    totals unreliable, the summaries are then rebuilt from every file instead
+    """
+    started = time.perf_counter()
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE listed_files AS
+        SELECT filename, size, CAST(last_modified AS TIMESTAMP) AS last_modified
+        FROM read_blob({sqlString(parquetGlob)})
+        """
+    )
+    changedFiles = con.execute(
+        """
+        SELECT COUNT(*)
+        FROM ocsf_files
+        LEFT JOIN listed_files USING (filename)
+        WHERE listed_files.filename IS NULL
+        OR listed_files.size != ocsf_files.size
+        OR listed_files.last_modified != ocsf_files.last_modified
+        """
+    ).fetchone()[0]
+    rebuild = rebuild or changedFiles > 0
+
+    con.execute("BEGIN TRANSACTION")
+    try:
+        if rebuild:
+            con.execute("DELETE FROM ocsf_files")
+            for table in SUMMARY_TABLES:
+                con.execute(f"DROP TABLE IF EXISTS {table}")
+
+        con.execute(
+            """
+            CREATE OR REPLACE TEMP TABLE new_files AS
+            SELECT listed_files.*
+            FROM listed_files
+            ANTI JOIN ocsf_files USING (filename)
+            """
+        )
+        newFiles = [row[0] for row in con.execute("SELECT filename FROM new_files ORDER BY filename").fetchall()]
+
+        if newFiles:
+            for table, summary in SUMMARY_TABLES.items():
+                keys = ", ".join(keyName(key) for key in summary["keys"])
+                delta = summaryDeltaSql(summary, newFiles)
+                con.execute(f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM ({delta}) LIMIT 0")
+                # Summary tables are small, folding the delta in with a GROUP BY rewrite is cheaper than keeping keys indexed
+                con.execute(
+                    f"""
+                    CREATE OR REPLACE TABLE {table} AS
+                    SELECT {keys}, {", ".join(summary["merge"])}
+                    FROM (
+                        SELECT * FROM {table}
+                        UNION ALL BY NAME
+                        {delta}
+                    )
+                    GROUP BY ALL
+                    """
+                )
+            con.execute("INSERT INTO ocsf_files SELECT *, now() FROM new_files")
+
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+    stats = {
+        "new_files": len(newFiles),
+        "rebuilt": rebuild,
+        "registered_files": con.execute("SELECT COUNT(*) FROM ocsf_files").fetchone()[0],
+        "seconds": time.perf_counter() - started
+    }
+    logger.info(
+        f"{'Rebuilt' if rebuild else 'Refreshed'} the OCSF catalog with {stats['new_files']} new Parquet files in {stats['seconds']:.2f}s, {stats['registered_files']} files registered."
+    )
+
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog", default=CATALOG_PATH, help="DuckDB database file for the catalog")
+    parser.add_argument("--parquet", default=LOCAL_PARQUET, help="Glob of the OCSF Parquet files, local or s3://")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute every summary table from all files")
+    args = parser.parse_args()
+
+    catalog = openOcsfCatalog(args.catalog, args.parquet)
+    refreshOcsfCatalog(catalog, args.parquet, rebuild=args.rebuild)
+    catalog.close()
+
+# eof
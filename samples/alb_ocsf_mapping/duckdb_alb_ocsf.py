@@ -1,50 +1,56 @@
 # %%
-import duckdb
+from duckdb_alb_catalog import CATALOG_PATH, LOCAL_PARQUET, openOcsfCatalog, refreshOcsfCatalog
 
-LOCAL_PARQUET = "awsalb_ocsf_http_activity.parquet.zstd"
+# The catalog registers the Parquet files once as the http_activity view and keeps summary tables that
+# only fold in files written since the last refresh, rerun this cell after a conversion run
+catalog = openOcsfCatalog(CATALOG_PATH, LOCAL_PARQUET)
+refreshOcsfCatalog(catalog, LOCAL_PARQUET)
 
 # %%
-duckdb.sql(
-    f"""
-    SELECT COUNT(*) FROM read_parquet('{LOCAL_PARQUET}')
+catalog.sql(
+    """
+    SELECT SUM(total_requests) FROM method_status_counts
     """
 ).show()
 
 # %%
-duckdb.sql(
-    f"""
-    SELECT * FROM read_parquet('{LOCAL_PARQUET}')
+catalog.sql(
+    """
+    SELECT * FROM http_activity
     LIMIT 30
     """
 ).show()
 
 # %%
-duckdb.sql(
-    f"""
-    SELECT DISTINCT
-        src_endpoint.ip,
-        dst_endpoint.uid
-    FROM read_parquet('{LOCAL_PARQUET}')
+catalog.sql(
+    """
+    SELECT
+        src_ip,
+        target_group_uid,
+        total_requests,
+        first_seen,
+        last_seen
+    FROM src_ip_target_groups
+    ORDER BY total_requests DESC
     LIMIT 50
     """
 ).show()
 
 # %%
-duckdb.sql(
-    f"""
+catalog.sql(
+    """
     SELECT
-        COUNT(activity_name) AS total_methods,
+        total_requests AS total_methods,
         status_code,
-        activity_name as http_method
-    FROM read_parquet('{LOCAL_PARQUET}')
-    GROUP BY http_method, status_code
+        http_method
+    FROM method_status_counts
     ORDER BY total_methods DESC
     """
 ).show()
 
 # %%
-duckdb.sql(
-    f"""
+catalog.sql(
+    """
     SELECT
         src_endpoint.ip as src_ip,
         src_endpoint.port as src_port,
@@ -53,20 +59,52 @@ duckdb.sql(
         http_request.user_agent as user_agent,
         message,
         status_detail
-    FROM read_parquet('{LOCAL_PARQUET}')
+    FROM http_activity
     WHERE status_code = 460
     """
 ).show()
 
 # %%
-duckdb.sql(
-    f"""
+catalog.sql(
+    """
     SELECT
         activity_name as http_method,
         status,
         src_endpoint.ip,
         http_request.url.query_string as query_string
-    FROM read_parquet('{LOCAL_PARQUET}')
+    FROM http_activity
     WHERE http_request.url.query_string IS NOT NULL
     """
-).show()
\ No newline at end of file
+).show()
+# %%
+# Partition columns from the account=/region=/event_date=/event_hour= paths prune files before they are read
+catalog.sql(
+    """
+    SELECT
+        event_hour,
+        status_code,
+        COUNT(*) AS total_requests
+    FROM http_activity
+    WHERE event_date = '2024-12-01'
+    AND event_hour BETWEEN '09' AND '12'
+    GROUP BY event_hour, status_code
+    ORDER BY event_hour, total_requests DESC
+    """
+).show()
+
+# %%
+# The same hourly breakdown from the summary table, no Parquet is read at all
+catalog.sql(
+    """
+    SELECT
+        event_hour,
+        status_code,
+        SUM(total_requests) AS total_requests,
+        SUM(total_bytes) AS total_bytes
+    FROM hourly_status_counts
+    WHERE event_date = '2024-12-01'
+    AND event_hour BETWEEN '09' AND '12'
+    GROUP BY event_hour, status_code
+    ORDER BY event_hour, total_requests DESC
+    """
+).show()
@@ -0,0 +1,462 @@
+import argparse
+import glob
+import json
+import logging
+from datetime import datetime
+from gzip import open as gunzip
+from os import makedirs
+
+import duckdb
+import pyarrow as pa
+
+from process_alb import (
+    ALB_FIELDS,
+    ALB_FIELD_COUNT,
+    LEGACY_TIMESTAMPS,
+    OUTPUT_DESTINATION,
+    OUTPUT_PROFILE,
+    OUTPUT_PROFILES,
+    PARTITION_OUTPUT,
+    ROW_GROUP_SIZE,
+    ocsfHttpActivityNestedSchema,
+    processAlbLog
+)
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO)
+
+# Local glob or s3:// glob of gzipped ALB access logs
+ALB_LOG_SOURCE = "./alb_logs/**/*.log.gz"
+# DuckDB worker threads, None lets DuckDB use every core
+THREADS = None
+# DuckDB memory limit such as "8GB", None keeps the DuckDB default of 80% of RAM
+MEMORY_LIMIT = None
+
+# Same split as tokenizeAlbLog: a double-quoted field, which may hold \" escapes, or a run of non-space characters
+# outside quotes
+ALB_TOKEN_PATTERN = r'"(?:[^"\\]|\\.)*"|[^\s"]+'
+# A line whose quoted fields are all terminated, the same lines tokenizeAlbLog accepts
+ALB_QUOTES_PATTERN = r'(?:"(?:[^"\\]|\\.)*"|[^"])*'
+# urllib.parse.urlsplit: scheme, //netloc, path and ?query of the request URL, the #fragment is ignored
+URL_PATTERN = r"^(?:([A-Za-z][A-Za-z0-9+.\-]*):)?(?://([^/?#]*))?([^?#]*)(?:\?([^#]*))?"
+
+def sqlString(value: str) -> str:
+    """Quotes a Python string as a SQL string literal"""
+    return "'" + value.replace("'", "''") + "'"
+
+def sqlTimestamps(column: str, legacyTimestamps: bool) -> str:
+    """
+    ISO-8601 ALB timestamps as TIMESTAMP_MS truncated like parseIso8601Timestamps, or the legacy
+    "YYYY-MM-DD HH:MM:SS.000" strings of convertIso8061ToSqlTimestamp that drop the fraction altogether.
+    Values that do not parse become NULL instead of failing the whole query
+    """
+    if legacyTimestamps:
+        return f"strftime(TRY_CAST(split_part({column}, '.', 1) AS TIMESTAMP), '%Y-%m-%d %H:%M:%S') || '.000'"
+
+    return f"CAST(date_trunc('millisecond', TRY_CAST(replace({column}, 'Z', '') AS TIMESTAMP)) AS TIMESTAMP_MS)"
+
+def sqlObservable(name: str, observableType: str, typeId: int, value: str) -> str:
+    return f"{{'name': {sqlString(name)}, 'type': {sqlString(observableType)}, 'type_id': CAST({typeId} AS INTEGER), 'value': {value}}}"
+
+def albOcsfHttpActivitySql(sources: list[str], legacyTimestamps: bool = LEGACY_TIMESTAMPS) -> str:
+    """
+    SQL version of HttpActivityBatchBuilder: reads gzipped ALB logs line by line with DuckDB's CSV reader,
+    tokenizes them like tokenizeAlbLog and maps every line to a full OCSF HTTP Activity row.
+    Lines mapPreProcessedLog and processAlbLog skip (malformed, no target group, non-numeric fields, times that do
+    not parse) are filtered out
+    """
+    # Only the enclosing quotes come off, trim() would also strip an escaped quote at the end of a field
+    fieldColumns = ",\n            ".join(
+        f'if(starts_with(tokens[{index}], \'"\'), tokens[{index}][2:-2], tokens[{index}]) AS "{name}"'
+        for index, name in enumerate(ALB_FIELDS, start=1)
+    )
+    sourceList = "[" + ", ".join(sqlString(source) for source in sources) + "]"
+
+    return f"""
+    WITH raw_logs AS (
+        -- Whole lines, raw_data needs them verbatim and newer ALB log formats append fields past the known ones
+        SELECT rawlog
+        FROM read_csv(
+            {sourceList},
+            columns = {{'rawlog': 'VARCHAR'}},
+            delim = '\\0',
+            quote = '',
+            escape = '',
+            header = false,
+            auto_detect = false
+        )
+    ),
+    tokenized AS (
+        SELECT
+            rawlog,
+            regexp_extract_all(rawlog, {sqlString(ALB_TOKEN_PATTERN)}) AS tokens
+        FROM raw_logs
+        -- Lines with an unterminated quoted field are dropped
+        WHERE rawlog IS NOT NULL
+        AND regexp_full_match(rawlog, {sqlString(ALB_QUOTES_PATTERN)})
+    ),
+    fields AS (
+        SELECT
+            rawlog,
+            {fieldColumns}
+        FROM tokenized
+        WHERE len(tokens) >= {ALB_FIELD_COUNT}
+    ),
+    derived AS (
+        SELECT
+            *,
+            string_split(target_group_arn, ':') AS arn_parts,
+            string_split(request, ' ') AS request_parts,
+            string_split(client, ':') AS client_parts,
+            TRY_CAST(request_processing_time AS DOUBLE) + TRY_CAST(target_processing_time AS DOUBLE) + TRY_CAST(response_processing_time AS DOUBLE) AS duration,
+            TRY_CAST(sent_bytes AS BIGINT) AS bytes_out,
+            TRY_CAST(received_bytes AS BIGINT) AS bytes_in,
+            {sqlTimestamps('"time"', legacyTimestamps)} AS parsed_time,
+            {sqlTimestamps('request_creation_time', legacyTimestamps)} AS parsed_start_time
+        FROM fields
+        -- ALB access log docs don't account for this, but if the TG ARN is empty it is likely a log delivery error and should be ignored
+        WHERE target_group_arn != '-'
+    ),
+    valid AS (
+        SELECT
+            *,
+            arn_parts[4] AS aws_region,
+            arn_parts[5] AS aws_account,
+            request_parts[1] AS request_method,
+            request_parts[2] AS url_string,
+            client_parts[1] AS src_ip,
+            client_parts[2] AS src_port,
+            'arn:aws:elasticloadbalancing:' || arn_parts[4] || ':' || arn_parts[5] || ':loadbalancer/' || elb AS elb_arn,
+            regexp_extract(request_parts[2], {sqlString(URL_PATTERN)}, 2) AS url_netloc
+        FROM derived
+        WHERE len(arn_parts) >= 5
+        AND len(request_parts) >= 3
+        AND len(client_parts) >= 2
+        AND duration IS NOT NULL
+        AND bytes_out IS NOT NULL
+        AND bytes_in IS NOT NULL
+        AND parsed_time IS NOT NULL
+        AND parsed_start_time IS NOT NULL
+        AND TRY_CAST(client_parts[2] AS INTEGER) IS NOT NULL
+    ),
+    events AS (
+        SELECT
+            *,
+            CASE request_method
+                WHEN 'CONNECT' THEN 1
+                WHEN 'DELETE' THEN 2
+                WHEN 'GET' THEN 3
+                WHEN 'HEAD' THEN 4
+                WHEN 'OPTIONS' THEN 5
+                WHEN 'POST' THEN 6
+                WHEN 'PUT' THEN 7
+                WHEN 'TRACE' THEN 8
+                ELSE 99
+            END AS activity_id,
+            CASE WHEN request_method IN ('CONNECT', 'DELETE', 'GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'TRACE')
+                THEN upper(request_method[1]) || lower(request_method[2:])
+                ELSE 'Other'
+            END AS activity_name,
+            left(elb_status_code, 1) IN ('1', '2', '3') AS is_success,
+            -- Same host and port rules as urlparse: userinfo is dropped, [IPv6] hosts keep their colons
+            regexp_extract(url_netloc, '([^@]*)$', 1) AS url_hostinfo
+        FROM valid
+    ),
+    urls AS (
+        SELECT
+            *,
+            CASE WHEN contains(url_hostinfo, '[')
+                THEN regexp_extract(url_hostinfo, '\\[([^\\]]*)', 1)
+                ELSE split_part(url_hostinfo, ':', 1)
+            END AS url_hostname,
+            CASE WHEN contains(url_hostinfo, '[')
+                THEN regexp_extract(url_hostinfo, '\\[[^\\]]*\\]?[^:]*:(.*)$', 1)
+                ELSE regexp_extract(url_hostinfo, ':(.*)$', 1)
+            END AS url_port
+        FROM events
+    )
+    SELECT
+        CAST(activity_id AS INTEGER) AS activity_id,
+        activity_name,
+        'Network Activity' AS category_name,
+        CAST(4 AS INTEGER) AS category_uid,
+        'HTTP Activity' AS class_name,
+        CAST(4002 AS INTEGER) AS class_uid,
+        CAST(1 AS INTEGER) AS severity_id,
+        'Informational' AS severity,
+        CASE WHEN is_success THEN 'Success' ELSE 'Failure' END AS status,
+        elb_status_code AS status_code,
+        NULLIF(error_reason, '-') AS status_detail,
+        CAST(CASE WHEN is_success THEN 1 ELSE 2 END AS INTEGER) AS status_id,
+        CAST(400200 + activity_id AS BIGINT) AS type_uid,
+        'HTTP Activity: ' || activity_name AS type_name,
+        'ALB executed the following actions: ' || actions_executed AS message,
+        parsed_time AS "time",
+        parsed_start_time AS start_time,
+        duration,
+        rawlog AS raw_data,
+        {{
+            'uid': trace_id,
+            'logged_time': parsed_time,
+            'orignal_time': parsed_time,
+            'version': '1.4.0',
+            'profiles': ['cloud'],
+            'product': {{
+                'name': 'Amazon Elastic Load Balancing',
+                'vendor_name': 'AWS',
+                'feature': {{'name': 'AlbAccessLogs'}}
+            }}
+        }} AS metadata,
+        [
+            {sqlObservable("src_endpoint.ip", "IP Address", 2, "src_ip")},
+            {sqlObservable("src_endpoint.port", "Port", 11, "src_port")},
+            {sqlObservable("http_request.url.url_string", "URL String", 6, "url_string")},
+            {sqlObservable("src_endpoint.uid", "Resource UID", 10, "elb_arn")},
+            {sqlObservable("dst_endpoint.uid", "Resource UID", 10, "target_group_arn")},
+            {sqlObservable("http_request.user_agent", "User Agent", 16, "user_agent")},
+            {sqlObservable("cloud.account.uid", "Account UID", 35, "aws_account")}
+        ] AS observables,
+        {{
+            'account': {{'type_id': CAST(10 AS INTEGER), 'type': 'AWS Account', 'uid': aws_account}},
+            'region': aws_region,
+            'provider': 'AWS'
+        }} AS cloud,
+        {{
+            'boundary_id': CAST(3 AS INTEGER),
+            'boundary': 'External',
+            'direction_id': CAST(1 AS INTEGER),
+            'direction': 'Inbound',
+            'protocol_name': 'tcp',
+            'protocol_num': CAST(6 AS INTEGER),
+            'uid': trace_id
+        }} AS connection_info,
+        -- elbTargetProcessor never returns a target ip/port, so neither do the dst_endpoint observables
+        {{
+            'ip': CAST(NULL AS VARCHAR),
+            'port': CAST(NULL AS INTEGER),
+            'uid': target_group_arn
+        }} AS dst_endpoint,
+        {{
+            'http_method': upper(request_method),
+            'version': request_parts[3],
+            'user_agent': user_agent,
+            'uid': trace_id,
+            'url': {{
+                'hostname': lower(NULLIF(url_hostname, '')),
+                'path': NULLIF(regexp_extract(url_string, {sqlString(URL_PATTERN)}, 3), ''),
+                'port': CASE WHEN regexp_full_match(url_port, '[0-9]+') AND TRY_CAST(url_port AS BIGINT) <= 65535
+                    THEN CAST(url_port AS INTEGER)
+                END,
+                'query_string': NULLIF(regexp_extract(url_string, {sqlString(URL_PATTERN)}, 4), ''),
+                'scheme': lower(NULLIF(regexp_extract(url_string, {sqlString(URL_PATTERN)}, 1), '')),
+                'url_string': url_string
+            }}
+        }} AS http_request,
+        {{
+            'ip': src_ip,
+            'port': CAST(src_port AS INTEGER),
+            'uid': elb_arn
+        }} AS src_endpoint,
+        {{
+            'bytes_out': bytes_out,
+            'bytes_in': bytes_in,
+            'bytes': bytes_out + bytes_in
+        }} AS traffic,
+        {{
+            'cipher': NULLIF(ssl_cipher, '-'),
+            'sni': NULLIF(domain_name, '-'),
+            'version': NULLIF(ssl_protocol, '-')
+        }} AS tls,
+        {{
+            'target_status_code': target_status_code,
+            'chosen_cert_arn': chosen_cert_arn,
+            'matched_rule_priority': matched_rule_priority,
+            'redirect_url': redirect_url,
+            'target_list': target_list,
+            'target_status_code_list': target_status_code_list,
+            'classification': classification,
+            'classification_reason': classification_reason
+        }} AS unmapped
+    FROM urls
+    """
+
+def profileColumnsSql(legacyTimestamps: bool = LEGACY_TIMESTAMPS, profile: str = OUTPUT_PROFILE) -> list[str]:
+    """
+    Select list of an output profile over the full OCSF rows, flattened profiles select every leaf as parent_child
+    """
+    def leaves(fields, parentPath: list[str]):
+        for field in fields:
+            columnPath = parentPath + [field.name]
+            if pa.types.is_struct(field.type):
+                yield from leaves(field.type, columnPath)
+            else:
+                yield columnPath
+
+    schema = ocsfHttpActivityNestedSchema(legacyTimestamps, profile)
+    if not OUTPUT_PROFILES[profile]["flatten"]:
+        return [f'"{field.name}"' for field in schema]
+
+    return [
+        ".".join(f'"{name}"' for name in columnPath) + f' AS "{"_".join(columnPath)}"'
+        for columnPath in leaves(schema, [])
+    ]
+
+def connectDuckDb(sources: list[str], destination: str = "", threads: int | None = THREADS, memoryLimit: str | None = MEMORY_LIMIT) -> duckdb.DuckDBPyConnection:
+    """In-memory DuckDB connection, with httpfs and the AWS credential chain when reading or writing S3"""
+    con = duckdb.connect()
+    con.execute("SET enable_progress_bar = false")
+    # Pushed down filters would re-run the tokenizer regex once per filter on every line, keep them where they are written
+    con.execute("SET disabled_optimizers = 'filter_pushdown'")
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    if memoryLimit:
+        con.execute(f"SET memory_limit = {sqlString(memoryLimit)}")
+    if any(location.startswith("s3://") for location in [*sources, destination]):
+        con.execute("INSTALL httpfs")
+        con.execute("LOAD httpfs")
+        con.execute("CREATE OR REPLACE SECRET alb_s3 (TYPE s3, PROVIDER credential_chain)")
+
+    return con
+
+def createOcsfView(con: duckdb.DuckDBPyConnection, sources: list[str], legacyTimestamps: bool = LEGACY_TIMESTAMPS, profile: str = OUTPUT_PROFILE, partitionOutput: bool = False):
+    """
+    Registers the ocsf_http_activity view in the profile's shape, optionally with the
+    account/region/event_date/event_hour columns the partitioned COPY splits files on
+    """
+    columns = profileColumnsSql(legacyTimestamps, profile)
+    if partitionOutput:
+        eventTime = '"time"' if not legacyTimestamps else 'CAST("time" AS TIMESTAMP)'
+        columns += [
+            '"cloud"."account"."uid" AS account',
+            '"cloud"."region" AS region',
+            f"strftime({eventTime}, '%Y-%m-%d') AS event_date",
+            f"strftime({eventTime}, '%H') AS event_hour"
+        ]
+
+    con.execute(
+        f"""
+        CREATE OR REPLACE VIEW ocsf_http_activity AS
+        SELECT {", ".join(columns)}
+        FROM ({albOcsfHttpActivitySql(sources, legacyTimestamps)})
+        """
+    )
+
+def convertAlbLogs(
+    sources: list[str],
+    outputDestination: str = OUTPUT_DESTINATION,
+    legacyTimestamps: bool = LEGACY_TIMESTAMPS,
+    profile: str = OUTPUT_PROFILE,
+    partitionOutput: bool = PARTITION_OUTPUT,
+    rowGroupSize: int = ROW_GROUP_SIZE,
+    threads: int | None = THREADS,
+    memoryLimit: str | None = MEMORY_LIMIT
+) -> int:
+    """
+    Converts ALB logs to OCSF Parquet in a single COPY, DuckDB parallelizes reading, mapping and writing itself.
+    Output uses the same Hive layout, file suffix and ZSTD compression as process_alb.py, returns the records written
+    """
+    con = connectDuckDb(sources, outputDestination, threads, memoryLimit)
+    createOcsfView(con, sources, legacyTimestamps, profile, partitionOutput)
+
+    if outputDestination.startswith("s3://"):
+        outputDestination = outputDestination.rstrip("/")
+    else:
+        makedirs(outputDestination, exist_ok=True)
+
+    copyOptions = [
+        "FORMAT parquet",
+        "COMPRESSION zstd",
+        f"ROW_GROUP_SIZE {int(rowGroupSize)}",
+        "FILENAME_PATTERN 'part-{uuid}'",
+        "FILE_EXTENSION 'parquet.zstd'"
+    ]
+    if partitionOutput:
+        copyOptions += ["PARTITION_BY (account, region, event_date, event_hour)", "APPEND"]
+    else:
+        copyOptions += ["PER_THREAD_OUTPUT", "APPEND"]
+
+    records = con.execute(
+        f"COPY (SELECT * FROM ocsf_http_activity) TO {sqlString(outputDestination)} ({', '.join(copyOptions)})"
+    ).fetchone()[0]
+    con.close()
+
+    logger.info(f"Wrote {records} OCSF records to {outputDestination} with DuckDB.")
+    return records
+
+def normalizeParityValue(value):
+    """Brings SQL output into the shape of httpActivityOcsfBuilder documents, timestamps become the legacy strings"""
+    if isinstance(value, dict):
+        return {key: normalizeParityValue(child) for key, child in value.items()}
+    if isinstance(value, list):
+        return [normalizeParityValue(child) for child in value]
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S.000")
+    if isinstance(value, str):
+        return value.rstrip("\r\n")
+
+    return value
+
+def checkSqlParity(logFiles: list[str], legacyTimestamps: bool = LEGACY_TIMESTAMPS) -> list[dict]:
+    """
+    Runs local gzipped ALB logs through both the SQL engine and httpActivityOcsfBuilder (via processAlbLog) and
+    returns every record where they disagree. timestamp[ms] values are compared at the second precision of the
+    legacy strings httpActivityOcsfBuilder produces, raw_data without its trailing newline
+    """
+    mismatches = []
+    for logFile in logFiles:
+        with gunzip(logFile, mode="rt") as logs:
+            expected = [ocsf for ocsf in map(processAlbLog, logs) if ocsf is not None]
+
+        con = connectDuckDb([logFile])
+        createOcsfView(con, [logFile], legacyTimestamps)
+        result = con.execute("SELECT * FROM ocsf_http_activity")
+        columns = [description[0] for description in result.description]
+        actual = [dict(zip(columns, row)) for row in result.fetchall()]
+        con.close()
+
+        if len(actual) != len(expected):
+            mismatches.append({"file": logFile, "sql_records": len(actual), "python_records": len(expected)})
+
+        for recordNumber, (sqlRecord, pythonRecord) in enumerate(zip(actual, expected), start=1):
+            differences = {
+                column: {"sql": normalizeParityValue(sqlRecord.get(column)), "python": normalizeParityValue(value)}
+                for column, value in pythonRecord.items()
+                if normalizeParityValue(sqlRecord.get(column)) != normalizeParityValue(value)
+            }
+            if differences:
+                mismatches.append({"file": logFile, "record": recordNumber, "differences": differences})
+
+    return mismatches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", action="append", dest="sources", help="Local or s3:// glob of gzipped ALB access logs, repeat for several")
+    parser.add_argument("--legacy-timestamps", action="store_true", help="Write event times as strings instead of timestamp[ms] columns")
+    parser.add_argument("--profile", choices=list(OUTPUT_PROFILES), default=OUTPUT_PROFILE, help="Output profile: full, lean (no raw_data) or analytics (flattened, no raw_data or observables)")
+    parser.add_argument("--output", default=OUTPUT_DESTINATION, help="Local directory or s3://bucket/prefix for the output Parquet files")
+    parser.add_argument("--no-partition", action="store_true", help="Write a flat set of Parquet files instead of account/region/date/hour partitions")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help="Rows per Parquet row group")
+    parser.add_argument("--threads", type=int, default=THREADS, help="DuckDB worker threads, defaults to every core")
+    parser.add_argument("--memory-limit", default=MEMORY_LIMIT, help="DuckDB memory limit such as 8GB")
+    parser.add_argument("--parity-check", metavar="LOG_GLOB", help="Compare SQL and Python OCSF output for local gzipped ALB logs and exit")
+    args = parser.parse_args()
+
+    if args.parity_check:
+        logFiles = sorted(glob.glob(args.parity_check, recursive=True))
+        mismatches = checkSqlParity(logFiles, legacyTimestamps=args.legacy_timestamps)
+        for mismatch in mismatches:
+            logger.warning(f"SQL mismatch: {json.dumps(mismatch, default=str)}")
+        logger.info(f"Parity check of {len(logFiles)} files found {len(mismatches)} mismatched records.")
+    else:
+        convertAlbLogs(
+            sources=args.sources or [ALB_LOG_SOURCE],
+            outputDestination=args.output,
+            legacyTimestamps=args.legacy_timestamps,
+            profile=args.profile,
+            partitionOutput=not args.no_partition,
+            rowGroupSize=args.row_group_size,
+            threads=args.threads,
+            memoryLimit=args.memory_limit
+        )
+
+# eof
@@ -0,0 +1,242 @@
+import argparse
+import json
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
+
+from process_alb import OUTPUT_DESTINATION, resolveOutputDestination
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO)
+
+# Index segments live next to the OCSF output, the leading underscore keeps Parquet readers of the output from picking them up
+INDEX_DIRECTORY = "_observable_index"
+# OCSF Parquet files that get indexed
+OCSF_FILE_SUFFIX = ".parquet.zstd"
+# Index rows per row group, smaller row groups let a lookup skip more of the index on the sorted value statistics
+INDEX_ROW_GROUP_SIZE = 16_384
+
+OBSERVABLE_INDEX_SCHEMA = pa.schema(
+    [
+        ("type_id", pa.int32()),
+        ("value", pa.string()),
+        ("file", pa.string()),
+        ("row_group", pa.int32()),
+        ("row", pa.int32()),
+        # Size and modification time of the file when it was indexed, a file rewritten in place no longer matches its rows
+        ("file_size", pa.int64()),
+        ("file_mtime_ns", pa.int64())
+    ]
+)
+
+def resolveFilesystem(destination: str) -> tuple[fs.FileSystem, str]:
+    """resolveOutputDestination with the local filesystem spelled out"""
+    filesystem, basePath = resolveOutputDestination(destination)
+    return filesystem or fs.LocalFileSystem(), basePath
+
+def listOcsfFiles(filesystem: fs.FileSystem, basePath: str) -> dict[str, tuple[int, int]]:
+    """(size, mtime_ns) of every OCSF Parquet file under the output, by path relative to it"""
+    fileInfos = filesystem.get_file_info(fs.FileSelector(basePath, recursive=True, allow_not_found=True))
+    return {
+        fileInfo.path[len(basePath) + 1:]: (fileInfo.size, fileInfo.mtime_ns)
+        for fileInfo in sorted(fileInfos, key=lambda fileInfo: fileInfo.path)
+        if fileInfo.type == fs.FileType.File and fileInfo.path.endswith(OCSF_FILE_SUFFIX)
+    }
+
+def indexedFiles(filesystem: fs.FileSystem, indexPath: str) -> dict[str, tuple[int, int]]:
+    """Files already covered by an index segment, with the (size, mtime_ns) they had when they were indexed"""
+    if filesystem.get_file_info(indexPath).type != fs.FileType.Directory:
+        return {}
+
+    indexDataset = ds.dataset(indexPath, format="parquet", filesystem=filesystem)
+    files = indexDataset.to_table(columns=["file", "file_size", "file_mtime_ns"]).group_by(["file", "file_size", "file_mtime_ns"]).aggregate([])
+    return {
+        relativePath: (fileSize, fileMtimeNs)
+        for relativePath, fileSize, fileMtimeNs in zip(*(files.column(name).to_pylist() for name in ("file", "file_size", "file_mtime_ns")))
+    }
+
+def segmentPath(indexPath: str) -> str:
+    """Path of a new index segment, named after the time it is written"""
+    return f"{indexPath}/segment-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')}.parquet"
+
+def dropIndexEntries(filesystem: fs.FileSystem, indexPath: str, files: set[str]) -> int:
+    """
+    Rewrites the index segments that point into the given files without those rows, segments left empty are deleted.
+    The rewritten segment is written before the old one is removed, so an interrupted rewrite only leaves duplicates
+    """
+    dropped = 0
+    fileFilter = pc.field("file").isin(pa.array(sorted(files), type=pa.string()))
+    indexDataset = ds.dataset(indexPath, format="parquet", filesystem=filesystem)
+    for fragment in indexDataset.get_fragments():
+        segment = fragment.to_table(schema=OBSERVABLE_INDEX_SCHEMA)
+        kept = segment.filter(~fileFilter)
+        if kept.num_rows == segment.num_rows:
+            continue
+        if kept.num_rows:
+            # Filtering keeps the segment sorted by type_id and value
+            pq.write_table(kept, segmentPath(indexPath), filesystem=filesystem, row_group_size=INDEX_ROW_GROUP_SIZE, compression="zstd")
+        filesystem.delete_file(fragment.path)
+        dropped += segment.num_rows - kept.num_rows
+
+    return dropped
+
+def explodeObservables(relativePath: str, fileStamp: tuple[int, int], rowGroup: int, observables: pa.ChunkedArray) -> pa.Table:
+    """One index row per observable of a row group, pointing back at the row it came from"""
+    observables = observables.combine_chunks()
+    flattened = pc.list_flatten(observables)
+    rows = pc.list_parent_indices(observables).cast(pa.int32())
+
+    return pa.Table.from_arrays(
+        [
+            flattened.field("type_id"),
+            flattened.field("value"),
+            pa.repeat(pa.scalar(relativePath), len(flattened)),
+            pa.repeat(pa.scalar(rowGroup, type=pa.int32()), len(flattened)),
+            rows,
+            pa.repeat(pa.scalar(fileStamp[0], type=pa.int64()), len(flattened)),
+            pa.repeat(pa.scalar(fileStamp[1], type=pa.int64()), len(flattened))
+        ],
+        schema=OBSERVABLE_INDEX_SCHEMA
+    )
+
+def buildObservableIndex(outputDestination: str = OUTPUT_DESTINATION, rebuild: bool = False) -> dict:
+    """
+    Explodes the observables of every OCSF file not indexed yet into (type_id, value) -> (file, row_group, row) rows
+    and writes them, sorted by type_id and value, as a new index segment. Only the observables column is read.
+    Files removed or rewritten in place since they were indexed (same name, other size or mtime, as when a rerun
+    overwrites part-000-NNNNN) have their index rows dropped, and rewritten ones are indexed again
+    """
+    started = time.perf_counter()
+    filesystem, basePath = resolveFilesystem(outputDestination)
+    indexPath = f"{basePath}/{INDEX_DIRECTORY}"
+
+    if rebuild and filesystem.get_file_info(indexPath).type == fs.FileType.Directory:
+        filesystem.delete_dir(indexPath)
+
+    ocsfFiles = listOcsfFiles(filesystem, basePath)
+    alreadyIndexed = indexedFiles(filesystem, indexPath)
+    staleFiles = {relativePath for relativePath, fileStamp in alreadyIndexed.items() if ocsfFiles.get(relativePath) != fileStamp}
+    dropped = dropIndexEntries(filesystem, indexPath, staleFiles) if staleFiles else 0
+    if staleFiles:
+        logger.info(f"Dropped {dropped} index entries of {len(staleFiles)} OCSF files removed or rewritten since they were indexed.")
+    newFiles = [relativePath for relativePath, fileStamp in ocsfFiles.items() if alreadyIndexed.get(relativePath) != fileStamp]
+
+    segments = []
+    for relativePath in newFiles:
+        parquetFile = pq.ParquetFile(f"{basePath}/{relativePath}", filesystem=filesystem)
+        if "observables" not in parquetFile.schema_arrow.names:
+            # The analytics profile drops observables, there is nothing to index
+            logger.warning(f"Skipping {relativePath}, it has no observables column.")
+            continue
+        for rowGroup in range(parquetFile.num_row_groups):
+            observables = parquetFile.read_row_group(rowGroup, columns=["observables"]).column("observables")
+            segments.append(explodeObservables(relativePath, ocsfFiles[relativePath], rowGroup, observables))
+
+    stats = {"files": len(newFiles), "entries": 0, "segment": None, "stale_files": len(staleFiles), "dropped_entries": dropped}
+    if segments:
+        index = pa.concat_tables(segments).sort_by(
+            [("type_id", "ascending"), ("value", "ascending"), ("file", "ascending"), ("row_group", "ascending"), ("row", "ascending")]
+        )
+        filesystem.create_dir(indexPath, recursive=True)
+        newSegment = segmentPath(indexPath)
+        pq.write_table(index, newSegment, filesystem=filesystem, row_group_size=INDEX_ROW_GROUP_SIZE, compression="zstd")
+        stats.update({"entries": index.num_rows, "segment": newSegment})
+
+    stats["seconds"] = time.perf_counter() - started
+    logger.info(f"Indexed {stats['entries']} observables from {stats['files']} new or rewritten OCSF files in {stats['seconds']:.2f}s.")
+
+    return stats
+
+def lookupObservables(values: list[str], typeId: int | None = None, outputDestination: str = OUTPUT_DESTINATION, columns: list[str] | None = None) -> pa.Table:
+    """
+    Returns the OCSF records whose observables contain any of the values (optionally of one OCSF observable type_id),
+    with the file, row_group and row they were read from. Only index row groups whose value statistics can match are
+    read, and only the row groups of the OCSF files that the index points at. Files removed or rewritten since the
+    last build are skipped, their index rows no longer point at the right records
+    """
+    filesystem, basePath = resolveFilesystem(outputDestination)
+    indexPath = f"{basePath}/{INDEX_DIRECTORY}"
+    if filesystem.get_file_info(indexPath).type != fs.FileType.Directory:
+        raise FileNotFoundError(f"No observable index at {indexPath}, build it with --build first")
+
+    indexFilter = pc.field("value").isin(pa.array(values, type=pa.string()))
+    if typeId is not None:
+        indexFilter = (pc.field("type_id") == typeId) & indexFilter
+
+    indexDataset = ds.dataset(indexPath, format="parquet", filesystem=filesystem)
+    hits = pa.concat_tables(
+        [
+            rowGroupFragment.to_table(filter=indexFilter, schema=OBSERVABLE_INDEX_SCHEMA)
+            for fragment in indexDataset.get_fragments()
+            for rowGroupFragment in fragment.split_by_row_group(indexFilter)
+        ]
+        or [OBSERVABLE_INDEX_SCHEMA.empty_table()]
+    )
+
+    # A record with the same value in several observables (src and dst ip) is returned once
+    rowsByRowGroup = defaultdict(set)
+    indexedStamps = {}
+    for relativePath, rowGroup, row, fileSize, fileMtimeNs in zip(
+        *(hits.column(name).to_pylist() for name in ("file", "row_group", "row", "file_size", "file_mtime_ns"))
+    ):
+        rowsByRowGroup[(relativePath, rowGroup)].add(row)
+        indexedStamps[relativePath] = (fileSize, fileMtimeNs)
+
+    fileInfos = filesystem.get_file_info([f"{basePath}/{relativePath}" for relativePath in indexedStamps])
+    staleFiles = {
+        relativePath
+        for relativePath, fileInfo in zip(indexedStamps, fileInfos)
+        if fileInfo.type != fs.FileType.File or (fileInfo.size, fileInfo.mtime_ns) != indexedStamps[relativePath]
+    }
+    if staleFiles:
+        logger.warning(f"Skipping {len(staleFiles)} OCSF files removed or rewritten since they were indexed, run --build to index them again.")
+
+    matches = []
+    for (relativePath, rowGroup), rows in sorted(rowsByRowGroup.items()):
+        if relativePath in staleFiles:
+            continue
+        parquetFile = pq.ParquetFile(f"{basePath}/{relativePath}", filesystem=filesystem)
+        rows = sorted(rows)
+        records = parquetFile.read_row_group(rowGroup, columns=columns).take(rows)
+        matches.append(
+            records.append_column("file", pa.repeat(pa.scalar(relativePath), len(rows)))
+            .append_column("row_group", pa.repeat(pa.scalar(rowGroup, type=pa.int32()), len(rows)))
+            .append_column("row", pa.array(rows, type=pa.int32()))
+        )
+
+    logger.info(f"Found {sum(match.num_rows for match in matches)} records in {len(matches)} row groups for {len(values)} observable values.")
+    if not matches:
+        return pa.table({"file": pa.array([], pa.string()), "row_group": pa.array([], pa.int32()), "row": pa.array([], pa.int32())})
+
+    return pa.concat_tables(matches, promote_options="default")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=OUTPUT_DESTINATION, help="Local directory or s3://bucket/prefix of the OCSF Parquet files")
+    parser.add_argument("--build", action="store_true", help="Index the observables of OCSF files that are not indexed yet")
+    parser.add_argument("--rebuild", action="store_true", help="Drop the existing index before building")
+    parser.add_argument("--lookup", action="append", default=[], help="Observable value to look up, repeat for several")
+    parser.add_argument("--lookup-file", help="File with one observable value per line, such as an IOC list")
+    parser.add_argument("--type-id", type=int, help="Only match observables of this OCSF type_id, 2 is IP Address and 6 URL String")
+    parser.add_argument("--columns", nargs="+", default=["time", "src_endpoint", "http_request", "status_code"], help="OCSF columns to return for matches")
+    args = parser.parse_args()
+
+    if args.build or args.rebuild:
+        buildObservableIndex(args.output, rebuild=args.rebuild)
+
+    values = list(args.lookup)
+    if args.lookup_file:
+        with open(args.lookup_file) as lookupFile:
+            values.extend(line.strip() for line in lookupFile if line.strip())
+    if values:
+        for record in lookupObservables(values, args.type_id, args.output, args.columns).to_pylist():
+            logger.info(json.dumps(record, default=str))
+
+# eof
@@ -1,77 +1,819 @@
 import logging
+import argparse
 from pygrok import Grok
-from os import path, remove
-from boto3 import client, resource
+from os import makedirs, path, remove, replace
+from boto3 import client
+from botocore.config import Config
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import gzip
 from gzip import open as gunzip
-from datetime import datetime
+from io import BytesIO, TextIOWrapper
+from datetime import datetime, timezone
 from urllib.parse import urlparse
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable
+from heapq import heappop, heappush
+import importlib
 import json
-import pandas as pd
+import re
+import sqlite3
+import zlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
 
 GROK = Grok(
-    '%{DATA:type}\s+%{TIMESTAMP_ISO8601:time}\s+%{DATA:elb}\s+%{DATA:client}\s+%{DATA:target}\s+%{BASE10NUM:request_processing_time}\s+%{DATA:target_processing_time}\s+%{BASE10NUM:response_processing_time}\s+%{BASE10NUM:elb_status_code}\s+%{DATA:target_status_code}\s+%{BASE10NUM:received_bytes}\s+%{BASE10NUM:sent_bytes}\s+\"%{DATA:request}\"\s+\"%{DATA:user_agent}\"\s+%{DATA:ssl_cipher}\s+%{DATA:ssl_protocol}\s+%{DATA:target_group_arn}\s+\"%{DATA:trace_id}\"\s+\"%{DATA:domain_name}\"\s+\"%{DATA:chosen_cert_arn}\"\s+%{DATA:matched_rule_priority}\s+%{TIMESTAMP_ISO8601:request_creation_time}\s+\"%{DATA:actions_executed}\"\s+\"%{DATA:redirect_url}\"\s+\"%{DATA:error_reason}\"\s+\"%{DATA:target_list}\"\s+\"%{DATA:target_status_code_list}\"\s+\"%{DATA:classification}\"\s+\"%{DATA:classification_reason}\"'
+    '%{DATA:type}\s+%{TIMESTAMP_ISO8601:time}\s+%{DATA:elb}\s+%{DATA:client}\s+%{DATA:target}\s+%{BASE10NUM:request_processing_time}\s+%{DATA:target_processing_time}\s+%{BASE10NUM:response_processing_time}\s+%{BASE10NUM:elb_status_code}\s+%{DATA:target_status_code}\s+%{BASE10NUM:received_bytes}\s+%{BASE10NUM:sent_bytes}\s+\"%{ALB_QUOTED:request}\"\s+\"%{ALB_QUOTED:user_agent}\"\s+%{DATA:ssl_cipher}\s+%{DATA:ssl_protocol}\s+%{DATA:target_group_arn}\s+\"%{ALB_QUOTED:trace_id}\"\s+\"%{ALB_QUOTED:domain_name}\"\s+\"%{ALB_QUOTED:chosen_cert_arn}\"\s+%{DATA:matched_rule_priority}\s+%{TIMESTAMP_ISO8601:request_creation_time}\s+\"%{ALB_QUOTED:actions_executed}\"\s+\"%{ALB_QUOTED:redirect_url}\"\s+\"%{ALB_QUOTED:error_reason}\"\s+\"%{ALB_QUOTED:target_list}\"\s+\"%{ALB_QUOTED:target_status_code_list}\"\s+\"%{ALB_QUOTED:classification}\"\s+\"%{ALB_QUOTED:classification_reason}\"',
+    # A quoted field runs to the next quote that is not backslash-escaped
+    custom_patterns={"ALB_QUOTED": r'(?:[^"\\]|\\.)*'}
 )
 
+# ALB access log fields in the order they are written, same names as the GROK pattern above
+ALB_FIELDS = (
+    "type", "time", "elb", "client", "target",
+    "request_processing_time", "target_processing_time", "response_processing_time",
+    "elb_status_code", "target_status_code", "received_bytes", "sent_bytes",
+    "request", "user_agent", "ssl_cipher", "ssl_protocol", "target_group_arn",
+    "trace_id", "domain_name", "chosen_cert_arn", "matched_rule_priority",
+    "request_creation_time", "actions_executed", "redirect_url", "error_reason",
+    "target_list", "target_status_code_list", "classification", "classification_reason"
+)
+ALB_FIELD_COUNT = len(ALB_FIELDS)
+
 BUCKET_NAME = ""
 PATH_NAME = ""
+# "tokenizer" uses tokenizeAlbLog, "grok" uses the original PyGrok pattern
+PARSER = "tokenizer"
+# Raise on malformed lines instead of skipping them
+STRICT_PARSING = False
+# Raw field filters such as "elb_status_code!~^2", only matching lines are mapped to OCSF (see albFilterPredicate)
+FILTERS = ()
+# Decompress S3 objects as they are read instead of staging them in /tmp
+STREAM_FROM_S3 = True
+# Gzip implementation: "auto" takes the fastest one installed (isal, then zlib_ng, then the stdlib), see GZIP_BACKEND_PREFERENCE
+GZIP_BACKEND = "auto"
+# Threads inflating the members of a multi-member gzip object in parallel, 1 always inflates sequentially
+DECOMPRESS_THREADS = 4
+# Number of S3 objects fetched and parsed at the same time
+CONCURRENCY = 16
+# Worker processes converting shards of S3 objects in parallel, each with CONCURRENCY threads of its own
+WORKERS = 1
+# Maximum rows per Arrow record batch produced by HttpActivityBatchBuilder
+RECORD_BATCH_SIZE = 50_000
+# Local directory or s3://bucket/prefix the OCSF Parquet files are written under
+OUTPUT_DESTINATION = "./awsalb_ocsf_http_activity"
+# Write Hive-style account=/region=/event_date=/event_hour= partitions instead of a flat set of files
+PARTITION_OUTPUT = True
+# Partitions with an open file at once, the least recently written partition is closed past this
+MAX_OPEN_PARTITIONS = 64
+# Rows buffered across all open partitions, past this the partition buffering the most is flushed as a smaller row group
+MAX_BUFFERED_ROWS = 1_000_000
+# Rows per Parquet row group, each writer buffers at most this many rows before flushing them to disk
+ROW_GROUP_SIZE = 100_000
+# Roll over to a new output file once either limit is reached
+MAX_FILE_RECORDS = 5_000_000
+MAX_FILE_BYTES = 512 * 1024 * 1024
+# Entries kept by each LRU cache of per-record derivations (target group ARN split, ELB ARN, URL parsing)
+DERIVATION_CACHE_SIZE = 4096
+# Output profiles: full keeps everything, lean drops raw_data, analytics also drops observables and flattens structs
+OUTPUT_PROFILES = {
+    "full": {"exclude": (), "flatten": False},
+    "lean": {"exclude": ("raw_data",), "flatten": False},
+    "analytics": {"exclude": ("raw_data", "observables"), "flatten": True}
+}
+OUTPUT_PROFILE = "full"
+# Write time/start_time as the legacy "YYYY-MM-DD HH:MM:SS.000" strings instead of timestamp[ms] columns
+LEGACY_TIMESTAMPS = False
+# SQLite database recording converted objects, set it (or --state-db) to skip objects converted by earlier runs
+STATE_DB_PATH = None
+# Objects converted between checkpoints of the state database
+CHECKPOINT_INTERVAL = 100
+S3_RETRY_CONFIG = {
+    "max_attempts": 15,
+    "mode": "adaptive"
+}
+
+class MalformedAlbLogError(ValueError):
+    """Raised in strict mode when a line is not a valid ALB access log"""
+
+def joinEscapedQuotes(segments: list[str]) -> list[str]:
+    """
+    Rejoins quote-split segments where a quoted field contains a backslash-escaped quote, such as a user agent
+    with \\" in it. The escape is kept as written, the same as the GROK pattern keeps it
+    """
+    joined = [segments[0]]
+    for segment in segments[1:]:
+        previous = joined[-1]
+        # Inside a quoted field a quote after an odd run of backslashes is escaped, an even run escapes itself
+        if len(joined) % 2 == 0 and (len(previous) - len(previous.rstrip("\\"))) % 2:
+            joined[-1] = f'{previous}"{segment}'
+        else:
+            joined.append(segment)
+
+    return joined
+
+def tokenizeAlbLog(rawlog: str, strict: bool = STRICT_PARSING) -> dict | None:
+    """
+    Splits an ALB access log line on whitespace while keeping double-quoted fields, and any \\" escaped inside them,
+    intact in a single pass.
+    Returns the same field dictionary as GROK.match(), malformed lines raise in strict mode and return None otherwise
+    """
+    # Splitting on the quote character alternates unquoted and quoted segments: even indexes hold space
+    # delimited fields, odd indexes hold the contents of a quoted field
+    segments = rawlog.rstrip("\r\n").split('"')
+    if '\\"' in rawlog:
+        segments = joinEscapedQuotes(segments)
+    if len(segments) % 2 == 0:
+        if strict:
+            raise MalformedAlbLogError(f"Unterminated quoted field in ALB log: {rawlog!r}")
+        return None
+
+    fields = []
+    for index, segment in enumerate(segments):
+        if index % 2:
+            fields.append(segment)
+        else:
+            fields.extend(segment.split())
+
+    # AWS appends new fields to the end of the log format over time, anything past the known fields is ignored
+    if len(fields) < ALB_FIELD_COUNT:
+        if strict:
+            raise MalformedAlbLogError(
+                f"Expected at least {ALB_FIELD_COUNT} ALB log fields, found {len(fields)}: {rawlog!r}"
+            )
+        return None
+
+    return dict(zip(ALB_FIELDS, fields))
+
+def parseAlbLog(rawlog: str, parser: str = PARSER, strict: bool = STRICT_PARSING) -> dict | None:
+    """Returns the raw ALB field dictionary using either the tokenizer or the PyGrok pattern"""
+    if parser == "grok":
+        return GROK.match(rawlog)
+
+    return tokenizeAlbLog(rawlog, strict=strict)
+
+# ALB fields compared as numbers by the <, <=, > and >= filter operators, everything else compares as strings
+ALB_NUMERIC_FIELDS = {
+    "request_processing_time", "target_processing_time", "response_processing_time",
+    "elb_status_code", "target_status_code", "received_bytes", "sent_bytes", "matched_rule_priority"
+}
+ALB_FILTER_EXPRESSION = re.compile(r"^\s*(\w+)\s*(!=|!~|>=|<=|=|~|>|<)\s*(.*?)\s*$")
+
+def albFilterPredicate(expression: str):
+    """
+    Compiles one "field OP value" filter on a raw ALB field. OP is =, !=, ~ (regex search), !~, <, <=, > or >=,
+    for example elb_status_code!~^2, time>=2024-12-01T09:00:00 or request~\\?
+    """
+    match = ALB_FILTER_EXPRESSION.match(expression)
+    if not match or match.group(1) not in ALB_FIELDS:
+        raise ValueError(f"Invalid ALB filter {expression!r}, expected <ALB field><operator><value>")
+    field, operator, value = match.groups()
+
+    if operator in ("~", "!~"):
+        pattern = re.compile(value)
+        negate = operator == "!~"
+        return lambda preProcessedLog: (pattern.search(preProcessedLog[field] or "") is None) == negate
+
+    if operator == "=":
+        return lambda preProcessedLog: preProcessedLog[field] == value
+    if operator == "!=":
+        return lambda preProcessedLog: preProcessedLog[field] != value
+
+    compare = {
+        "<": lambda left, right: left < right,
+        "<=": lambda left, right: left <= right,
+        ">": lambda left, right: left > right,
+        ">=": lambda left, right: left >= right
+    }[operator]
+    if field in ALB_NUMERIC_FIELDS:
+        number = float(value)
+
+        def numericPredicate(preProcessedLog: dict) -> bool:
+            try:
+                return compare(float(preProcessedLog[field]), number)
+            except (TypeError, ValueError):
+                # "-" and other non-numeric values never match a numeric comparison
+                return False
+
+        return numericPredicate
+
+    # ISO-8601 timestamps compare correctly as strings
+    return lambda preProcessedLog: preProcessedLog[field] is not None and compare(preProcessedLog[field], value)
+
+@lru_cache(maxsize=32)
+def compileAlbFilter(expressions: tuple[str, ...]):
+    """
+    Combines filter expressions into one predicate over the raw ALB field dictionary, every expression must match.
+    Returns None when there is nothing to filter
+    """
+    if not expressions:
+        return None
+    predicates = [albFilterPredicate(expression) for expression in expressions]
+
+    return lambda preProcessedLog: all(predicate(preProcessedLog) for predicate in predicates)
+
+def checkParserParity(rawlogs) -> list[dict]:
+    """
+    Runs every line through both the tokenizer and the PyGrok pattern and returns the lines where they disagree
+    """
+    mismatches = []
+    for lineNumber, rawlog in enumerate(rawlogs, start=1):
+        grokParsed = GROK.match(rawlog)
+        tokenized = tokenizeAlbLog(rawlog, strict=False)
+        if grokParsed != tokenized:
+            mismatches.append(
+                {
+                    "line": lineNumber,
+                    "grok": grokParsed,
+                    "tokenizer": tokenized
+                }
+            )
+
+    return mismatches
+
+# Optional drop-in replacements for the gzip module, fastest first: python-isal wraps Intel ISA-L and zlib-ng
+# inflates with SIMD, both expose the same open/GzipFile/decompress API as the stdlib
+GZIP_BACKEND_PREFERENCE = (
+    ("isal", "isal.igzip"),
+    ("zlib_ng", "zlib_ng.gzip_ng"),
+    ("stdlib", "gzip")
+)
+
+def availableGzipBackends() -> dict:
+    """Gzip modules that import in this environment, in GZIP_BACKEND_PREFERENCE order"""
+    backends = {}
+    for name, moduleName in GZIP_BACKEND_PREFERENCE:
+        try:
+            backends[name] = importlib.import_module(moduleName)
+        except ImportError:
+            continue
+
+    return backends
+
+GZIP_BACKENDS = availableGzipBackends()
+
+def gzipBackend(name: str = GZIP_BACKEND):
+    """Returns the gzip module for a backend name, "auto" picks the first available one"""
+    if name == "auto":
+        return next(iter(GZIP_BACKENDS.values()))
+    if name not in GZIP_BACKENDS:
+        raise ValueError(f"Gzip backend {name} is not installed, available backends are {list(GZIP_BACKENDS)}")
+
+    return GZIP_BACKENDS[name]
+
+def gzipMemberOffsets(data: bytes) -> list[int]:
+    """
+    Offsets of what look like gzip member headers: the magic bytes, deflate, no reserved flags and a known XFL.
+    Compressed data can still contain a lookalike, decompressGzip verifies every member and falls back if one fails
+    """
+    offsets = []
+    offset = data.find(b"\x1f\x8b\x08")
+    while offset != -1:
+        if len(data) >= offset + 10 and not data[offset + 3] & 0xE0 and data[offset + 8] in (0, 2, 4):
+            offsets.append(offset)
+        offset = data.find(b"\x1f\x8b\x08", offset + 1)
+
+    return offsets
+
+def decompressGzip(data: bytes, backend: str = GZIP_BACKEND, threads: int = DECOMPRESS_THREADS) -> bytes:
+    """
+    Decompresses a whole gzip buffer. Multi-member files (concatenated gzip, as written by parallel compressors and
+    appending writers) are inflated one member per thread, the backends release the GIL while inflating
+    """
+    gzipModule = gzipBackend(backend)
+    offsets = gzipMemberOffsets(data) if threads > 1 else []
+    if len(offsets) < 2 or offsets[0] != 0:
+        return gzipModule.decompress(data)
+
+    members = [memoryview(data)[start:end] for start, end in zip(offsets, offsets[1:] + [len(data)])]
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return b"".join(executor.map(gzipModule.decompress, members))
+    except (EOFError, OSError, zlib.error):
+        # A header lookalike inside compressed data split a member in two, inflate the buffer in one go instead
+        return gzipModule.decompress(data)
+
+def streamS3LogLines(s3Client, bucket: str, key: str):
+    """
+    Decompresses the S3 object body incrementally and yields log lines without writing anything to disk
+    """
+    body = s3Client.get_object(Bucket=bucket, Key=key)["Body"]
+    try:
+        with gzipBackend().GzipFile(fileobj=body, mode="rb") as gz:
+            with TextIOWrapper(gz, encoding="utf-8") as logs:
+                yield from logs
+    finally:
+        body.close()
+
+def downloadS3LogLines(s3Client, bucket: str, key: str):
+    """
+    Stages the S3 object in /tmp, yields its decompressed log lines and removes the file afterwards
+    """
+    filename = key.replace("/", "_")
+
+    # Download each file
+    s3Client.download_file(bucket, key, f"/tmp/{filename}")
+    try:
+        # Uncompress and process the logs, a staged object can be inflated in parallel when it has several members
+        with open(f"/tmp/{filename}", "rb") as compressed:
+            decompressed = decompressGzip(compressed.read())
+        yield from TextIOWrapper(BytesIO(decompressed), encoding="utf-8")
+    finally:
+        # Clean up the downloaded file
+        if path.exists(f"/tmp/{filename}"):
+            remove(f"/tmp/{filename}")
+
+def listLogObjects(s3Client, bucket: str, prefix: str):
+    """
+    Yields every object under the prefix, following list_objects_v2 pagination past the first 1,000 keys
+    """
+    paginator = s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+def processLogObject(s3Client, bucket: str, key: str, parser: str = PARSER, strict: bool = STRICT_PARSING, stream: bool = STREAM_FROM_S3, batchSize: int = RECORD_BATCH_SIZE, legacyTimestamps: bool = LEGACY_TIMESTAMPS, filters: tuple[str, ...] = FILTERS, profile: str = OUTPUT_PROFILE) -> list[pa.RecordBatch]:
+    """
+    Reads a single ALB log object from S3 and returns its OCSF records as Arrow record batches.
+    Filters are evaluated on the raw fields right after parsing, rejected lines are never mapped to OCSF
+    """
+    batches: list[pa.RecordBatch] = []
+    albFilter = compileAlbFilter(tuple(filters))
+    builder = HttpActivityBatchBuilder(legacyTimestamps=legacyTimestamps, profile=profile)
+    readLogLines = streamS3LogLines if stream else downloadS3LogLines
+
+    for rawlog in readLogLines(s3Client, bucket, key):
+        preProcessedLog = parseAlbLog(rawlog, parser=parser, strict=strict)
+        if albFilter is not None and (preProcessedLog is None or not albFilter(preProcessedLog)):
+            continue
+        try:
+            builder.append(rawlog, preProcessedLog)
+        except ValueError:
+            # The tokenizer does not type check numeric fields the way the GROK pattern does
+            if strict:
+                raise
+        if len(builder) >= batchSize:
+            batches.append(builder.flush())
+
+    if len(builder):
+        batches.append(builder.flush())
+
+    if builder.skippedRows:
+        if strict:
+            raise MalformedAlbLogError(f"{builder.skippedRows} lines of {key} have a time that does not parse")
+        logger.warning(f"Skipped {builder.skippedRows} lines of {key} whose time does not parse.")
+
+    return batches
+
+def processLogObjects(s3Client, bucket: str, objects, concurrency: int = CONCURRENCY, failures: list[dict] | None = None, **processOptions):
+    """
+    Fetches and parses objects on a bounded thread pool so parsing overlaps the network wait of other GETs.
+    Yields (key, OCSF records) as each object completes, at most 2x concurrency objects are in flight at once.
+    When a failures list is given, objects that raise are recorded there and skipped instead of aborting the run
+    """
+    def completed(futures):
+        for future in futures:
+            key = inFlight.pop(future)
+            try:
+                yield key, future.result()
+            except Exception as err:
+                if failures is None:
+                    raise
+                logger.error(f"Failed to process {key}: {err}")
+                failures.append({"key": key, "error": repr(err)})
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        inFlight = {}
+        for obj in objects:
+            if len(inFlight) >= concurrency * 2:
+                done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                yield from completed(done)
+
+            future = executor.submit(processLogObject, s3Client, bucket, obj["Key"], **processOptions)
+            inFlight[future] = obj["Key"]
 
-def openLogFile(bucket: str, prefix: str):
+        yield from completed(list(as_completed(inFlight)))
+
+class IngestionStateStore:
     """
-    Downloads and parses all log files stored in S3 under a given prefix
+    SQLite record of the S3 objects already converted, keyed by bucket, key, ETag and conversion settings, along with
+    the run and the Parquet files their records went into. A re-uploaded object gets a new ETag and is converted again,
+    and so is an object converted with other settings (see conversionSpec)
     """
-    ocsfLogs: list[dict] = []
-    s3 = resource("s3")
-    s3Client = client("s3")
+    def __init__(self, dbPath: str = STATE_DB_PATH, conversion: str = ""):
+        self.dbPath = dbPath
+        self.conversion = conversion
+        # Worker processes share the database, wait on their locks instead of failing
+        self._connection = sqlite3.connect(dbPath, timeout=60)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS processed_objects (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                conversion TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                records INTEGER NOT NULL,
+                files TEXT NOT NULL,
+                processed_at TEXT NOT NULL,
+                PRIMARY KEY (bucket, key, etag, conversion)
+            )
+            """
+        )
+        # Files opened since the last checkpoint of their run, the records they hold are not committed yet
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_files (
+                file TEXT NOT NULL PRIMARY KEY,
+                run_id TEXT NOT NULL
+            )
+            """
+        )
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def isProcessed(self, bucket: str, key: str, etag: str) -> bool:
+        cursor = self._connection.execute(
+            "SELECT 1 FROM processed_objects WHERE bucket = ? AND key = ? AND etag = ? AND conversion = ?",
+            (bucket, key, etag, self.conversion)
+        )
+        return cursor.fetchone() is not None
+
+    def filterUnprocessed(self, bucket: str, objects, skipped: list[str] | None = None):
+        """Yields only the listed objects that have not been converted yet, skipped keys are appended to skipped"""
+        for obj in objects:
+            if self.isProcessed(bucket, obj["Key"], obj.get("ETag", "")):
+                if skipped is not None:
+                    skipped.append(obj["Key"])
+                continue
+            yield obj
+
+    def markProcessed(self, bucket: str, objects: list[tuple[str, str, int]], files: list[str], runId: str):
+        """Records (key, ETag, record count) entries as converted into the given files, which stop being pending, in one transaction"""
+        processedAt = datetime.now(timezone.utc).isoformat()
+        filesJson = json.dumps(files)
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO processed_objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (bucket, key, etag or "", self.conversion, runId, records, filesJson, processedAt)
+                    for key, etag, records in objects
+                ]
+            )
+            self._connection.executemany("DELETE FROM pending_files WHERE file = ?", [(filename,) for filename in files])
+
+    def addPendingFile(self, filename: str, runId: str):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO pending_files VALUES (?, ?)", (filename, runId))
+
+    def pendingFiles(self, excludeRunId: str | None = None) -> list[str]:
+        """Files left pending by runs other than excludeRunId, a run that crashed never committed their records"""
+        cursor = self._connection.execute("SELECT file FROM pending_files WHERE run_id != ?", (excludeRunId or "",))
+        return [filename for filename, in cursor.fetchall()]
+
+    def dropPendingFiles(self, files: list[str]):
+        with self._connection:
+            self._connection.executemany("DELETE FROM pending_files WHERE file = ?", [(filename,) for filename in files])
+
+def conversionSpec(filters: tuple[str, ...] = FILTERS, profile: str = OUTPUT_PROFILE) -> str:
+    """
+    Canonical form of the settings that decide which records and columns an object is converted into, part of the state
+    key so a filtered or lean run never marks objects as converted for a later run with other filters or profile
+    """
+    return json.dumps({"filters": sorted(filters), "profile": profile}, sort_keys=True)
+
+def createS3Client(concurrency: int = CONCURRENCY):
+    """
+    boto3 clients are thread safe, size the connection pool so every worker thread gets a pooled connection
+    """
+    return client("s3", config=Config(max_pool_connections=concurrency, retries=S3_RETRY_CONFIG))
+
+def createOcsfWriter(
+    outputDestination: str = OUTPUT_DESTINATION,
+    partitionOutput: bool = PARTITION_OUTPUT,
+    maxOpenPartitions: int = MAX_OPEN_PARTITIONS,
+    maxBufferedRows: int = MAX_BUFFERED_ROWS,
+    legacyTimestamps: bool = LEGACY_TIMESTAMPS,
+    profile: str = OUTPUT_PROFILE,
+    filePrefix: str = "part",
+    **writerOptions
+):
+    """
+    Returns a PartitionedParquetWriter, or a flat RollingParquetWriter when partitioning is disabled
+    """
+    writerOptions["schema"] = ocsfHttpActivitySchema(legacyTimestamps, profile)
+    if partitionOutput:
+        return PartitionedParquetWriter(
+            destination=outputDestination,
+            filePrefix=filePrefix,
+            maxOpenPartitions=maxOpenPartitions,
+            maxBufferedRows=maxBufferedRows,
+            **writerOptions
+        )
+
+    filesystem, basePath = resolveOutputDestination(outputDestination)
+    return RollingParquetWriter(outputPrefix=f"{basePath}/{filePrefix}", filesystem=filesystem, **writerOptions)
+
+def processLogShard(
+    shardId: int,
+    bucket: str,
+    objects,
+    concurrency: int,
+    processOptions: dict,
+    outputOptions: dict,
+    s3Client=None,
+    statePath: str | None = None,
+    runId: str | None = None,
+    checkpointInterval: int = CHECKPOINT_INTERVAL,
+    conversion: str = ""
+) -> dict:
+    """
+    Converts a shard of S3 objects into its own set of Parquet files (part-{shardId}-NNNNN) and returns its stats,
+    this runs in a worker process so it creates its own S3 client unless one is passed in.
+    With a state store, open files are closed every checkpointInterval objects and those objects are recorded as
+    converted, so a crashed run resumes from its last checkpoint. Every file is recorded as pending when it is opened
+    and committed at the next checkpoint, the next run deletes the files a crash left pending
+    """
+    s3Client = s3Client or createS3Client(concurrency)
+    stateStore = IngestionStateStore(statePath, conversion) if statePath else None
+    failures: list[dict] = []
+    totalObjects = 0
+    etags: dict[str, str] = {}
+    uncommitted: list[tuple[str, str, int]] = []
+    committedFiles: set[str] = set()
+
+    def trackEtags(objects):
+        for obj in objects:
+            etags[obj["Key"]] = obj.get("ETag", "")
+            yield obj
+
+    def recordPendingFile(filename: str):
+        stateStore.addPendingFile(filename, runId)
+
+    def checkpoint():
+        # Objects only count as converted once every file holding their records is closed
+        writer.close()
+        newFiles = [filename for filename in writer.files if filename not in committedFiles]
+        stateStore.markProcessed(bucket, uncommitted, newFiles, runId)
+        committedFiles.update(newFiles)
+        uncommitted.clear()
+
+    # Each run gets its own file names so reruns never overwrite files recorded by an earlier run
+    filePrefix = f"part-{runId}-{shardId:03}" if runId else f"part-{shardId:03}"
+
+    with createOcsfWriter(filePrefix=filePrefix, onFileOpen=recordPendingFile if stateStore else None, **outputOptions) as writer:
+        for key, processed in processLogObjects(
+            s3Client,
+            bucket,
+            trackEtags(objects),
+            concurrency=concurrency,
+            # Strict runs abort on the first object that fails instead of recording it
+            failures=None if processOptions.get("strict") else failures,
+            **processOptions
+        ):
+            for batch in processed:
+                writer.write(batch)
+            totalObjects += 1
+            records = sum(batch.num_rows for batch in processed)
+            logger.debug(f"Processed {records} records from {key}")
+
+            if stateStore:
+                uncommitted.append((key, etags.pop(key), records))
+                if len(uncommitted) >= checkpointInterval:
+                    checkpoint()
+
+    if stateStore:
+        if uncommitted:
+            checkpoint()
+        stateStore.close()
+
+    return {
+        "shard": shardId,
+        "objects": totalObjects,
+        "records": writer.totalRecords,
+        "files": writer.files,
+        "failed": failures,
+        "cache_stats": derivationCacheStats()
+    }
+
+def assignShards(objects: list[dict], workers: int) -> list[list[dict]]:
+    """
+    Spreads objects across workers by size, largest first onto the least loaded worker, so shards finish together
+    """
+    shards = [[] for _ in range(workers)]
+    load = [(0, shardId) for shardId in range(workers)]
+    for obj in sorted(objects, key=lambda obj: obj.get("Size", 0), reverse=True):
+        shardBytes, shardId = heappop(load)
+        shards[shardId].append({"Key": obj["Key"], "ETag": obj.get("ETag", "")})
+        heappush(load, (shardBytes + obj.get("Size", 0), shardId))
+
+    return [shard for shard in shards if shard]
+
+def removeUncommittedFiles(stateStore: IngestionStateStore, outputDestination: str, runId: str) -> list[str]:
+    """
+    Deletes the files earlier runs left pending: rolled over or evicted files, and in progress ones, holding records
+    of objects that were never recorded as converted and that this run converts again
+    """
+    filesystem, _ = resolveOutputDestination(outputDestination)
+    pendingFiles = stateStore.pendingFiles(excludeRunId=runId)
+    for filename in pendingFiles:
+        if filesystem is None:
+            for leftover in (filename, f"{filename}.inprogress"):
+                if path.exists(leftover):
+                    remove(leftover)
+        elif filesystem.get_file_info(filename).type == fs.FileType.File:
+            filesystem.delete_file(filename)
+    stateStore.dropPendingFiles(pendingFiles)
+    if pendingFiles:
+        logger.warning(f"Removed {len(pendingFiles)} uncommitted files left behind by an interrupted run.")
+
+    return pendingFiles
+
+def writeManifest(outputDestination: str, manifest: dict) -> str:
+    """Writes the run manifest as _manifest.json (_manifest-{run_id}.json for incremental runs) next to the Parquet output"""
+    filesystem, basePath = resolveOutputDestination(outputDestination)
+    manifestName = f"_manifest-{manifest['run_id']}.json" if manifest.get("run_id") else "_manifest.json"
+    manifestPath = f"{basePath}/{manifestName}"
+    manifestBytes = json.dumps(manifest, indent=2, default=str).encode("utf-8")
+
+    if filesystem is None:
+        makedirs(basePath, exist_ok=True)
+        with open(manifestPath, "wb") as manifestFile:
+            manifestFile.write(manifestBytes)
+    else:
+        with filesystem.open_output_stream(manifestPath) as manifestFile:
+            manifestFile.write(manifestBytes)
+
+    return manifestPath
+
+def openLogFile(
+    bucket: str,
+    prefix: str,
+    parser: str = PARSER,
+    strict: bool = STRICT_PARSING,
+    stream: bool = STREAM_FROM_S3,
+    concurrency: int = CONCURRENCY,
+    workers: int = WORKERS,
+    filters: tuple[str, ...] = FILTERS,
+    legacyTimestamps: bool = LEGACY_TIMESTAMPS,
+    profile: str = OUTPUT_PROFILE,
+    outputDestination: str = OUTPUT_DESTINATION,
+    partitionOutput: bool = PARTITION_OUTPUT,
+    maxOpenPartitions: int = MAX_OPEN_PARTITIONS,
+    maxBufferedRows: int = MAX_BUFFERED_ROWS,
+    rowGroupSize: int = ROW_GROUP_SIZE,
+    maxFileRecords: int = MAX_FILE_RECORDS,
+    maxFileBytes: int = MAX_FILE_BYTES,
+    statePath: str | None = STATE_DB_PATH,
+    checkpointInterval: int = CHECKPOINT_INTERVAL
+) -> dict | None:
+    """
+    Streams (or downloads) and parses all log files stored in S3 under a given prefix, writing OCSF Parquet as it goes.
+    With more than one worker the objects are split into shards converted by separate processes, either way a
+    manifest of the shards, their files and any failed objects is written and returned.
+    With a state database, objects already converted (same key, ETag, filters and profile) by an earlier run are skipped.
+    In strict mode the first object that fails aborts the run
+    """
+    s3Client = createS3Client(concurrency)
+    runId = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ") if statePath else None
+    skipped: list[str] = []
+    stateOptions = {
+        "statePath": statePath,
+        "runId": runId,
+        "checkpointInterval": checkpointInterval,
+        "conversion": conversionSpec(tuple(filters), profile)
+    }
+    processOptions = {
+        "parser": parser,
+        "strict": strict,
+        "stream": stream,
+        "legacyTimestamps": legacyTimestamps,
+        "filters": tuple(filters),
+        "profile": profile
+    }
+    # Fail fast on invalid filters instead of inside every worker
+    compileAlbFilter(tuple(filters))
+    outputOptions = {
+        "outputDestination": outputDestination,
+        "partitionOutput": partitionOutput,
+        "maxOpenPartitions": maxOpenPartitions,
+        "maxBufferedRows": maxBufferedRows,
+        "legacyTimestamps": legacyTimestamps,
+        "profile": profile,
+        "rowGroupSize": rowGroupSize,
+        "maxFileRecords": maxFileRecords,
+        "maxFileBytes": maxFileBytes
+    }
 
     # List all objects under the given prefix (S3 path)
-    objects = s3Client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    objects = listLogObjects(s3Client, bucket, prefix)
+    if statePath:
+        stateStore = IngestionStateStore(statePath, stateOptions["conversion"])
+        removeUncommittedFiles(stateStore, outputDestination, runId)
+        objects = stateStore.filterUnprocessed(bucket, objects, skipped=skipped)
+
+    if workers > 1:
+        shards = assignShards(list(objects), workers)
+        shardResults = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(processLogShard, shardId, bucket, shard, concurrency, processOptions, outputOptions, **stateOptions): (shardId, shard)
+                for shardId, shard in enumerate(shards)
+            }
+            for future in as_completed(futures):
+                shardId, shard = futures[future]
+                try:
+                    shardResults.append(future.result())
+                except Exception as err:
+                    # The worker died (for example out of memory), report every object of the shard as failed
+                    logger.error(f"Shard {shardId} failed: {err}")
+                    shardResults.append(
+                        {
+                            "shard": shardId,
+                            "objects": 0,
+                            "records": 0,
+                            "files": [],
+                            "failed": [{"key": obj["Key"], "error": repr(err)} for obj in shard]
+                        }
+                    )
+        shardResults.sort(key=lambda shardResult: shardResult["shard"])
+    else:
+        # A single shard fetches objects concurrently as the listing pages arrive
+        shardResults = [
+            processLogShard(0, bucket, objects, concurrency, processOptions, outputOptions, s3Client=s3Client, **stateOptions)
+        ]
+
+    if statePath:
+        stateStore.close()
 
-    logger.info(f"Processing {len(objects)} Objects.")
+    totalObjects = sum(shardResult["objects"] for shardResult in shardResults)
+    failedObjects = [failure for shardResult in shardResults for failure in shardResult["failed"]]
+    logger.info(f"Processed {totalObjects} Objects.")
+    if skipped:
+        logger.info(f"Skipped {len(skipped)} Objects already converted by an earlier run.")
 
-    if 'Contents' not in objects:
-        print(f"No files found in {bucket}/{prefix}")
+    if not totalObjects and not failedObjects:
+        if not skipped:
+            print(f"No files found in {bucket}/{prefix}")
         return
 
-    # Iterate over all objects in the prefix
-    for obj in objects['Contents']:
-        key = obj['Key']
-        filename = key.replace("/", "_")
-        
-        # Download each file
-        s3.meta.client.download_file(bucket, key, f"/tmp/{filename}")
-        try:
-            # Uncompress and process the logs
-            with gunzip(f"/tmp/{filename}", mode="rt") as logs:
-                for rawlog in logs:
-                    processed = grokProcessLogs(rawlog)
-                    if processed:
-                        ocsfLogs.append(grokProcessLogs(rawlog))
-        finally:
-            # Clean up the downloaded file
-            if path.exists(f"/tmp/{filename}"):
-                remove(f"/tmp/{filename}")
+    manifest = {
+        "bucket": bucket,
+        "prefix": prefix,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "run_id": runId,
+        "objects": totalObjects,
+        "skipped": len(skipped),
+        "records": sum(shardResult["records"] for shardResult in shardResults),
+        "files": sum(len(shardResult["files"]) for shardResult in shardResults),
+        "failed": failedObjects,
+        "shards": shardResults
+    }
+    manifestPath = writeManifest(outputDestination, manifest)
 
-    df = pd.DataFrame(ocsfLogs)
+    logger.info(f"Wrote {manifest['records']} OCSF records across {manifest['files']} Parquet files, manifest at {manifestPath}.")
+    if failedObjects:
+        logger.warning(f"{len(failedObjects)} objects failed to process, see the manifest for details.")
+        if strict:
+            # A strict shard stops at its first failure, the worker process reports it here
+            raise RuntimeError(f"{len(failedObjects)} objects failed to process in strict mode, see {manifestPath}")
 
-    print(df.head(n=10))
+    return manifest
 
-    df.to_parquet("./awsalb_ocsf_http_activity.parquet.zstd",compression="zstd")
+def processAlbLog(rawlog: str, parser: str = PARSER, strict: bool = STRICT_PARSING) -> dict | None:
+    """
+    Parses a single ALB access log line and converts it into OCSF HTTP Activity
+    """
+    preProcessedLog = parseAlbLog(rawlog, parser=parser, strict=strict)
+    try:
+        return mapPreProcessedLog(rawlog, preProcessedLog)
+    except ValueError:
+        # The tokenizer does not type check numeric fields the way the GROK pattern does
+        if strict:
+            raise
+        return None
 
 def grokProcessLogs(rawlog: str) -> dict | None:
     """
     Uses PyGrok to transform ALB access log pattern into Python dictionary and further OCSF conversion
     """
-    preProcessedLog = GROK.match(rawlog)
+    return mapPreProcessedLog(rawlog, GROK.match(rawlog))
+
+def mapPreProcessedLog(rawlog: str, preProcessedLog: dict | None) -> dict | None:
+    """
+    Converts the raw ALB field dictionary into OCSF, logs without a target group are skipped
+    """
     # ALB access log docs don't account for this, but if the TG ARN is empty it is likely a log delivery error and should be ignored
     try:
         if preProcessedLog["target_group_arn"] is not None and preProcessedLog["target_group_arn"] != "-":
             try:
-                tgSplitter = preProcessedLog["target_group_arn"].split(":")
-                preProcessedLog["region"] = tgSplitter[3]
-                preProcessedLog["account"] = str(tgSplitter[4])
+                preProcessedLog["region"], preProcessedLog["account"] = targetGroupCloudContext(preProcessedLog["target_group_arn"])
 
                 baseEventMapping = httpActivityBaseEventMapping(preProcessedLog["request"].split(" ")[0])
                 dstEndpoint = elbTargetProcessor(preProcessedLog["target"])
@@ -108,9 +850,26 @@ def elbTargetProcessor(target: str) -> dict[str | None]:
 
     return dstEndpoint
 
+@lru_cache(maxsize=DERIVATION_CACHE_SIZE)
+def targetGroupCloudContext(targetGroupArn: str) -> tuple[str, str]:
+    """
+    Returns the region and account of a target group ARN, raises IndexError for malformed ARNs
+    """
+    tgSplitter = targetGroupArn.split(":")
+    return tgSplitter[3], str(tgSplitter[4])
+
+@lru_cache(maxsize=DERIVATION_CACHE_SIZE)
+def elbArnBuilder(elbId: str, awsRegion: str, awsAccount: str) -> str:
+    """
+    Create an ARN for the ELB, only a portion is in the raw log
+    """
+    return f"arn:aws:elasticloadbalancing:{awsRegion}:{awsAccount}:loadbalancer/{elbId}"
+
+@lru_cache(maxsize=DERIVATION_CACHE_SIZE)
 def processUrlObject(urlString: str) -> dict[str | int | None]:
     """
-    Uses urllib.parse to process the URL string contained within the Request portion of the ALB log
+    Uses urllib.parse to process the URL string contained within the Request portion of the ALB log.
+    Results are cached and shared between records, treat the returned dictionary as read-only
     """
 
     p = urlparse(urlString)
@@ -128,76 +887,52 @@ def processUrlObject(urlString: str) -> dict[str | int | None]:
         "scheme": p.scheme or None
     }
 
+def httpActivityBaseEvent(activityId: int, activityName: str) -> dict[str | int]:
+    """Builds the Base Event attributes for an HTTP Activity activity"""
+    return {
+        "ActivityId": activityId,
+        "ActivityName": activityName,
+        "TypeUid": 400200 + activityId,
+        "TypeName": f"HTTP Activity: {activityName}"
+    }
+
+# Precomputed Base Event attributes per HTTP method, anything else maps to Other
+HTTP_ACTIVITY_BASE_EVENTS = {
+    "CONNECT": httpActivityBaseEvent(1, "Connect"),
+    "DELETE": httpActivityBaseEvent(2, "Delete"),
+    "GET": httpActivityBaseEvent(3, "Get"),
+    "HEAD": httpActivityBaseEvent(4, "Head"),
+    "OPTIONS": httpActivityBaseEvent(5, "Options"),
+    "POST": httpActivityBaseEvent(6, "Post"),
+    "PUT": httpActivityBaseEvent(7, "Put"),
+    "TRACE": httpActivityBaseEvent(8, "Trace")
+}
+HTTP_ACTIVITY_OTHER_EVENT = httpActivityBaseEvent(99, "Other")
+
 def httpActivityBaseEventMapping(httpMethod: str) -> dict[str | int]:
     """
     For events that match HTTP Activity Event - map Base Event attributes such as class_name and type_uid and so forth
     """
-    if httpMethod == "CONNECT":
-        activityId = 1
-        activityName = "Connect"
-        typeUid = 400201
-        typeName = "HTTP Activity: Connect"
-    elif httpMethod == "DELETE":
-        activityId = 2
-        activityName = "Delete"
-        typeUid = 400202
-        typeName = "HTTP Activity: Delete"
-    elif httpMethod == "GET":
-        activityId = 3
-        activityName = "Get"
-        typeUid = 400203
-        typeName = "HTTP Activity: Get"
-    elif httpMethod == "HEAD":
-        activityId = 4
-        activityName = "Head"
-        typeUid = 400204
-        typeName = "HTTP Activity: Head"
-    elif httpMethod == "OPTIONS":
-        activityId = 5
-        activityName = "Options"
-        typeUid = 400205
-        typeName = "HTTP Activity: Options"
-    elif httpMethod == "POST":
-        activityId = 6
-        activityName = "Post"
-        typeUid = 400206
-        typeName = "HTTP Activity: Post"
-    elif httpMethod == "PUT":
-        activityId = 7
-        activityName = "Put"
-        typeUid = 400207
-        typeName = "HTTP Activity: Put"
-    elif httpMethod == "TRACE":
-        activityId = 8
-        activityName = "Trace"
-        typeUid = 400208
-        typeName = "HTTP Activity: Trace"
-    else:
-        activityId = 99
-        activityName = "Other"
-        typeUid = 400299
-        typeName = "HTTP Activity: Other"
+    return HTTP_ACTIVITY_BASE_EVENTS.get(httpMethod, HTTP_ACTIVITY_OTHER_EVENT)
 
-    return {
-        "ActivityId": activityId,
-        "ActivityName": activityName,
-        "TypeUid": typeUid,
-        "TypeName": typeName
-    }
+# Precomputed normalized status by the first digit of the status code, 1xx-3xx are successes and everything else fails
+OCSF_STATUS_SUCCESS = {
+    "Status": "Success",
+    "StatusId": 1
+}
+OCSF_STATUS_FAILURE = {
+    "Status": "Failure",
+    "StatusId": 2
+}
+OCSF_STATUS_BY_CLASS = {
+    "1": OCSF_STATUS_SUCCESS,
+    "2": OCSF_STATUS_SUCCESS,
+    "3": OCSF_STATUS_SUCCESS
+}
 
 def ocsfStatusNormalization(httpStatusCode: str) -> dict[str | int]:
     """Transforms status code into normalize status"""
-    if httpStatusCode.startswith("1") or httpStatusCode.startswith("2") or httpStatusCode.startswith("3"):
-        status = "Success"
-        statusId = 1
-    else:
-        status = "Failure"
-        statusId = 2
-
-    return {
-        "Status": status,
-        "StatusId": statusId
-    }
+    return OCSF_STATUS_BY_CLASS.get(httpStatusCode[:1], OCSF_STATUS_FAILURE)
 
 def tlsNormalization(preProcessedLog: dict) -> dict[str | None]:
     """Normalizes TLS data from ALB"""
@@ -212,6 +947,19 @@ def tlsNormalization(preProcessedLog: dict) -> dict[str | None]:
         "TlsVersion": tlsVersion
     }
 
+def derivationCacheStats() -> dict[str, dict[str, int]]:
+    """Returns hit and miss counters of the memoized per-record derivations"""
+    stats = {}
+    for cachedFunction in (targetGroupCloudContext, elbArnBuilder, processUrlObject):
+        cacheInfo = cachedFunction.cache_info()
+        stats[cachedFunction.__name__] = {
+            "hits": cacheInfo.hits,
+            "misses": cacheInfo.misses,
+            "size": cacheInfo.currsize
+        }
+
+    return stats
+
 def convertIso8061ToSqlTimestamp(isoTimestamp: str):
     isoTimestamp = isoTimestamp.split(".")[0]
     # Parse the ISO 8061 timestamp
@@ -256,7 +1004,7 @@ def httpActivityOcsfBuilder(rawlog: str, preProcessedLog: dict, baseEventMapping
     elbId = preProcessedLog["elb"]
     awsAccount = preProcessedLog["account"]
     awsRegion = preProcessedLog["region"]
-    elbArn = f"arn:aws:elasticloadbalancing:{awsRegion}:{awsAccount}:loadbalancer/{elbId}"
+    elbArn = elbArnBuilder(elbId, awsRegion, awsAccount)
 
     # Normalize Observables
     observables = [
@@ -419,9 +1167,759 @@ def httpActivityOcsfBuilder(rawlog: str, preProcessedLog: dict, baseEventMapping
 
     return ocsf
 
-openLogFile(
-    bucket=BUCKET_NAME,
-    prefix=PATH_NAME
+def ocsfStruct(*fields) -> pa.DataType:
+    """Shorthand for a struct of nullable OCSF attributes"""
+    return pa.struct([pa.field(name, dataType) for name, dataType in fields])
+
+OBSERVABLE_TYPE = ocsfStruct(
+    ("name", pa.string()),
+    ("type", pa.string()),
+    ("type_id", pa.int32()),
+    ("value", pa.string())
 )
 
+def ocsfHttpActivityNestedSchema(legacyTimestamps: bool = LEGACY_TIMESTAMPS, profile: str = OUTPUT_PROFILE) -> pa.Schema:
+    """
+    Fixed OCSF 1.4.0 HTTP Activity schema matching the documents built by httpActivityOcsfBuilder, event times are
+    timestamp[ms] columns unless the legacy "YYYY-MM-DD HH:MM:SS.000" strings are requested.
+    Columns the output profile does not emit are left out
+    """
+    timestampType = pa.string() if legacyTimestamps else pa.timestamp("ms")
+
+    schema = pa.schema(
+        [
+            ("activity_id", pa.int32()),
+            ("activity_name", pa.string()),
+            ("category_name", pa.string()),
+            ("category_uid", pa.int32()),
+            ("class_name", pa.string()),
+            ("class_uid", pa.int32()),
+            ("severity_id", pa.int32()),
+            ("severity", pa.string()),
+            ("status", pa.string()),
+            ("status_code", pa.string()),
+            ("status_detail", pa.string()),
+            ("status_id", pa.int32()),
+            ("type_uid", pa.int64()),
+            ("type_name", pa.string()),
+            ("message", pa.string()),
+            ("time", timestampType),
+            ("start_time", timestampType),
+            ("duration", pa.float64()),
+            ("raw_data", pa.string()),
+            ("metadata", ocsfStruct(
+                ("uid", pa.string()),
+                ("logged_time", timestampType),
+                ("orignal_time", timestampType),
+                ("version", pa.string()),
+                ("profiles", pa.list_(pa.string())),
+                ("product", ocsfStruct(
+                    ("name", pa.string()),
+                    ("vendor_name", pa.string()),
+                    ("feature", ocsfStruct(("name", pa.string())))
+                ))
+            )),
+            ("observables", pa.list_(OBSERVABLE_TYPE)),
+            ("cloud", ocsfStruct(
+                ("account", ocsfStruct(
+                    ("type_id", pa.int32()),
+                    ("type", pa.string()),
+                    ("uid", pa.string())
+                )),
+                ("region", pa.string()),
+                ("provider", pa.string())
+            )),
+            ("connection_info", ocsfStruct(
+                ("boundary_id", pa.int32()),
+                ("boundary", pa.string()),
+                ("direction_id", pa.int32()),
+                ("direction", pa.string()),
+                ("protocol_name", pa.string()),
+                ("protocol_num", pa.int32()),
+                ("uid", pa.string())
+            )),
+            ("dst_endpoint", ocsfStruct(
+                ("ip", pa.string()),
+                ("port", pa.int32()),
+                ("uid", pa.string())
+            )),
+            ("http_request", ocsfStruct(
+                ("http_method", pa.string()),
+                ("version", pa.string()),
+                ("user_agent", pa.string()),
+                ("uid", pa.string()),
+                ("url", ocsfStruct(
+                    ("hostname", pa.string()),
+                    ("path", pa.string()),
+                    ("port", pa.int32()),
+                    ("query_string", pa.string()),
+                    ("scheme", pa.string()),
+                    ("url_string", pa.string())
+                ))
+            )),
+            ("src_endpoint", ocsfStruct(
+                ("ip", pa.string()),
+                ("port", pa.int32()),
+                ("uid", pa.string())
+            )),
+            ("traffic", ocsfStruct(
+                ("bytes_out", pa.int64()),
+                ("bytes_in", pa.int64()),
+                ("bytes", pa.int64())
+            )),
+            ("tls", ocsfStruct(
+                ("cipher", pa.string()),
+                ("sni", pa.string()),
+                ("version", pa.string())
+            )),
+            ("unmapped", ocsfStruct(
+                ("target_status_code", pa.string()),
+                ("chosen_cert_arn", pa.string()),
+                ("matched_rule_priority", pa.string()),
+                ("redirect_url", pa.string()),
+                ("target_list", pa.string()),
+                ("target_status_code_list", pa.string()),
+                ("classification", pa.string()),
+                ("classification_reason", pa.string())
+            ))
+        ]
+    )
+
+    for column in OUTPUT_PROFILES[profile]["exclude"]:
+        schema = schema.remove(schema.get_field_index(column))
+
+    return schema
+
+def flattenOcsfFields(fields, parentName: str = "") -> list[pa.Field]:
+    """Flattens nested structs into top-level fields named like src_endpoint_ip"""
+    flattened = []
+    for field in fields:
+        name = f"{parentName}_{field.name}" if parentName else field.name
+        if pa.types.is_struct(field.type):
+            flattened.extend(flattenOcsfFields(field.type, name))
+        else:
+            flattened.append(pa.field(name, field.type))
+
+    return flattened
+
+def ocsfHttpActivitySchema(legacyTimestamps: bool = LEGACY_TIMESTAMPS, profile: str = OUTPUT_PROFILE) -> pa.Schema:
+    """
+    Output schema of an OCSF HTTP Activity profile, flattened for profiles that ask for it
+    """
+    schema = ocsfHttpActivityNestedSchema(legacyTimestamps, profile)
+    if OUTPUT_PROFILES[profile]["flatten"]:
+        return pa.schema(flattenOcsfFields(schema))
+
+    return schema
+
+OCSF_HTTP_ACTIVITY_SCHEMA = ocsfHttpActivitySchema()
+
+# Columns that hold the same value for every ALB record, these are repeated at flush time instead of appended per row
+OCSF_HTTP_ACTIVITY_CONSTANTS = {
+    "category_name": "Network Activity",
+    "category_uid": 4,
+    "class_name": "HTTP Activity",
+    "class_uid": 4002,
+    "severity_id": 1,
+    "severity": "Informational",
+    "metadata.version": "1.4.0",
+    "metadata.profiles": ["cloud"],
+    "metadata.product.name": "Amazon Elastic Load Balancing",
+    "metadata.product.vendor_name": "AWS",
+    "metadata.product.feature.name": "AlbAccessLogs",
+    "cloud.account.type_id": 10,
+    "cloud.account.type": "AWS Account",
+    "cloud.provider": "AWS",
+    "connection_info.boundary_id": 3,
+    "connection_info.boundary": "External",
+    "connection_info.direction_id": 1,
+    "connection_info.direction": "Inbound",
+    "connection_info.protocol_name": "tcp",
+    "connection_info.protocol_num": 6
+}
+
+# Per-row columns in the order HttpActivityBatchBuilder.append() produces them
+OCSF_HTTP_ACTIVITY_COLUMNS = (
+    "activity_id", "activity_name", "status", "status_code", "status_detail", "status_id",
+    "type_uid", "type_name", "message", "time", "start_time", "duration", "raw_data",
+    "metadata.uid",
+    "cloud.account.uid", "cloud.region", "connection_info.uid",
+    "dst_endpoint.ip", "dst_endpoint.port", "dst_endpoint.uid",
+    "http_request.http_method", "http_request.version", "http_request.user_agent", "http_request.uid",
+    "http_request.url.hostname", "http_request.url.path", "http_request.url.port",
+    "http_request.url.query_string", "http_request.url.scheme", "http_request.url.url_string",
+    "src_endpoint.ip", "src_endpoint.port", "src_endpoint.uid",
+    "traffic.bytes_out", "traffic.bytes_in", "traffic.bytes",
+    "tls.cipher", "tls.sni", "tls.version",
+    "unmapped.target_status_code", "unmapped.chosen_cert_arn", "unmapped.matched_rule_priority",
+    "unmapped.redirect_url", "unmapped.target_list", "unmapped.target_status_code_list",
+    "unmapped.classification", "unmapped.classification_reason"
+)
+
+def parseIso8601Timestamps(isoTimestamps: list[str], timestampType: pa.DataType = pa.timestamp("ms")) -> pa.Array:
+    """
+    Parses a column of ALB ISO-8601 timestamps ("2024-01-01T00:00:00.123456Z") into a timestamp array with Arrow
+    compute, values that do not parse become null instead of failing the whole batch
+    """
+    isoArray = pa.array(isoTimestamps, type=pa.string())
+    try:
+        parsed = isoArray.cast(pa.timestamp("us", tz="UTC"))
+    except pa.ArrowInvalid:
+        parsed = pa.array(
+            [parseIso8601Timestamp(isoTimestamp) for isoTimestamp in isoTimestamps],
+            type=pa.timestamp("us", tz="UTC")
+        )
+
+    # ALB timestamps are UTC, store them as zone-less TIMESTAMP(3) like the legacy strings
+    return parsed.cast(timestampType, safe=False)
+
+def parseIso8601Timestamp(isoTimestamp: str) -> datetime | None:
+    """Row-by-row fallback for parseIso8601Timestamps"""
+    try:
+        return datetime.fromisoformat(isoTimestamp.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+
+# Columns that are copies of another per-row column
+OCSF_HTTP_ACTIVITY_ALIASES = {
+    "metadata.logged_time": "time",
+    "metadata.orignal_time": "time"
+}
+
+def ocsfColumnPaths(schema: pa.Schema) -> set[str]:
+    """Dotted paths of every leaf column in a nested OCSF schema, list columns such as observables count as leaves"""
+    def walk(fields, parentPath: str):
+        for field in fields:
+            columnPath = f"{parentPath}.{field.name}" if parentPath else field.name
+            if pa.types.is_struct(field.type):
+                yield from walk(field.type, columnPath)
+            else:
+                yield columnPath
+
+    return set(walk(schema, ""))
+
+def flattenOcsfArrays(arrays) -> list[pa.Array]:
+    """Flattens struct arrays in the same order as flattenOcsfFields"""
+    flattened = []
+    for array in arrays:
+        if pa.types.is_struct(array.type):
+            flattened.extend(flattenOcsfArrays(array.flatten()))
+        else:
+            flattened.append(array)
+
+    return flattened
+
+def discardValue(value):
+    """Stand-in append for columns an output profile does not emit"""
+
+class HttpActivityBatchBuilder:
+    """
+    Appends parsed ALB fields straight into per-column buffers and emits OCSF HTTP Activity pyarrow.RecordBatches,
+    this skips the nested per-row dictionaries of httpActivityOcsfBuilder and the pandas type inference entirely
+    """
+    def __init__(self, legacyTimestamps: bool = LEGACY_TIMESTAMPS, profile: str = OUTPUT_PROFILE):
+        self.legacyTimestamps = legacyTimestamps
+        self.profile = profile
+        self.schema = ocsfHttpActivitySchema(legacyTimestamps, profile)
+        self._nestedSchema = ocsfHttpActivityNestedSchema(legacyTimestamps, profile)
+        self._flatten = OUTPUT_PROFILES[profile]["flatten"]
+        self._emitObservables = "observables" in self._nestedSchema.names
+        self._columns = {column: [] for column in OCSF_HTTP_ACTIVITY_COLUMNS}
+        self._columnBuffers = tuple(self._columns.values())
+        # Columns the profile does not emit are never buffered
+        buffered = {OCSF_HTTP_ACTIVITY_ALIASES.get(columnPath, columnPath) for columnPath in ocsfColumnPaths(self._nestedSchema)}
+        self._columnAppenders = tuple(
+            buffer.append if column in buffered else discardValue
+            for column, buffer in self._columns.items()
+        )
+        # Observables are a list<struct> column, tracked as flat child buffers plus list offsets
+        self._observables = ([], [], [], [])
+        self._observableOffsets = [0]
+        self._rows = 0
+        # Rows flush() dropped because their time or start_time did not parse
+        self.skippedRows = 0
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def append(self, rawlog: str, preProcessedLog: dict | None) -> bool:
+        """
+        Maps one parsed ALB log into the column buffers, returns False for logs that mapPreProcessedLog would skip
+        """
+        # ALB access log docs don't account for this, but if the TG ARN is empty it is likely a log delivery error and should be ignored
+        if preProcessedLog is None:
+            return False
+        targetGroupArn = preProcessedLog["target_group_arn"]
+        if targetGroupArn is None or targetGroupArn == "-":
+            return False
+
+        try:
+            awsRegion, awsAccount = targetGroupCloudContext(targetGroupArn)
+
+            requestSplit = preProcessedLog["request"].split(" ")
+            baseEventMapping = httpActivityBaseEventMapping(requestSplit[0])
+            dstEndpoint = elbTargetProcessor(preProcessedLog["target"])
+            urlString = requestSplit[1]
+            parsedUrl = processUrlObject(urlString)
+            httpVersion = requestSplit[2]
+
+            clientSplit = preProcessedLog["client"].split(":")
+            srcIp = clientSplit[0]
+            srcPort = clientSplit[1]
+        except IndexError:
+            return False
+
+        statusCode = preProcessedLog["elb_status_code"]
+        statusNormalization = ocsfStatusNormalization(statusCode)
+        normalizedTls = tlsNormalization(preProcessedLog)
+        if self.legacyTimestamps:
+            eventTime = convertIso8061ToSqlTimestamp(preProcessedLog["time"])
+            startTime = convertIso8061ToSqlTimestamp(preProcessedLog["request_creation_time"])
+        else:
+            # ISO-8601 strings are parsed for the whole batch at once in flush()
+            eventTime = preProcessedLog["time"]
+            startTime = preProcessedLog["request_creation_time"]
+        elbArn = elbArnBuilder(preProcessedLog["elb"], awsRegion, awsAccount)
+        traceId = preProcessedLog["trace_id"]
+        userAgent = preProcessedLog["user_agent"]
+        sentBytes = int(preProcessedLog["sent_bytes"])
+        receivedBytes = int(preProcessedLog["received_bytes"])
+
+        # Every value is computed before anything is appended so a ValueError cannot leave a partial row behind
+        row = (
+            baseEventMapping["ActivityId"],
+            baseEventMapping["ActivityName"],
+            statusNormalization["Status"],
+            statusCode,
+            None if preProcessedLog["error_reason"] == "-" else preProcessedLog["error_reason"],
+            statusNormalization["StatusId"],
+            baseEventMapping["TypeUid"],
+            baseEventMapping["TypeName"],
+            f"ALB executed the following actions: {preProcessedLog['actions_executed']}",
+            eventTime,
+            startTime,
+            float(preProcessedLog["request_processing_time"]) + float(preProcessedLog["target_processing_time"]) + float(preProcessedLog["response_processing_time"]),
+            rawlog,
+            traceId,
+            awsAccount,
+            awsRegion,
+            traceId,
+            dstEndpoint["ip"],
+            dstEndpoint["port"],
+            targetGroupArn,
+            requestSplit[0].upper(),
+            httpVersion,
+            userAgent,
+            traceId,
+            parsedUrl["hostname"],
+            parsedUrl["path"],
+            parsedUrl["port"],
+            parsedUrl["query_string"],
+            parsedUrl["scheme"],
+            urlString,
+            srcIp,
+            int(srcPort),
+            elbArn,
+            sentBytes,
+            receivedBytes,
+            sentBytes + receivedBytes,
+            normalizedTls["TlsCipher"],
+            normalizedTls["TlsSni"],
+            normalizedTls["TlsVersion"],
+            preProcessedLog["target_status_code"],
+            preProcessedLog["chosen_cert_arn"],
+            preProcessedLog["matched_rule_priority"],
+            preProcessedLog["redirect_url"],
+            preProcessedLog["target_list"],
+            preProcessedLog["target_status_code_list"],
+            preProcessedLog["classification"],
+            preProcessedLog["classification_reason"]
+        )
+        for append, value in zip(self._columnAppenders, row):
+            append(value)
+
+        # Normalize Observables
+        if self._emitObservables:
+            self._appendObservable("src_endpoint.ip", "IP Address", 2, srcIp)
+            self._appendObservable("src_endpoint.port", "Port", 11, srcPort)
+            self._appendObservable("http_request.url.url_string", "URL String", 6, urlString)
+            self._appendObservable("src_endpoint.uid", "Resource UID", 10, elbArn)
+            self._appendObservable("dst_endpoint.uid", "Resource UID", 10, targetGroupArn)
+            self._appendObservable("http_request.user_agent", "User Agent", 16, userAgent)
+            self._appendObservable("cloud.account.uid", "Account UID", 35, awsAccount)
+            if dstEndpoint["ip"]:
+                self._appendObservable("dst_endpoint.ip", "IP Address", 2, dstEndpoint["ip"])
+            if dstEndpoint["port"]:
+                self._appendObservable("dst_endpoint.port", "Port", 11, str(dstEndpoint["port"]))
+            self._observableOffsets.append(len(self._observables[0]))
+
+        self._rows += 1
+        return True
+
+    def _appendObservable(self, name: str, observableType: str, typeId: int, value: str):
+        names, types, typeIds, values = self._observables
+        names.append(name)
+        types.append(observableType)
+        typeIds.append(typeId)
+        values.append(value)
+
+    def _buildArray(self, columnPath: str, dataType: pa.DataType) -> pa.Array:
+        """Recursively assembles the Arrow array for a schema field from the column buffers and constants"""
+        if columnPath in OCSF_HTTP_ACTIVITY_CONSTANTS:
+            return pa.repeat(pa.scalar(OCSF_HTTP_ACTIVITY_CONSTANTS[columnPath], type=dataType), self._rows)
+
+        if columnPath == "observables":
+            observables = pa.StructArray.from_arrays(
+                [
+                    pa.array(buffer, type=field.type)
+                    for buffer, field in zip(self._observables, OBSERVABLE_TYPE)
+                ],
+                fields=list(OBSERVABLE_TYPE)
+            )
+            return pa.ListArray.from_arrays(
+                pa.array(self._observableOffsets, type=pa.int32()),
+                observables,
+                type=dataType
+            )
+
+        if pa.types.is_struct(dataType):
+            return pa.StructArray.from_arrays(
+                [self._buildArray(f"{columnPath}.{field.name}", field.type) for field in dataType],
+                fields=list(dataType)
+            )
+
+        if pa.types.is_timestamp(dataType):
+            return parseIso8601Timestamps(self._columns[OCSF_HTTP_ACTIVITY_ALIASES.get(columnPath, columnPath)], dataType)
+
+        return pa.array(self._columns[OCSF_HTTP_ACTIVITY_ALIASES.get(columnPath, columnPath)], type=dataType)
+
+    def flush(self) -> pa.RecordBatch | None:
+        """Returns the buffered rows as a RecordBatch and resets the builder, None if nothing was appended"""
+        if not self._rows:
+            return None
+
+        batch = pa.RecordBatch.from_arrays(
+            [self._buildArray(field.name, field.type) for field in self._nestedSchema],
+            schema=self._nestedSchema
+        )
+        if not self.legacyTimestamps:
+            # Skipped like the legacy string conversion skips them, a null time would land in an event_date=None partition
+            valid = pc.and_(pc.is_valid(batch.column("time")), pc.is_valid(batch.column("start_time")))
+            invalidRows = batch.num_rows - pc.sum(valid).as_py()
+            if invalidRows:
+                batch = batch.filter(valid)
+                self.skippedRows += invalidRows
+        if self._flatten:
+            # Struct children become top-level columns without copying the buffers
+            batch = pa.RecordBatch.from_arrays(flattenOcsfArrays(batch.columns), schema=self.schema)
+
+        for buffer in self._columnBuffers:
+            buffer.clear()
+        for buffer in self._observables:
+            buffer.clear()
+        self._observableOffsets = [0]
+        self._rows = 0
+
+        return batch
+
+class RollingParquetWriter:
+    """
+    Streams record batches into Parquet row groups as they arrive, rolling over to a new file once the current
+    file reaches maxFileRecords rows or maxFileBytes on disk, so memory stays flat regardless of the input size
+    """
+    def __init__(
+        self,
+        outputPrefix: str = f"{OUTPUT_DESTINATION}/part",
+        schema: pa.Schema = OCSF_HTTP_ACTIVITY_SCHEMA,
+        rowGroupSize: int = ROW_GROUP_SIZE,
+        maxFileRecords: int = MAX_FILE_RECORDS,
+        maxFileBytes: int = MAX_FILE_BYTES,
+        filesystem: fs.FileSystem | None = None,
+        onFileOpen: Callable[[str], None] | None = None
+    ):
+        self.outputPrefix = outputPrefix
+        self.filesystem = filesystem
+        # Called with every file name before anything is written to it
+        self.onFileOpen = onFileOpen
+        self.schema = schema
+        self.rowGroupSize = rowGroupSize
+        self.maxFileRecords = maxFileRecords
+        self.maxFileBytes = maxFileBytes
+        self.files: list[str] = []
+        self.totalRecords = 0
+        self._pending: list[pa.RecordBatch] = []
+        self._pendingRows = 0
+        self._sink = None
+        self._writer = None
+        self._fileRecords = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, batch: pa.RecordBatch):
+        """Buffers a record batch and flushes a row group every rowGroupSize rows"""
+        if not batch.num_rows:
+            return
+        self._pending.append(batch)
+        self._pendingRows += batch.num_rows
+        if self._pendingRows >= self.rowGroupSize:
+            self._flushRowGroups()
+
+    def _openFile(self):
+        filename = f"{self.outputPrefix}-{len(self.files):05}.parquet.zstd"
+        if self.onFileOpen is not None:
+            self.onFileOpen(filename)
+        if self.filesystem is None:
+            makedirs(path.dirname(filename) or ".", exist_ok=True)
+            # Written under a temporary name and renamed on close so an interrupted run never leaves a truncated file
+            self._sink = pa.OSFile(f"{filename}.inprogress", "wb")
+        else:
+            # S3 multipart uploads only become visible once the stream is closed
+            self.filesystem.create_dir(path.dirname(filename), recursive=True)
+            self._sink = self.filesystem.open_output_stream(filename)
+        self._writer = pq.ParquetWriter(self._sink, self.schema, compression="zstd")
+        self._fileRecords = 0
+        self.files.append(filename)
+
+    def _closeFile(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            if self.filesystem is None:
+                replace(f"{self.files[-1]}.inprogress", self.files[-1])
+            logger.info(f"Wrote {self._fileRecords} records to {self.files[-1]}")
+        self._writer = None
+        self._sink = None
+
+    def _flushRowGroups(self, final: bool = False):
+        table = pa.Table.from_batches(self._pending, schema=self.schema)
+        self._pending = []
+        self._pendingRows = 0
+
+        offset = 0
+        while offset < table.num_rows:
+            # Never write past the record limit of the current file
+            remainingInFile = self.maxFileRecords - self._fileRecords if self._writer is not None else self.maxFileRecords
+            length = min(self.rowGroupSize, remainingInFile)
+            if table.num_rows - offset < length and not final:
+                # Keep the remainder buffered so row groups stay at rowGroupSize rows
+                self._pending = table.slice(offset).to_batches()
+                self._pendingRows = table.num_rows - offset
+                return
+
+            if self._writer is None:
+                self._openFile()
+            rowGroup = table.slice(offset, length)
+            self._writer.write_table(rowGroup, row_group_size=self.rowGroupSize)
+            offset += rowGroup.num_rows
+            self._fileRecords += rowGroup.num_rows
+            self.totalRecords += rowGroup.num_rows
+
+            if self._fileRecords >= self.maxFileRecords or self._sink.tell() >= self.maxFileBytes:
+                self._closeFile()
+
+    @property
+    def bufferedRows(self) -> int:
+        return self._pendingRows
+
+    def flush(self):
+        """Writes the buffered rows out now, as a row group smaller than rowGroupSize when fewer are buffered"""
+        if self._pending:
+            self._flushRowGroups(final=True)
+
+    def close(self) -> list[str]:
+        """Flushes any buffered rows, closes the current file and returns every file written"""
+        self.flush()
+        self._closeFile()
+        return self.files
+
+def resolveOutputDestination(destination: str) -> tuple[fs.FileSystem | None, str]:
+    """
+    Returns the pyarrow filesystem and base path for an output destination, None is returned for local directories
+    """
+    if "://" in destination:
+        filesystem, basePath = fs.FileSystem.from_uri(destination)
+        return filesystem, basePath.rstrip("/")
+
+    return None, destination.rstrip("/")
+
+def hivePartitionPath(account: str, region: str, eventDate: str, eventHour: str) -> str:
+    """Builds the Hive-style partition path for an account, region and event hour"""
+    return f"account={account}/region={region}/event_date={eventDate}/event_hour={eventHour}"
+
+def partitionRecordBatch(batch: pa.RecordBatch) -> list[tuple[str, pa.RecordBatch]]:
+    """
+    Splits an OCSF record batch by cloud.account.uid, cloud.region and event date and hour using Arrow group-by
+    """
+    if "cloud" in batch.schema.names:
+        cloud = batch.column("cloud")
+        account = cloud.field("account").field("uid")
+        region = cloud.field("region")
+    else:
+        # Flattened output profiles
+        account = batch.column("cloud_account_uid")
+        region = batch.column("cloud_region")
+    eventTime = batch.column("time")
+    if pa.types.is_timestamp(eventTime.type):
+        eventDate = pc.strftime(eventTime, "%Y-%m-%d")
+        eventHour = pc.strftime(eventTime, "%H")
+    else:
+        eventDate = pc.utf8_slice_codeunits(eventTime, 0, 10)
+        eventHour = pc.utf8_slice_codeunits(eventTime, 11, 13)
+    keys = pa.table(
+        {
+            "account": account,
+            "region": region,
+            "event_date": eventDate,
+            "event_hour": eventHour,
+            "row": pa.array(range(batch.num_rows), type=pa.int64())
+        }
+    )
+    groups = keys.group_by(["account", "region", "event_date", "event_hour"], use_threads=False).aggregate([("row", "list")])
+
+    partitions = []
+    for index in range(groups.num_rows):
+        partition = hivePartitionPath(
+            groups["account"][index].as_py(),
+            groups["region"][index].as_py(),
+            groups["event_date"][index].as_py(),
+            groups["event_hour"][index].as_py()
+        )
+        # Most objects belong to a single load balancer hour, skip the take() when there is nothing to split
+        if groups.num_rows == 1:
+            partitions.append((partition, batch))
+        else:
+            partitions.append((partition, batch.take(groups["row_list"][index].values)))
+
+    return partitions
+
+class PartitionedParquetWriter:
+    """
+    Streams OCSF record batches into Hive-style account=/region=/event_date=/event_hour= partitions under a local
+    directory or S3 prefix, each partition is written through its own RollingParquetWriter.
+    At most maxBufferedRows rows are buffered across the partitions, not a full row group for each open one
+    """
+    def __init__(
+        self,
+        destination: str = OUTPUT_DESTINATION,
+        filePrefix: str = "part",
+        maxOpenPartitions: int = MAX_OPEN_PARTITIONS,
+        maxBufferedRows: int = MAX_BUFFERED_ROWS,
+        **writerOptions
+    ):
+        self.filesystem, self.basePath = resolveOutputDestination(destination)
+        self.filePrefix = filePrefix
+        self.maxOpenPartitions = maxOpenPartitions
+        self.maxBufferedRows = maxBufferedRows
+        self.writerOptions = writerOptions
+        self._partitions: dict[str, RollingParquetWriter] = {}
+        # Partitions with an open file or buffered rows, least recently written first
+        self._openPartitions: OrderedDict[str, None] = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def files(self) -> list[str]:
+        return [filename for writer in self._partitions.values() for filename in writer.files]
+
+    @property
+    def totalRecords(self) -> int:
+        return sum(writer.totalRecords for writer in self._partitions.values())
+
+    def write(self, batch: pa.RecordBatch):
+        """Splits a record batch into its partitions and buffers each slice with that partition's writer"""
+        if not batch.num_rows:
+            return
+
+        for partition, partitionBatch in partitionRecordBatch(batch):
+            writer = self._partitions.get(partition)
+            if writer is None:
+                writer = RollingParquetWriter(
+                    outputPrefix=f"{self.basePath}/{partition}/{self.filePrefix}",
+                    filesystem=self.filesystem,
+                    **self.writerOptions
+                )
+                self._partitions[partition] = writer
+            writer.write(partitionBatch)
+
+            self._openPartitions[partition] = None
+            self._openPartitions.move_to_end(partition)
+            # Bound the open files and buffered rows, a partition written to again later continues with its next file
+            while len(self._openPartitions) > self.maxOpenPartitions:
+                leastRecent, _ = self._openPartitions.popitem(last=False)
+                self._partitions[leastRecent].close()
+
+            bufferedRows = {openPartition: self._partitions[openPartition].bufferedRows for openPartition in self._openPartitions}
+            while sum(bufferedRows.values()) > self.maxBufferedRows:
+                largest = max(bufferedRows, key=bufferedRows.get)
+                self._partitions[largest].flush()
+                bufferedRows[largest] = 0
+
+    def close(self) -> list[str]:
+        """Closes every partition writer and returns all files written"""
+        for writer in self._partitions.values():
+            writer.close()
+        self._openPartitions.clear()
+        return self.files
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bucket", default=BUCKET_NAME, help="S3 bucket containing the ALB access logs")
+    parser.add_argument("--prefix", default=PATH_NAME, help="S3 prefix of the ALB access logs")
+    parser.add_argument("--parser", choices=["tokenizer", "grok"], default=PARSER, help="ALB log parser to use")
+    parser.add_argument("--strict", action="store_true", default=STRICT_PARSING, help="Fail on malformed log lines instead of skipping them")
+    parser.add_argument("--filter", action="append", default=list(FILTERS), dest="filters", help="Raw ALB field filter such as elb_status_code!~^2 or time>=2024-12-01T09:00:00, repeat to AND several")
+    parser.add_argument("--download", action="store_true", help="Stage each object in /tmp instead of streaming it from S3")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Number of S3 objects to fetch and parse concurrently")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Worker processes, each writes its own Parquet shard (try os.cpu_count())")
+    parser.add_argument("--legacy-timestamps", action="store_true", help="Write event times as strings instead of timestamp[ms] columns")
+    parser.add_argument("--profile", choices=list(OUTPUT_PROFILES), default=OUTPUT_PROFILE, help="Output profile: full, lean (no raw_data) or analytics (flattened, no raw_data or observables)")
+    parser.add_argument("--output", default=OUTPUT_DESTINATION, help="Local directory or s3://bucket/prefix for the output Parquet files")
+    parser.add_argument("--no-partition", action="store_true", help="Write a flat set of Parquet files instead of account/region/date/hour partitions")
+    parser.add_argument("--max-open-partitions", type=int, default=MAX_OPEN_PARTITIONS, help="Partitions with an open Parquet file at once")
+    parser.add_argument("--max-buffered-rows", type=int, default=MAX_BUFFERED_ROWS, help="Rows buffered across all open partitions before the largest buffer is flushed")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help="Rows per Parquet row group")
+    parser.add_argument("--max-file-records", type=int, default=MAX_FILE_RECORDS, help="Roll over to a new Parquet file after this many records")
+    parser.add_argument("--max-file-bytes", type=int, default=MAX_FILE_BYTES, help="Roll over to a new Parquet file after this many bytes")
+    parser.add_argument("--state-db", default=STATE_DB_PATH, help="SQLite database of converted objects, reruns skip objects it already records")
+    parser.add_argument("--checkpoint-interval", type=int, default=CHECKPOINT_INTERVAL, help="Objects converted between state database checkpoints")
+    parser.add_argument("--parity-check", metavar="LOG_FILE", help="Compare tokenizer and GROK output for a local gzipped ALB log and exit")
+    args = parser.parse_args()
+
+    if args.parity_check:
+        with gunzip(args.parity_check, mode="rt") as logs:
+            mismatches = checkParserParity(logs)
+        for mismatch in mismatches:
+            logger.warning(f"Parser mismatch on line {mismatch['line']}: {json.dumps(mismatch)}")
+        logger.info(f"Parity check found {len(mismatches)} mismatched lines.")
+    else:
+        openLogFile(
+            bucket=args.bucket,
+            prefix=args.prefix,
+            parser=args.parser,
+            strict=args.strict,
+            stream=not args.download,
+            concurrency=args.concurrency,
+            workers=args.workers,
+            filters=tuple(args.filters),
+            legacyTimestamps=args.legacy_timestamps,
+            profile=args.profile,
+            outputDestination=args.output,
+            partitionOutput=not args.no_partition,
+            maxOpenPartitions=args.max_open_partitions,
+            maxBufferedRows=args.max_buffered_rows,
+            rowGroupSize=args.row_group_size,
+            maxFileRecords=args.max_file_records,
+            maxFileBytes=args.max_file_bytes,
+            statePath=args.state_db,
+            checkpointInterval=args.checkpoint_interval
+        )
+
 # eof
\ No newline at end of file
@@ -0,0 +1,168 @@
+import argparse
+import datetime
+import gzip
+import ipaddress
+import logging
+import random
+from os import makedirs, path
+
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO)
+
+ACCOUNT_ID = "123456789012"
+REGIONS = ["us-east-1", "us-east-2", "us-west-2", "eu-west-1"]
+
+# Weighted towards what busy load balancers actually see
+HTTP_METHODS = ["GET"] * 70 + ["POST"] * 15 + ["PUT"] * 4 + ["DELETE"] * 3 + ["HEAD"] * 3 + ["OPTIONS"] * 3 + ["PATCH", "CONNECT"]
+STATUS_CODES = ["200"] * 70 + ["201", "204", "301", "302", "304"] * 3 + ["400", "401", "403", "404"] * 2 + ["460", "500", "502", "503", "504"]
+PATHS = ["/", "/login", "/logout", "/api/v1/users", "/api/v1/orders", "/static/app.js", "/static/app.css", "/health", "/search", "/wp-login.php"]
+QUERY_STRINGS = ["", "", "", "?page=2", "?q=shoes&sort=price", "?id=1%27%20OR%201=1--", "?token=abc123"]
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.1 Safari/605.1.15",
+    "curl/8.5.0",
+    "python-requests/2.32.3",
+    "ELB-HealthChecker/2.0",
+    "sqlmap/1.8.11#stable (https://sqlmap.org)",
+    # ALB escapes quotes inside quoted fields with a backslash
+    'Mozilla/5.0 (compatible; \\"Probe\\" 1.0; \\\\)',
+    "-"
+]
+TLS_CIPHERS = ["ECDHE-RSA-AES128-GCM-SHA256", "ECDHE-RSA-AES256-GCM-SHA384", "TLS_AES_128_GCM_SHA256"]
+TLS_PROTOCOLS = ["TLSv1.2", "TLSv1.3"]
+ERROR_REASONS = ["-"] * 8 + ["LambdaUnhandled", "TargetConnectionErrorCode"]
+
+def randomHex(length: int) -> str:
+    """Random hex string, drawn from random so --seed makes the output reproducible"""
+    return f"{random.getrandbits(length * 4):0{length}x}"
+
+def syntheticTimestamp(start: datetime.datetime, spreadSeconds: int) -> datetime.datetime:
+    """
+    Random UTC timestamp with microseconds within spreadSeconds of start
+    """
+    return start + datetime.timedelta(seconds=random.randint(0, spreadSeconds), microseconds=random.randint(0, 999999))
+
+def isoTimestamp(timestamp: datetime.datetime) -> str:
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def generateSyntheticAlbLog(elbId: str, region: str, start: datetime.datetime, lambdaRatio: float) -> str:
+    """
+    Generates one ALB access log line with a mix of methods, status codes, TLS/non-TLS listeners and Lambda targets
+    """
+    requestType = random.choice(["http", "https", "https", "h2"])
+    isTls = requestType != "http"
+    isLambda = random.random() < lambdaRatio
+
+    requestCreationTime = syntheticTimestamp(start, 3600)
+    responseTime = requestCreationTime + datetime.timedelta(milliseconds=random.randint(1, 2500))
+
+    clientIp = str(ipaddress.IPv4Address(random.randint(0x0B000000, 0xDF000000)))
+    clientPort = random.randint(1024, 65535)
+    targetGroupName = "lambda-targets" if isLambda else "web-targets"
+    targetGroupArn = f"arn:aws:elasticloadbalancing:{region}:{ACCOUNT_ID}:targetgroup/{targetGroupName}/{randomHex(16)}"
+    # Lambda targets have no ip:port
+    target = "-" if isLambda else f"10.0.{random.randint(0, 255)}.{random.randint(1, 254)}:{random.choice([80, 8080, 443])}"
+
+    statusCode = random.choice(STATUS_CODES)
+    targetStatusCode = "-" if statusCode == "460" else statusCode
+    method = random.choice(HTTP_METHODS)
+    scheme = "https" if isTls else "http"
+    port = 443 if isTls else 80
+    domain = random.choice(["www.example.com", "api.example.com", "shop.example.com"])
+    url = f"{scheme}://{domain}:{port}{random.choice(PATHS)}{random.choice(QUERY_STRINGS)}"
+    httpVersion = "HTTP/2.0" if requestType == "h2" else "HTTP/1.1"
+
+    fields = [
+        requestType,
+        isoTimestamp(responseTime),
+        f"app/my-loadbalancer/{elbId}",
+        f"{clientIp}:{clientPort}",
+        target,
+        f"{random.uniform(0, 0.01):.3f}",
+        "-1" if statusCode == "460" else f"{random.uniform(0, 2):.3f}",
+        f"{random.uniform(0, 0.01):.3f}",
+        statusCode,
+        targetStatusCode,
+        str(random.randint(0, 4096)),
+        str(random.randint(0, 65536)),
+        f'"{method} {url} {httpVersion}"',
+        f'"{random.choice(USER_AGENTS)}"',
+        random.choice(TLS_CIPHERS) if isTls else "-",
+        random.choice(TLS_PROTOCOLS) if isTls else "-",
+        targetGroupArn,
+        f'"Root=1-{int(requestCreationTime.timestamp()):08x}-{randomHex(24)}"',
+        f'"{domain}"' if isTls else '"-"',
+        f'"arn:aws:acm:{region}:{ACCOUNT_ID}:certificate/{randomHex(8)}-{randomHex(4)}-{randomHex(4)}-{randomHex(4)}-{randomHex(12)}"' if isTls else '"-"',
+        str(random.randint(0, 10)),
+        isoTimestamp(requestCreationTime),
+        '"forward"',
+        '"-"',
+        f'"{random.choice(ERROR_REASONS)}"',
+        '"-"' if isLambda else f'"{target}"',
+        f'"{targetStatusCode}"',
+        '"-"',
+        '"-"',
+        f"TID_{randomHex(32)}"
+    ]
+
+    return " ".join(fields)
+
+def malformLog(rawlog: str) -> str:
+    """
+    Breaks an otherwise valid line the ways delivery errors and truncation do
+    """
+    breakage = random.choice(["truncate", "unterminated_quote", "no_target_group", "bad_timestamp"])
+    if breakage == "truncate":
+        return rawlog[:random.randint(1, len(rawlog) // 2)].replace('"', "")
+    if breakage == "unterminated_quote":
+        return rawlog[:rawlog.index('"') + 10]
+    if breakage == "bad_timestamp":
+        fields = rawlog.split(" ", 2)
+        return f"{fields[0]} {fields[1][:10]}T99:99:99.000000Z {fields[2]}"
+
+    fields = rawlog.split(" arn:aws:elasticloadbalancing:", 1)
+    return fields[0] + " - " + fields[1].split(" ", 1)[1]
+
+def writeSyntheticAlbLogFiles(outputDir: str, files: int, linesPerFile: int, malformedRatio: float, lambdaRatio: float) -> list[str]:
+    """
+    Writes gzipped ALB access log files named like the real ones AWS delivers
+    """
+    makedirs(outputDir, exist_ok=True)
+    start = datetime.datetime(2024, 12, 1, tzinfo=datetime.timezone.utc)
+    written = []
+
+    for fileIndex in range(files):
+        elbId = randomHex(16)
+        region = random.choice(REGIONS)
+        fileStart = start + datetime.timedelta(hours=fileIndex % 24)
+        filename = path.join(
+            outputDir,
+            f"{ACCOUNT_ID}_elasticloadbalancing_{region}_app.my-loadbalancer.{elbId}_{fileStart.strftime('%Y%m%dT%H%MZ')}_10.0.0.1_{randomHex(8)}.log.gz"
+        )
+        with gzip.open(filename, mode="wt") as logFile:
+            for _ in range(linesPerFile):
+                rawlog = generateSyntheticAlbLog(elbId, region, fileStart, lambdaRatio)
+                if random.random() < malformedRatio:
+                    rawlog = malformLog(rawlog)
+                logFile.write(rawlog + "\n")
+        written.append(filename)
+
+    return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", default="./synthetic_alb_logs", help="Directory for the gzipped ALB access logs")
+    parser.add_argument("--files", type=int, default=10, help="Number of log files to write")
+    parser.add_argument("--lines", type=int, default=100_000, help="Log lines per file")
+    parser.add_argument("--malformed-ratio", type=float, default=0.001, help="Share of lines that are malformed")
+    parser.add_argument("--lambda-ratio", type=float, default=0.1, help="Share of requests that hit a Lambda target")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible output")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    written = writeSyntheticAlbLogFiles(args.output_dir, args.files, args.lines, args.malformed_ratio, args.lambda_ratio)
+    logger.info(f"Wrote {len(written)} files of {args.lines} synthetic ALB access logs to {args.output_dir}")
+
+# eof
@@ -1,19 +1,28 @@
 import logging
 import argparse
+import heapq
 from os import getenv
 from botocore.config import Config
 import boto3
-import gzip
-import json
-import io
+import importlib
+import math
 import random
 import string
-from collections import defaultdict
+import threading
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from collections import defaultdict, deque
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
 import pyarrow.parquet as pq
 from datetime import datetime
-from multiprocessing import Pool, cpu_count
-from typing import List
+from multiprocessing import Manager, cpu_count, util
+from typing import List, Tuple
+from cb_parquet_sink import MULTIPART_CONCURRENCY, ParquetSink, PartitionBuffer, open_parquet_sink
+from cb_schema_registry import SchemaRegistry, SharedSchemaRegistry, cast_column, load_schema_registry, save_schema_registry, widen_type
 
 # -------- LOGGING -------- #
 logging.basicConfig(
@@ -30,7 +39,35 @@ INPUT_PREFIX: str = f"{getenv('INPUT_PREFIX')}/org_key={ORG_KEY}/"
 OUTPUT_PREFIX: str = "source=carbon_black_events_processed/"
 FILES_PER_BATCH: int = int(getenv("FILES_PER_BATCH", 500))
 MAX_RECORDS: int = int(getenv("MAX_RECORDS", 100_000))
-MAX_BYTES = 128 * 1024 * 1024
+# Budgets of one work unit: compressed input bytes when planning, and records once the files are parsed
+MAX_BYTES: int = int(getenv("MAX_BYTES", 128 * 1024 * 1024))
+# "auto" uses the fastest installed gzip implementation: isal, then zlib_ng, then the stdlib
+GZIP_BACKEND: str = getenv("GZIP_BACKEND", "auto")
+# Threads inflating the members of a multi-member .jsonl.gz in parallel, 1 always inflates sequentially
+DECOMPRESS_THREADS: int = int(getenv("DECOMPRESS_THREADS", 4))
+# Decompressed JSONL is handed to the Arrow JSON reader in blocks of about this many bytes, a bad line only costs its block a retry
+JSONL_BLOCK_SIZE: int = int(getenv("JSONL_BLOCK_SIZE", 16 * 1024 * 1024))
+# Optional Parquet file (such as an earlier output file) whose schema fixes the column types instead of inferring them
+JSONL_SCHEMA_PATH: str = getenv("JSONL_SCHEMA_PATH")
+# Work units planned per worker up front, smaller units balance better across the pool
+UNITS_PER_WORKER: int = int(getenv("UNITS_PER_WORKER", 4))
+# Times a file that could not be read is handed to another work unit
+UNIT_RETRIES: int = int(getenv("UNIT_RETRIES", 2))
+# A running unit is a straggler once it takes STRAGGLER_FACTOR times the median unit time, after STRAGGLER_MIN_UNITS have finished
+STRAGGLER_FACTOR: float = float(getenv("STRAGGLER_FACTOR", 3))
+STRAGGLER_MIN_UNITS: int = int(getenv("STRAGGLER_MIN_UNITS", 3))
+STRAGGLER_CHECK_SECONDS: int = int(getenv("STRAGGLER_CHECK_SECONDS", 10))
+# Hand the files a straggler has not started on to new work units
+STRAGGLER_SPLIT: bool = getenv("STRAGGLER_SPLIT", "false").lower() == "true"
+# How long a worker's final flush waits for the other workers to take theirs, so none of them takes two
+FLUSH_BARRIER_SECONDS: int = int(getenv("FLUSH_BARRIER_SECONDS", 60))
+# GETs each worker keeps in flight while it parses, and the compressed bytes they may buffer (the first GET always goes out)
+PREFETCH_OBJECTS: int = int(getenv("PREFETCH_OBJECTS", 4))
+PREFETCH_BYTES: int = int(getenv("PREFETCH_BYTES", 64 * 1024 * 1024))
+# Connections per S3 client, enough for the prefetch GETs plus the concurrent multipart upload parts
+S3_MAX_POOL_CONNECTIONS: int = int(getenv("S3_MAX_POOL_CONNECTIONS", PREFETCH_OBJECTS + MULTIPART_CONCURRENCY))
+# Write the hourly partitions below this local directory instead of S3_OUTPUT_BUCKET, for test runs
+OUTPUT_LOCAL_DIR: str = getenv("OUTPUT_LOCAL_DIR")
 
 # -------- boto3 -------- #
 botocore_retry_config = Config(
@@ -40,46 +77,232 @@ botocore_retry_config = Config(
     }
 )
 
-s3 = boto3.client("s3", config=botocore_retry_config)
+def create_s3_client():
+    # A session per client, the default session is not safe to share between threads
+    return boto3.session.Session().client(
+        "s3",
+        config=botocore_retry_config.merge(Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+    )
+
+s3 = create_s3_client()
+
+def init_worker(delete_after: bool = False):
+    """
+    Gives every pool process its own client, the one created before the fork would share its connection pool,
+    and commits the partitions the process still buffers when it exits without having run flush_worker
+    """
+    global s3
+    s3 = create_s3_client()
+    util.Finalize(None, flush_partition_buffer, args=(delete_after,), exitpriority=10)
 
-def list_s3_keys(prefix: str) -> List[str]:
+def list_s3_keys(prefix: str) -> List[Tuple[str, int]]:
     keys = []
     paginator = s3.get_paginator("list_objects_v2")
     for page in paginator.paginate(Bucket=CB_EVENTS_S3_BUCKET_NAME, Prefix=prefix):
         for obj in page.get("Contents", []):
             if obj["Key"].endswith(".jsonl.gz"):
-                keys.append(obj["Key"])
+                keys.append((obj["Key"], obj["Size"]))
     return keys
 
 def random_suffix(length=28):
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
-def parse_and_flatten_jsonl(content: bytes):
-    records = []
-    with gzip.GzipFile(fileobj=io.BytesIO(content), mode="rb") as gz:
-        for line in gz:
-            try:
-                records.append(json.loads(line))
-            except Exception:
-                continue
-    return records
-
-def convert_timestamps(records):
-    for rec in records:
-        for ts_key in ("backend_timestamp", "device_timestamp"):
-            val = rec.get(ts_key)
-            if isinstance(val, str):
-                try:
-                    dt = datetime.strptime(val.split(" +")[0], "%Y-%m-%d %H:%M:%S")
-                    rec[ts_key] = dt
-                except Exception:
-                    rec[ts_key] = None
-            elif isinstance(val, (int, float)):
-                try:
-                    rec[ts_key] = datetime.fromtimestamp(val)
-                except Exception:
-                    rec[ts_key] = None
-    return records
+# -------- gzip -------- #
+# Drop-in replacements for the gzip module, fastest first. python-isal wraps Intel ISA-L and zlib-ng inflates with SIMD
+GZIP_BACKEND_PREFERENCE = (
+    ("isal", "isal.igzip"),
+    ("zlib_ng", "zlib_ng.gzip_ng"),
+    ("stdlib", "gzip")
+)
+
+def load_gzip_backend(name: str = GZIP_BACKEND):
+    for backend_name, module_name in GZIP_BACKEND_PREFERENCE:
+        if name not in ("auto", backend_name):
+            continue
+        try:
+            return backend_name, importlib.import_module(module_name)
+        except ImportError:
+            if name != "auto":
+                raise
+    raise ValueError(f"Unknown gzip backend {name}")
+
+gzip_backend_name, gzip_backend = load_gzip_backend()
+
+def gzip_member_offsets(content: bytes) -> List[int]:
+    # Magic bytes, deflate, no reserved flags and a known XFL. A lookalike inside compressed data is caught in decompress_gzip
+    offsets = []
+    offset = content.find(b"\x1f\x8b\x08")
+    while offset != -1:
+        if len(content) >= offset + 10 and not content[offset + 3] & 0xE0 and content[offset + 8] in (0, 2, 4):
+            offsets.append(offset)
+        offset = content.find(b"\x1f\x8b\x08", offset + 1)
+    return offsets
+
+def decompress_gzip(content: bytes, threads: int = DECOMPRESS_THREADS) -> bytes:
+    offsets = gzip_member_offsets(content) if threads > 1 else []
+    if len(offsets) < 2 or offsets[0] != 0:
+        return gzip_backend.decompress(content)
+
+    # Multi-member gzip: one member per thread, the backends release the GIL while inflating
+    members = [memoryview(content)[start:end] for start, end in zip(offsets, offsets[1:] + [len(content)])]
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return b"".join(executor.map(gzip_backend.decompress, members))
+    except (EOFError, OSError, zlib.error):
+        return gzip_backend.decompress(content)
+
+# -------- JSONL -------- #
+# Column types seen so far in this worker, reused as the explicit schema so every block and file gets the same types
+jsonl_schema = pq.read_schema(JSONL_SCHEMA_PATH) if JSONL_SCHEMA_PATH else None
+
+def jsonl_blocks(data: bytes, block_size: int = JSONL_BLOCK_SIZE):
+    view = memoryview(data)
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start + block_size)
+        end = len(data) if end == -1 else end + 1
+        yield view[start:end]
+        start = end
+
+def read_jsonl_block(block, schema=None) -> pa.Table:
+    parse_options = pa_json.ParseOptions(explicit_schema=schema, unexpected_field_behavior="infer") if schema is not None else None
+    return pa_json.read_json(pa.BufferReader(pa.py_buffer(block)), parse_options=parse_options)
+
+def parse_jsonl_block(block) -> Tuple[List[pa.Table], int]:
+    global jsonl_schema
+
+    # The cached schema first, then plain inference in case this block disagrees with the cached types
+    for schema in ((jsonl_schema, None) if jsonl_schema is not None else (None,)):
+        try:
+            table = read_jsonl_block(block, schema)
+        except pa.ArrowInvalid:
+            continue
+        try:
+            jsonl_schema = table.schema if jsonl_schema is None else pa.unify_schemas([jsonl_schema, table.schema])
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        return [table], 0
+
+    # Bisect on line boundaries until the lines that do not parse are isolated
+    middle = bytes(block).find(b"\n", len(block) // 2)
+    if middle == -1 or middle + 1 >= len(block):
+        middle = bytes(block).rfind(b"\n", 0, len(block) // 2)
+    if middle == -1:
+        return [], 1 if bytes(block).strip() else 0
+
+    left_tables, left_bad = parse_jsonl_block(block[:middle + 1])
+    right_tables, right_bad = parse_jsonl_block(block[middle + 1:])
+    return left_tables + right_tables, left_bad + right_bad
+
+def concat_jsonl_tables(tables: List[pa.Table]) -> pa.Table:
+    try:
+        return pa.concat_tables(tables, promote_options="permissive")
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+
+    # Widened the way the schema registry widens: a field holding numbers in one file and strings in another is kept as strings
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types[field.name] = widen_type(types[field.name], field.type) if field.name in types else field.type
+    tables = [
+        pa.Table.from_arrays([cast_column(table[name], types[name]) for name in table.column_names], names=table.column_names)
+        for table in tables
+    ]
+    return pa.concat_tables(tables, promote_options="permissive")
+
+def parse_and_flatten_jsonl(content: bytes) -> Tuple[pa.Table, int]:
+    """Reads a .jsonl.gz body straight into an Arrow table, returns it with the number of lines that were not valid JSON"""
+    tables = []
+    bad_lines = 0
+    for block in jsonl_blocks(decompress_gzip(content)):
+        block_tables, block_bad_lines = parse_jsonl_block(block)
+        tables.extend(block_tables)
+        bad_lines += block_bad_lines
+
+    if not tables:
+        return pa.table({}), bad_lines
+    return concat_jsonl_tables(tables), bad_lines
+
+# -------- schema registry -------- #
+# Canonical schema of the processed events, loaded before the pool forks so every worker conforms to the same version
+schema_registry = SchemaRegistry()
+
+def use_schema_registry(registry: SchemaRegistry):
+    """
+    Makes the registry the one records are conformed to and, unless JSONL_SCHEMA_PATH is set, seeds the JSON reader
+    with its types. String fields are left to inference as the reader will not take a number for a string, and the
+    timestamps are parsed by convert_timestamps
+    """
+    global schema_registry, jsonl_schema
+    schema_registry = registry
+    if JSONL_SCHEMA_PATH or not len(registry.schema):
+        return
+    jsonl_schema = pa.schema([
+        field for field in registry.schema
+        if field.name not in TIMESTAMP_FIELDS and not pa.types.is_string(field.type) and not pa.types.is_null(field.type)
+    ])
+
+# Fields convert_timestamps parses into timestamp[us]
+TIMESTAMP_FIELDS = ("backend_timestamp", "device_timestamp")
+# Epoch seconds that fit a datetime (years 1 through 9999), anything outside becomes null as fromtimestamp would fail
+MIN_EPOCH_SECONDS = -62135596800
+MAX_EPOCH_SECONDS = 253402300799
+
+def epoch_to_timestamp(seconds: pa.ChunkedArray) -> pa.ChunkedArray:
+    seconds = seconds.cast(pa.float64())
+    in_range = pc.and_(pc.greater_equal(seconds, MIN_EPOCH_SECONDS), pc.less_equal(seconds, MAX_EPOCH_SECONDS))
+    micros = pc.round(pc.multiply(pc.if_else(in_range, seconds, None), 1_000_000))
+    return micros.cast(pa.int64()).cast(pa.timestamp("us"))
+
+def string_to_timestamp(values: pa.ChunkedArray) -> pa.ChunkedArray:
+    # "2024-01-01 10:00:00 +0000", anything after " +" is dropped as the offset is always zero
+    parsed = pc.strptime(
+        pc.replace_substring_regex(values, pattern=r" \+.*$", replacement=""),
+        format="%Y-%m-%d %H:%M:%S",
+        unit="us",
+        error_is_null=True
+    )
+    # Epoch seconds end up as strings when the field type differed between files
+    is_epoch = pc.match_substring_regex(values, pattern=r"^-?[0-9]+(\.[0-9]+)?$")
+    if not pc.any(is_epoch).as_py():
+        return parsed
+    epochs = epoch_to_timestamp(pc.if_else(is_epoch, values, None))
+    return pc.if_else(is_epoch, epochs, parsed)
+
+def to_timestamp(values: pa.ChunkedArray) -> pa.ChunkedArray:
+    if pa.types.is_timestamp(values.type):
+        return values.cast(pa.timestamp("us"))
+    if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+        return string_to_timestamp(values)
+    if pa.types.is_integer(values.type) or pa.types.is_floating(values.type):
+        return epoch_to_timestamp(values)
+    return pa.nulls(len(values), type=pa.timestamp("us"))
+
+def convert_timestamps(table: pa.Table) -> pa.Table:
+    """Parses string and epoch backend/device timestamps into UTC timestamp[us] columns, unparseable values become null"""
+    for ts_key in TIMESTAMP_FIELDS:
+        if ts_key in table.column_names:
+            table = table.set_column(
+                table.schema.get_field_index(ts_key),
+                ts_key,
+                to_timestamp(table[ts_key])
+            )
+    return table
+
+def partition_by_hour(table: pa.Table, row_sources: pa.Array):
+    """
+    Yields (hour, rows of that hour, the distinct row_sources of those rows) for every hour with a backend_timestamp,
+    rows without one are left out
+    """
+    hours = pa.table({
+        "hour": pc.floor_temporal(table["backend_timestamp"], unit="hour"),
+        "row": pa.array(range(table.num_rows), type=pa.int64()),
+        "source": row_sources
+    })
+    groups = hours.filter(pc.is_valid(hours["hour"])).group_by("hour", use_threads=False).aggregate([("row", "list"), ("source", "distinct")])
+    for hour, rows, sources in zip(groups["hour"].to_pylist(), groups["row_list"], groups["source_distinct"].to_pylist()):
+        yield hour, table.take(rows.values), sources
 
 def determine_partition_path(base_prefix: str, timestamp: datetime) -> str:
     return (
@@ -87,80 +310,419 @@ def determine_partition_path(base_prefix: str, timestamp: datetime) -> str:
         f"year={timestamp.year}/month={timestamp.month}/day={timestamp.day}/hour={timestamp.hour}/"
     )
 
-def process_file_batch(batch_keys: List[str], delete_after: bool = False):
-    partitioned_records = defaultdict(list)
-    total_bytes = 0
+# -------- partition buffer -------- #
+def open_partition_sink(partition_path: str) -> ParquetSink:
+    return open_parquet_sink(s3, S3_OUTPUT_BUCKET, f"{partition_path}part-{random_suffix()}.parquet.zstd", OUTPUT_LOCAL_DIR)
+
+def conform_to_registry(tables: List[pa.Table]) -> List[pa.Table]:
+    return schema_registry.conform_tables(tables)
+
+# Hourly partitions of this process, filled across work units so each hour gets a few large files instead of one per unit.
+# Pending records take the registry's current schema, so a partition only starts a new file for a field with values
+partition_buffer = PartitionBuffer(
+    open_partition_sink,
+    conform=conform_to_registry,
+    compression="zstd",
+    use_deprecated_int96_timestamps=False,
+    coerce_timestamps="us"
+)
+
+def delete_input_keys(keys: List[str]):
+    for key in keys:
+        try:
+            s3.delete_object(Bucket=CB_EVENTS_S3_BUCKET_NAME, Key=key)
+            logger.info(f"Deleted {key} after processing.")
+        except Exception as e:
+            logger.warning(f"Failed to delete {key}: {e}")
+
+def handle_partition_results(results: List[dict], delete_after: bool = False) -> Tuple[int, int, List[str], List[str]]:
+    """
+    Logs the partition files committed, deletes the inputs whose records are all committed and returns (written, failed,
+    the inputs whose records are all committed, the inputs with records in a file that failed)
+    """
+    written = 0
+    for result in results:
+        if result["error"] is None:
+            logger.info(f"Wrote {result['rows']} records to {result['name']}")
+            written += 1
+        else:
+            logger.error(f"Failed to write partition {result['partition']}: {result['error']}")
+
+    released, failed = partition_buffer.take_released()
+    if delete_after:
+        delete_input_keys(released)
+    if failed:
+        # Kept so the next run picks them up again
+        logger.warning(f"Keeping {len(failed)} input files with records in a partition file that failed to write.")
+
+    return written, len(results) - written, released, failed
+
+def flush_partition_buffer(delete_after: bool = False):
+    """Commits every buffered partition, runs when a worker process exits"""
+    results = partition_buffer.flush_all()
+    if results:
+        logger.info(f"Flushing {len(results)} buffered partition files.")
+        handle_partition_results(results, delete_after)
+
+# -------- prefetch -------- #
+def fetch_object(key: str) -> bytes:
+    return s3.get_object(Bucket=CB_EVENTS_S3_BUCKET_NAME, Key=key)["Body"].read()
+
+def prefetch_objects(batch: List[Tuple[str, int]], max_in_flight: int = PREFETCH_OBJECTS, max_bytes: int = PREFETCH_BYTES):
+    """
+    Yields (key, size, future of the body) in batch order while the next GETs run on background threads, so the
+    network stays busy while the caller parses. Closing the generator cancels the GETs that have not started
+    """
+    fetcher = ThreadPoolExecutor(max(int(max_in_flight), 1))
+    in_flight = deque()
+    in_flight_bytes = 0
+    position = 0
+    try:
+        while in_flight or position < len(batch):
+            while position < len(batch) and len(in_flight) < max_in_flight and (not in_flight or in_flight_bytes + batch[position][1] <= max_bytes):
+                key, size = batch[position]
+                in_flight.append((key, size, fetcher.submit(fetch_object, key)))
+                in_flight_bytes += size
+                position += 1
+
+            key, size, fetched = in_flight.popleft()
+            in_flight_bytes -= size
+            yield key, size, fetched
+    finally:
+        fetcher.shutdown(wait=True, cancel_futures=True)
+
+# -------- scheduling -------- #
+def plan_work_units(
+    objects: List[Tuple[str, int]],
+    max_bytes: int = MAX_BYTES,
+    max_files: int = FILES_PER_BATCH,
+    workers: int = cpu_count()
+) -> List[List[Tuple[str, int]]]:
+    """
+    Packs (key, compressed size) pairs into work units of even size, largest files first onto the lightest unit.
+    There are enough units to keep every worker busy and to stay within max_bytes and max_files per unit
+    """
+    if not objects:
+        return []
+
+    total_bytes = sum(size for _, size in objects)
+    unit_count = max(
+        math.ceil(total_bytes / max(int(max_bytes), 1)),
+        math.ceil(len(objects) / int(max_files)),
+        min(workers, len(objects))
+    )
+
+    units = [[] for _ in range(unit_count)]
+    lightest = [(0, index) for index in range(unit_count)]
+    for key, size in sorted(objects, key=lambda obj: obj[1], reverse=True):
+        unit_bytes, index = heapq.heappop(lightest)
+        units[index].append((key, size))
+        if len(units[index]) < int(max_files):
+            heapq.heappush(lightest, (unit_bytes + size, index))
+
+    return [unit for unit in units if unit]
+
+def empty_unit_stats() -> dict:
+    return {
+        "files": 0,
+        "records": 0,
+        "bytes": 0,
+        "partitions": 0,
+        "failures": 0,
+        "bad_lines": 0,
+        "skipped": 0,
+        "seconds": 0.0,
+        "leftover": [],
+        "failed": [],
+        "buffered": [],
+        "settled": [],
+        "uncommitted": []
+    }
+
+def process_file_batch(
+    batch: List[Tuple[str, int]],
+    delete_after: bool = False,
+    claims=None,
+    shared_registry: SharedSchemaRegistry = None
+) -> dict:
+    """
+    Processes the files of one work unit until its record or byte budget is used up and returns the unit's stats,
+    including the files left over for requeueing and the files that could not be read. With a shared claims dict,
+    files another unit already started on are skipped, so a straggler's files can be handed to a second unit safely.
+    Every file is conformed to the schema registry, kept in step with the other workers through shared_registry
+    """
+    started = time.perf_counter()
+    stats = empty_unit_stats()
+    claim = random_suffix()
+    tables = []
+    table_keys = []
     processed_keys = []
 
-    for key in batch_keys:
-        obj = s3.get_object(Bucket=CB_EVENTS_S3_BUCKET_NAME, Key=key)
-        body = obj["Body"].read()
-        total_bytes += len(body)
+    objects = prefetch_objects(batch)
+    for position, (key, size, fetched) in enumerate(objects):
+        if claims is not None and claims.setdefault(key, claim) != claim:
+            stats["skipped"] += 1
+            continue
 
-        records = parse_and_flatten_jsonl(body)
-        records = convert_timestamps(records)
+        try:
+            body = fetched.result()
+            table, bad_lines = parse_and_flatten_jsonl(body)
+            if shared_registry is not None:
+                shared_registry.pull(schema_registry)
+            table = schema_registry.conform(convert_timestamps(table))
+            if shared_registry is not None:
+                shared_registry.publish(schema_registry)
+        except Exception as e:
+            logger.error(f"Failed to read {key}: {e}")
+            stats["failures"] += 1
+            stats["failed"].append((key, size))
+            continue
 
-        for rec in records:
-            ts = rec.get("backend_timestamp")
-            if isinstance(ts, datetime):
-                # Round to the hour
-                hour_ts = datetime(ts.year, ts.month, ts.day, ts.hour)
-                partitioned_records[hour_ts].append(rec)
+        if bad_lines:
+            logger.warning(f"Skipped {bad_lines} malformed lines in {key}")
+        if table.num_rows:
+            tables.append(table)
+            table_keys.append(key)
+        stats["files"] += 1
+        stats["bytes"] += len(body)
+        stats["records"] += table.num_rows
+        stats["bad_lines"] += bad_lines
 
         processed_keys.append(key)
 
-        if len(processed_keys) >= MAX_RECORDS or total_bytes >= MAX_BYTES:
+        # At least one file is always processed, so requeued work keeps shrinking
+        if stats["records"] >= MAX_RECORDS or stats["bytes"] >= MAX_BYTES:
+            stats["leftover"] = batch[position + 1:]
             break
 
-    if not partitioned_records:
+    # Drops the GETs still queued for the leftover files
+    objects.close()
+
+    hourly_partitions = []
+    if tables:
+        # Another worker or a later file may have widened a type the earlier files were conformed to
+        if shared_registry is not None:
+            shared_registry.pull(schema_registry)
+        tables = schema_registry.conform_tables(tables)
+        if shared_registry is not None:
+            shared_registry.publish(schema_registry)
+        table = pa.concat_tables(tables)
+        if "backend_timestamp" in table.column_names:
+            row_sources = pa.concat_arrays([
+                pa.repeat(pa.scalar(index, type=pa.int32()), source_table.num_rows)
+                for index, source_table in enumerate(tables)
+            ])
+            hourly_partitions = list(partition_by_hour(table, row_sources))
+
+    if processed_keys and not hourly_partitions:
         logger.warning("No valid records with timestamps found.")
-        return
 
-    for hour, records in partitioned_records.items():
+    unit_partitions = []
+    partitioned_keys = set()
+    for hour, records, sources in hourly_partitions:
+        source_keys = [table_keys[index] for index in sources]
+        partitioned_keys.update(source_keys)
+        unit_partitions.append((determine_partition_path(OUTPUT_PREFIX, hour), records, source_keys))
+    results = partition_buffer.append_all(unit_partitions)
+    results.extend(partition_buffer.flush_idle())
+    written, failed, released, uncommitted = handle_partition_results(results, delete_after)
+    stats["partitions"] += written
+    stats["failures"] += failed
+    stats["buffered"] = sorted(partitioned_keys)
+    stats["settled"] = released + uncommitted
+    stats["uncommitted"] = uncommitted
+
+    # Files without a single record to write have nothing left to wait for
+    if delete_after:
+        delete_input_keys([key for key in processed_keys if key not in partitioned_keys])
+
+    if stats["leftover"]:
+        logger.info(f"Work unit budget reached after {len(processed_keys)} files, requeueing {len(stats['leftover'])} files.")
+
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+def flush_worker(barrier=None, delete_after: bool = False) -> dict:
+    """
+    Commits every partition this worker still buffers and returns the stats like a work unit does. Every worker runs
+    one before the pool shuts down, the barrier keeps a worker that is done from taking a second one
+    """
+    started = time.perf_counter()
+    stats = empty_unit_stats()
+    written, failed, released, uncommitted = handle_partition_results(partition_buffer.flush_all(), delete_after)
+    stats.update({"partitions": written, "failures": failed, "settled": released + uncommitted, "uncommitted": uncommitted})
+    if barrier is not None:
         try:
-            table = pa.Table.from_pylist(records)
-            for col in ("backend_timestamp", "device_timestamp"):
-                if col in table.column_names:
-                    table = table.set_column(
-                        table.schema.get_field_index(col),
-                        col,
-                        table[col].cast(pa.timestamp("us"))
-                    )
+            barrier.wait(FLUSH_BARRIER_SECONDS)
+        except threading.BrokenBarrierError:
+            logger.warning("Not every worker took its final flush, the rest commit their partitions as they exit.")
 
-            partition_path = determine_partition_path(OUTPUT_PREFIX, hour)
-            filename = f"{partition_path}part-{random_suffix()}.parquet.zstd"
+    stats["seconds"] = time.perf_counter() - started
+    return stats
 
-            out_buffer = io.BytesIO()
-            pq.write_table(
-                table,
-                out_buffer,
-                compression="zstd",
-                use_deprecated_int96_timestamps=False,
-                coerce_timestamps="us"
-            )
+def create_worker_pool(workers: int, delete_after: bool = False) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(workers, initializer=init_worker, initargs=(delete_after,))
 
-            s3.put_object(
-                Bucket=S3_OUTPUT_BUCKET,
-                Key=filename,
-                Body=out_buffer.getvalue()
-            )
-            logger.info(f"Wrote {len(records)} records to {filename}")
+def batch_process(keys: List[Tuple[str, int]], delete_after: bool = False, batch_size=FILES_PER_BATCH) -> List[dict]:
+    """
+    Runs the work units on a process pool from a shared queue, every worker takes the next unit as soon as it is free.
+    Leftover files are requeued as new units, unreadable files are retried up to UNIT_RETRIES times and units that run
+    far longer than the median are reported, and with STRAGGLER_SPLIT their unstarted files are handed to new units.
+    A pool broken by a worker that died is replaced, the units it took down are retried and the files whose records its
+    workers still buffered are requeued. Once the queue is empty every worker commits what it buffers in a final flush,
+    reported like a unit, and the files with records in a partition file that failed are retried like unreadable ones.
+    The workers share the fields and types they register as they go, stored as the next schema registry version once
+    the pool is done
+    """
+    use_schema_registry(load_schema_registry(s3, S3_OUTPUT_BUCKET, local_dir=OUTPUT_LOCAL_DIR))
+    workers = cpu_count()
+    unit_bytes = MAX_BYTES
+    queue = deque(plan_work_units(keys, unit_bytes, batch_size, workers * UNITS_PER_WORKER))
+    logger.info(f"Planned {len(queue)} work units for {workers} workers.")
 
-        except Exception as e:
-            logger.error(f"Failed to write partition {hour}: {e}")
+    running = {}
+    unit_stats = []
+    retries = defaultdict(int)
+    next_unit = 0
+    sizes = dict(keys)
+    # Input files whose records the workers of each pool generation still buffer, and the generations that broke
+    generation = 0
+    buffered = defaultdict(set)
+    broken = set()
+    # Stats of the final flushes, and whether units ran since the last ones
+    flush_stats = []
+    unflushed = False
 
-    if delete_after:
-        for key in processed_keys:
+    with Manager() as manager:
+        claims = manager.dict()
+        shared_registry = SharedSchemaRegistry(manager, schema_registry)
+        pool = create_worker_pool(workers, delete_after)
+
+        def submit(task_function, *args):
+            nonlocal pool, generation
             try:
-                s3.delete_object(Bucket=CB_EVENTS_S3_BUCKET_NAME, Key=key)
-                logger.info(f"Deleted {key} after processing.")
-            except Exception as e:
-                logger.warning(f"Failed to delete {key}: {e}")
+                return pool.submit(task_function, *args)
+            except BrokenProcessPool:
+                # The units of the dead worker fail below and their files are retried on the new pool
+                broken.add(generation)
+                generation += 1
+                logger.warning("The process pool broke, a worker most likely ran out of memory. Starting a new pool.")
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = create_worker_pool(workers, delete_after)
+                return pool.submit(task_function, *args)
+
+        try:
+            while queue or running or unflushed:
+                if not queue and not running:
+                    # Commits what the workers buffer while failed files can still be retried, one flush per worker
+                    barrier = manager.Barrier(workers)
+                    for _ in range(workers):
+                        future = submit(flush_worker, barrier, delete_after)
+                        # Flushes are never reported as stragglers
+                        running[future] = {"unit": None, "batch": [], "started": time.perf_counter(), "straggler": True, "pool": generation}
+                    unflushed = False
+
+                # Only as many units as workers are in flight, so a unit's run time starts when it is submitted
+                while queue and len(running) < workers:
+                    unit = queue.popleft()
+                    future = submit(process_file_batch, unit, delete_after, claims, shared_registry)
+                    running[future] = {"unit": next_unit, "batch": unit, "started": time.perf_counter(), "straggler": False, "pool": generation}
+                    next_unit += 1
+
+                done, _ = wait(running, timeout=STRAGGLER_CHECK_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    name = "Final flush" if task["unit"] is None else f"Work unit {task['unit']}"
+                    try:
+                        stats = future.result()
+                    except Exception as e:
+                        logger.error(f"{name} failed: {e}")
+                        stats = empty_unit_stats()
+                        stats.update({"failures": len(task["batch"]), "failed": task["batch"], "seconds": time.perf_counter() - task["started"]})
+                        if isinstance(e, BrokenProcessPool):
+                            broken.add(task["pool"])
+                    stats["unit"] = task["unit"]
+                    if task["unit"] is None:
+                        flush_stats.append(stats)
+                        if stats["partitions"] or stats["failures"]:
+                            logger.info(f"{name}: {stats['partitions']} partitions, {stats['failures']} failures in {stats['seconds']:.1f}s.")
+                    else:
+                        unit_stats.append(stats)
+                        unflushed = True
+                        logger.info(
+                            f"{name}: {stats['files']} files, {stats['records']} records, {stats['bytes']} bytes, "
+                            f"{stats['partitions']} partitions, {stats['failures']} failures in {stats['seconds']:.1f}s."
+                        )
+
+                    failed = stats.pop("failed") + [(key, sizes[key]) for key in stats.pop("uncommitted")]
+                    retry = [obj for obj in failed if retries[obj[0]] < UNIT_RETRIES]
+                    for key, _ in retry:
+                        retries[key] += 1
+                        claims.pop(key, None)
+                    if retry:
+                        queue.append(retry)
+                        logger.info(f"Retrying {len(retry)} files of {name.lower()} that could not be read or written.")
+
+                    buffered[task["pool"]].update(stats.pop("buffered"))
+                    buffered[task["pool"]].difference_update(stats.pop("settled"))
+
+                    leftover = stats.pop("leftover")
+                    if leftover:
+                        # Size the requeued units by the compressed bytes per record actually seen, so they fit MAX_RECORDS
+                        records = sum(completed["records"] for completed in unit_stats)
+                        if records:
+                            bytes_per_record = sum(completed["bytes"] for completed in unit_stats) / records
+                            unit_bytes = min(MAX_BYTES, max(int(MAX_RECORDS * bytes_per_record), 1))
+                        requeued = plan_work_units(leftover, unit_bytes, batch_size, 1)
+                        queue.extend(requeued)
+                        logger.info(f"Requeued {len(leftover)} files as {len(requeued)} work units of up to {unit_bytes} bytes.")
+
+                # A broken pool takes down every worker, with the partitions they buffered for units that had succeeded
+                lost = sorted(key for broken_generation in broken for key in buffered.pop(broken_generation, ()))
+                if lost:
+                    for key in lost:
+                        claims.pop(key, None)
+                    requeued = plan_work_units([(key, sizes[key]) for key in lost], unit_bytes, batch_size, 1)
+                    queue.extend(requeued)
+                    logger.warning(f"Requeued {len(lost)} files whose records died with the workers of a broken pool as {len(requeued)} work units.")
+
+                completed_seconds = sorted(completed["seconds"] for completed in unit_stats)
+                if len(completed_seconds) < STRAGGLER_MIN_UNITS:
+                    continue
+                median_seconds = completed_seconds[len(completed_seconds) // 2]
+                for task in running.values():
+                    elapsed = time.perf_counter() - task["started"]
+                    if task["straggler"] or elapsed < STRAGGLER_FACTOR * median_seconds:
+                        continue
+                    task["straggler"] = True
+                    unstarted = [obj for obj in task["batch"] if obj[0] not in claims]
+                    logger.warning(
+                        f"Work unit {task['unit']} is a straggler: running {elapsed:.0f}s against a median of {median_seconds:.1f}s, "
+                        f"{len(unstarted)} of its {len(task['batch'])} files not started."
+                    )
+                    if STRAGGLER_SPLIT and unstarted:
+                        split = [unstarted[i::2] for i in range(2) if unstarted[i::2]]
+                        queue.extendleft(split)
+                        logger.info(f"Split {len(unstarted)} files of straggler unit {task['unit']} into {len(split)} new work units.")
+        finally:
+            # Waits for the workers to exit, which commits anything a worker buffers without having run its final flush
+            pool.shutdown()
+        schema_registry.merge(shared_registry.registry())
+
+    # Only has partitions when process_file_batch ran in this process
+    flush_partition_buffer(delete_after)
+    save_schema_registry(schema_registry, s3, S3_OUTPUT_BUCKET, local_dir=OUTPUT_LOCAL_DIR)
+
+    totals = {name: sum(stats[name] for stats in unit_stats + flush_stats) for name in ("files", "records", "bytes", "partitions", "failures")}
+    logger.info(
+        f"Processed {totals['files']} files, {totals['records']} records and {totals['bytes']} bytes in {len(unit_stats)} work units, "
+        f"committed {totals['partitions']} partition files with {totals['failures']} failures."
+    )
+    if unit_stats:
+        slowest = max(unit_stats, key=lambda stats: stats["seconds"])
+        logger.info(f"Slowest work unit {slowest['unit']} took {slowest['seconds']:.1f}s for {slowest['files']} files and {slowest['bytes']} bytes.")
 
-def batch_process(keys: List[str], delete_after: bool = False, batch_size=FILES_PER_BATCH):
-    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
-    with Pool(cpu_count()) as pool:
-        pool.starmap(process_file_batch, [(batch, delete_after) for batch in batches])
+    return unit_stats
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -169,9 +731,10 @@ if __name__ == "__main__":
 
     keys = list_s3_keys(INPUT_PREFIX)
     totalKeys = len(keys)
-    totalBatches = totalKeys / FILES_PER_BATCH
+    totalBytes = sum(size for _, size in keys)
 
-    logger.info(f"Discovered {totalKeys} files for processing across {totalBatches} batches.")
+    logger.info(f"Decompressing with the {gzip_backend_name} gzip backend.")
+    logger.info(f"Discovered {totalKeys} files ({totalBytes} bytes) for processing.")
     batch_process(keys, delete_after=args.delete)
 
 # EOF
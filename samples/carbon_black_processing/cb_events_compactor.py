@@ -6,6 +6,8 @@ from datetime import datetime, timedelta, timezone, UTC
 import pyarrow.parquet as pq
 import pyarrow as pa
 import io
+from cb_parquet_sink import MULTIPART_CONCURRENCY, open_parquet_sink, write_parquet
+from cb_schema_registry import SchemaRegistry, load_schema_registry, save_schema_registry
 
 # -------- LOGGING -------- #
 logging.basicConfig(
@@ -25,7 +27,9 @@ botocore_retry_config = Config(
     retries={
         "max_attempts": 15,
         "mode": "adaptive"
-    }
+    },
+    # Room for the concurrent multipart upload parts
+    max_pool_connections=max(10, MULTIPART_CONCURRENCY)
 )
 
 s3 = boto3.client("s3", config=botocore_retry_config)
@@ -72,34 +76,14 @@ def download_parquet_to_table(bucket: str, key: str):
     response = s3.get_object(Bucket=bucket, Key=key)
     return pq.read_table(source=io.BytesIO(response["Body"].read()))
 
-def align_tables_to_superset(tables: list[pa.Table]) -> list[pa.Table]:
-    all_fields = {}
-    for table in tables:
-        for field in table.schema:
-            all_fields[field.name] = field.type
-
-    # Alphabetical order of fields
-    sorted_fields = sorted(all_fields.items(), key=lambda x: x[0])
-    superset_schema = pa.schema(sorted_fields)
-
-    aligned_tables = []
-    for table in tables:
-        columns = {}
-        for field in superset_schema:
-            if field.name in table.column_names:
-                columns[field.name] = table[field.name]
-            else:
-                columns[field.name] = pa.nulls(table.num_rows, type=field.type)
-        aligned_table = pa.table(columns, schema=superset_schema)
-        aligned_tables.append(aligned_table)
-
-    return aligned_tables
+def combine_tables(tables: list[pa.Table], schema_registry: SchemaRegistry) -> pa.Table:
+    """Conforms every file to the registered schema, files already written with it are concatenated without a copy"""
+    return pa.concat_tables(schema_registry.conform_tables(tables))
 
 def write_compacted_table(bucket: str, prefix: str, table: pa.Table, index: int):
-    out_buffer = io.BytesIO()
-    pq.write_table(table, out_buffer, compression="zstd")
     compacted_key = f"{prefix}compacted-part-{index:03}.parquet.zstd"
-    s3.put_object(Bucket=bucket, Key=compacted_key, Body=out_buffer.getvalue())
+    # Streams into a multipart upload, a failed write aborts it instead of leaving a partial object
+    write_parquet(table, open_parquet_sink(s3, bucket, compacted_key), compression="zstd")
     logger.info(
         "Wrote %s with %s rows",
         compacted_key, table.num_rows
@@ -115,7 +99,7 @@ def delete_keys(bucket: str, keys: list):
         len(keys)
     )
 
-def compact_partition(bucket: str, prefix: str):
+def compact_partition(bucket: str, prefix: str, schema_registry: SchemaRegistry):
     keys = list_parquet_files(bucket, prefix)
     if len(keys) < 2:
         return
@@ -140,8 +124,7 @@ def compact_partition(bucket: str, prefix: str):
 
         if current_bytes >= MAX_UNCOMPRESSED_BYTES:
             try:
-                aligned = align_tables_to_superset(current_tables)
-                combined = pa.concat_tables(aligned)
+                combined = combine_tables(current_tables, schema_registry)
                 write_compacted_table(bucket, prefix, combined, batch_index)
                 batch_index += 1
             except Exception as err:
@@ -154,8 +137,7 @@ def compact_partition(bucket: str, prefix: str):
 
     if current_tables:
         try:
-            aligned = align_tables_to_superset(current_tables)
-            combined = pa.concat_tables(aligned)
+            combined = combine_tables(current_tables, schema_registry)
             write_compacted_table(bucket, prefix, combined, batch_index)
         except Exception as err:
             logger.error(
@@ -167,10 +149,14 @@ def compact_partition(bucket: str, prefix: str):
 
 def main():
     hourly_prefixes = list_hourly_partition_prefixes(CB_EVENTS_S3_BUCKET_NAME, OUTPUT_PREFIX)
+    schema_registry = load_schema_registry(s3, CB_EVENTS_S3_BUCKET_NAME)
 
     logger.info("Found %s hourly partitions.", len(hourly_prefixes))
     for prefix in hourly_prefixes:
-        compact_partition(CB_EVENTS_S3_BUCKET_NAME, prefix)
+        compact_partition(CB_EVENTS_S3_BUCKET_NAME, prefix, schema_registry)
+
+    # Files written before the registry existed may bring fields it has not seen yet
+    save_schema_registry(schema_registry, s3, CB_EVENTS_S3_BUCKET_NAME)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,413 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from os import getenv, makedirs, path, remove, replace
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import defaultdict, deque
+from typing import Callable, Iterable, List, Optional, Tuple
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# -------- CONFIGURATION -------- #
+# Bytes buffered before a part is uploaded, S3 rejects parts under 5 MiB except the last one
+MULTIPART_PART_BYTES: int = int(getenv("MULTIPART_PART_BYTES", 8 * 1024 * 1024))
+# Parts of one upload in flight at once, peak memory is about (MULTIPART_CONCURRENCY + 1) * MULTIPART_PART_BYTES
+MULTIPART_CONCURRENCY: int = int(getenv("MULTIPART_CONCURRENCY", 4))
+# A buffered partition file is committed once it reaches this many compressed bytes
+PARTITION_TARGET_BYTES: int = int(getenv("PARTITION_TARGET_BYTES", 128 * 1024 * 1024))
+# Records collected for a partition before they are written out as one row group
+PARTITION_ROW_GROUP_ROWS: int = int(getenv("PARTITION_ROW_GROUP_ROWS", 128 * 1024))
+# A partition nothing was appended to for this long is committed as it is
+PARTITION_IDLE_SECONDS: int = int(getenv("PARTITION_IDLE_SECONDS", 120))
+# Partition files open at once, the one appended to least recently is committed to make room
+PARTITION_MAX_OPEN: int = int(getenv("PARTITION_MAX_OPEN", 32))
+
+# -------- sinks -------- #
+class ParquetSink(ABC):
+    """
+    Write-only file object that ParquetWriter streams into. Leaving the with block commits the file,
+    leaving it on an exception aborts it so no partial file is ever visible
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes_written = 0
+        self.closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    @abstractmethod
+    def write(self, data) -> int:
+        """Takes the next bytes of the file, raises ValueError once the sink is closed"""
+
+    @abstractmethod
+    def close(self):
+        """Commits the file"""
+
+    @abstractmethod
+    def abort(self):
+        """Discards everything written, the file never becomes visible"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.closed:
+            return
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class S3MultipartSink(ParquetSink):
+    """Uploads the bytes written as S3 multipart upload parts on background threads, small files go out with one put_object"""
+
+    def __init__(self, s3, bucket: str, key: str, part_bytes: int = MULTIPART_PART_BYTES, concurrency: int = MULTIPART_CONCURRENCY):
+        super().__init__(key)
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = int(part_bytes)
+        self.concurrency = max(int(concurrency), 1)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.uploader = None
+        self.in_flight = deque()
+        self.parts = []
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError(f"Write to closed sink {self.name}")
+        self.buffer += data
+        self.bytes_written += len(data)
+        if len(self.buffer) >= self.part_bytes:
+            self.upload_buffer()
+        return len(data)
+
+    def upload_part(self, part_number: int, body: bytes) -> dict:
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def upload_buffer(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+            self.uploader = ThreadPoolExecutor(self.concurrency)
+
+        # Waiting for the oldest part keeps at most `concurrency` parts in memory besides the buffer
+        while len(self.in_flight) >= self.concurrency:
+            self.parts.append(self.in_flight.popleft().result())
+
+        part_number = len(self.parts) + len(self.in_flight) + 1
+        self.in_flight.append(self.uploader.submit(self.upload_part, part_number, bytes(self.buffer)))
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.upload_buffer()
+                self.parts.extend(future.result() for future in self.in_flight)
+                self.in_flight.clear()
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={"Parts": sorted(self.parts, key=lambda part: part["PartNumber"])}
+                )
+        except Exception:
+            self.abort()
+            raise
+        self.shutdown()
+
+    def abort(self):
+        if self.closed:
+            return
+        for future in self.in_flight:
+            future.cancel()
+        wait(self.in_flight)
+        self.in_flight.clear()
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                # A lifecycle rule for incomplete multipart uploads cleans up whatever is left
+                logger.warning("Failed to abort the multipart upload of %s: %s", self.key, e)
+        self.shutdown()
+
+    def shutdown(self):
+        self.buffer = bytearray()
+        if self.uploader is not None:
+            self.uploader.shutdown(wait=True)
+        self.closed = True
+
+class LocalFileSink(ParquetSink):
+    """Writes to a temporary file next to the target and renames it into place on close"""
+
+    def __init__(self, file_path: str):
+        super().__init__(file_path)
+        self.file_path = file_path
+        self.temp_path = f"{file_path}.inprogress"
+        makedirs(path.dirname(file_path) or ".", exist_ok=True)
+        self.file = open(self.temp_path, "wb")
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError(f"Write to closed sink {self.name}")
+        self.file.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.file.close()
+        replace(self.temp_path, self.file_path)
+        self.closed = True
+
+    def abort(self):
+        if self.closed:
+            return
+        self.file.close()
+        if path.exists(self.temp_path):
+            remove(self.temp_path)
+        self.closed = True
+
+# -------- partition buffer -------- #
+def conform_table(table: pa.Table, schema: pa.Schema) -> Optional[pa.Table]:
+    """
+    The table cast to the schema with missing columns as nulls, None when it has values in columns the schema lacks or
+    types that do not cast. Columns the schema lacks that only hold nulls are dropped, nothing is lost without them
+    """
+    if table.schema.equals(schema):
+        return table
+    if any(name not in schema.names and table[name].null_count < table.num_rows for name in table.column_names):
+        return None
+    try:
+        return pa.Table.from_arrays(
+            [
+                table[field.name].cast(field.type) if field.name in table.column_names else pa.nulls(table.num_rows, type=field.type)
+                for field in schema
+            ],
+            schema=schema
+        )
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return None
+
+class OpenPartition:
+    def __init__(self, name: str):
+        self.name = name
+        self.sink = None
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+        self.rows = 0
+        self.sources = set()
+        self.last_append = time.monotonic()
+
+class PartitionBuffer:
+    """
+    Collects the records of each partition across work units and writes them as row groups into one open file per
+    partition, committing it once it reaches target_bytes, goes idle_seconds without an append or is evicted.
+    Every file tracks the sources (input keys) of its records, take_released() hands back the sources whose records
+    are all in committed files, and the ones that ended up in a file that failed
+    """
+
+    def __init__(
+        self,
+        open_sink: Callable[[str], ParquetSink],
+        target_bytes: int = PARTITION_TARGET_BYTES,
+        row_group_rows: int = PARTITION_ROW_GROUP_ROWS,
+        idle_seconds: int = PARTITION_IDLE_SECONDS,
+        max_open: int = PARTITION_MAX_OPEN,
+        conform: Callable[[List[pa.Table]], List[pa.Table]] = None,
+        **writer_options
+    ):
+        self.open_sink = open_sink
+        # Brings the pending tables of a partition to one schema, such as the schema registry's current one
+        self.conform = conform
+        self.target_bytes = int(target_bytes)
+        self.row_group_rows = int(row_group_rows)
+        self.idle_seconds = idle_seconds
+        self.max_open = max(int(max_open), 1)
+        self.writer_options = writer_options
+        self.partitions = {}
+        self.open_files = defaultdict(int)
+        self.released = []
+        self.failed = set()
+
+    def append(self, name: str, table: pa.Table, sources: Iterable[str]) -> List[dict]:
+        """Buffers the records of one partition, returns the files committed to make room or because they are full"""
+        results = []
+        partition = self.partitions.get(name)
+        if partition is None:
+            if len(self.partitions) >= self.max_open:
+                oldest = min(self.partitions.values(), key=lambda open_partition: open_partition.last_append)
+                results.extend(self.commit(oldest))
+            partition = self.partitions[name] = OpenPartition(name)
+
+        self.add_sources(partition, sources)
+        partition.pending.append(table)
+        partition.pending_rows += table.num_rows
+        partition.last_append = time.monotonic()
+
+        if partition.pending_rows >= self.row_group_rows:
+            written, partition = self.write_pending(partition)
+            self.partitions[name] = partition
+            results.extend(written)
+        if partition.sink is not None and partition.sink.bytes_written >= self.target_bytes:
+            results.extend(self.commit(partition))
+
+        return results
+
+    def append_all(self, partitions: Iterable[Tuple[str, pa.Table, List[str]]]) -> List[dict]:
+        """
+        Buffers the (name, table, sources) partitions of one work unit. Their sources are held until every partition
+        took its records, so a partition evicted or committed in between never releases a source whose records for a
+        later partition are still to come
+        """
+        partitions = list(partitions)
+        held = {source for _, _, sources in partitions for source in sources}
+        for source in held:
+            self.open_files[source] += 1
+        try:
+            return [result for name, table, sources in partitions for result in self.append(name, table, sources)]
+        finally:
+            self.release(held, failed=False)
+
+    def add_sources(self, partition: OpenPartition, sources: Iterable[str]):
+        for source in sources:
+            if source not in partition.sources:
+                partition.sources.add(source)
+                self.open_files[source] += 1
+
+    def write_pending(self, partition: OpenPartition) -> Tuple[List[dict], OpenPartition]:
+        """
+        Writes the pending records as a row group. Records the open file's schema cannot take commit it and go
+        into a new file, which is returned as the partition's current file along with the results of committed files
+        """
+        results = []
+        if self.conform is not None:
+            tables = [pa.concat_tables(self.conform(partition.pending))]
+        else:
+            try:
+                tables = [pa.concat_tables(partition.pending, promote_options="permissive")]
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                tables = partition.pending
+        partition.pending = []
+        partition.pending_rows = 0
+
+        for table in tables:
+            if partition.writer is not None:
+                conformed = conform_table(table, partition.writer.schema)
+                if conformed is None:
+                    # The new file holds records of the same sources, they are only released once both files are committed
+                    following = OpenPartition(partition.name)
+                    self.add_sources(following, partition.sources)
+                    results.extend(self.close(partition))
+                    partition = following
+                else:
+                    table = conformed
+
+            try:
+                if partition.writer is None:
+                    partition.sink = self.open_sink(partition.name)
+                    partition.writer = pq.ParquetWriter(partition.sink, table.schema, **self.writer_options)
+                partition.writer.write_table(table)
+                partition.rows += table.num_rows
+            except Exception as e:
+                results.append(self.fail(partition, e))
+                partition = OpenPartition(partition.name)
+
+        return results, partition
+
+    def commit(self, partition: OpenPartition) -> List[dict]:
+        """Writes out the pending records and commits the partition's file, or files when the records needed a new one"""
+        if self.partitions.get(partition.name) is partition:
+            del self.partitions[partition.name]
+        results = []
+        if partition.pending:
+            results, partition = self.write_pending(partition)
+        return results + self.close(partition)
+
+    def close(self, partition: OpenPartition) -> List[dict]:
+        if partition.writer is None:
+            self.release(partition.sources, failed=False)
+            return []
+        try:
+            partition.writer.close()
+            partition.sink.close()
+        except Exception as e:
+            return [self.fail(partition, e)]
+
+        self.release(partition.sources, failed=False)
+        return [{"partition": partition.name, "name": partition.sink.name, "rows": partition.rows, "bytes": partition.sink.bytes_written, "error": None}]
+
+    def fail(self, partition: OpenPartition, error: Exception) -> dict:
+        if partition.sink is not None:
+            partition.sink.abort()
+        if partition.writer is not None:
+            try:
+                # The sink is already aborted, this only marks the writer closed
+                partition.writer.close()
+            except Exception:
+                pass
+        self.release(partition.sources, failed=True)
+        return {"partition": partition.name, "name": partition.sink.name if partition.sink else partition.name, "rows": partition.rows, "bytes": 0, "error": error}
+
+    def release(self, sources: Iterable[str], failed: bool):
+        for source in sources:
+            if failed:
+                self.failed.add(source)
+            self.open_files[source] -= 1
+            if self.open_files[source] <= 0:
+                del self.open_files[source]
+                self.released.append(source)
+
+    def flush_idle(self) -> List[dict]:
+        threshold = time.monotonic() - self.idle_seconds
+        return [result for partition in list(self.partitions.values()) if partition.last_append <= threshold for result in self.commit(partition)]
+
+    def flush_all(self) -> List[dict]:
+        return [result for partition in list(self.partitions.values()) for result in self.commit(partition)]
+
+    def take_released(self) -> Tuple[List[str], List[str]]:
+        """Sources whose records are all committed, and sources with records in a file that failed to commit"""
+        released = [source for source in self.released if source not in self.failed]
+        failed = [source for source in self.released if source in self.failed]
+        self.failed.difference_update(failed)
+        self.released = []
+        return released, failed
+
+def open_parquet_sink(s3, bucket: str, key: str, local_dir: str = None) -> ParquetSink:
+    """The S3 sink for the key, or with local_dir the same key below that directory"""
+    if local_dir:
+        return LocalFileSink(path.join(local_dir, key))
+    return S3MultipartSink(s3, bucket, key)
+
+def write_parquet(table: pa.Table, sink: ParquetSink, **writer_options) -> int:
+    """Streams the table into the sink row group by row group and commits it, returns the bytes written"""
+    with sink:
+        with pq.ParquetWriter(sink, table.schema, **writer_options) as writer:
+            writer.write_table(table)
+    return sink.bytes_written
+
+# EOF
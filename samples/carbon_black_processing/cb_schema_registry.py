@@ -0,0 +1,284 @@
+import json
+import logging
+from os import getenv, listdir, makedirs, path
+from typing import Dict, Iterable, List, Optional, Set
+import pyarrow as pa
+import pyarrow.compute as pc
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# -------- CONFIGURATION -------- #
+# Registry versions live under this prefix of the events bucket, outside the Parquet output so readers never pick them up
+SCHEMA_REGISTRY_PREFIX: str = getenv("SCHEMA_REGISTRY_PREFIX", "schema_registry/carbon_black_events/")
+# Field holding the Carbon Black event type, such as endpoint.event.procstart
+EVENT_TYPE_FIELD: str = getenv("EVENT_TYPE_FIELD", "type")
+# Attempts to store a new version when another run stored one first
+SCHEMA_REGISTRY_SAVE_ATTEMPTS = 5
+
+CAST_ERRORS = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError)
+
+# -------- registry -------- #
+def cast_column(column: pa.ChunkedArray, target: pa.DataType) -> pa.ChunkedArray:
+    """column.cast(target), except that structs, lists and maps, which Arrow cannot cast to string, become JSON text"""
+    if column.type == target:
+        return column
+    if pa.types.is_string(target) and pa.types.is_nested(column.type):
+        return pa.chunked_array(
+            [
+                pa.array([None if value is None else json.dumps(value, default=str) for value in chunk.to_pylist()], type=pa.string())
+                for chunk in column.chunks
+            ],
+            type=pa.string()
+        )
+    return column.cast(target)
+
+def castable(source: pa.DataType, target: pa.DataType) -> bool:
+    """Whether Arrow has a cast from source to target at all, values can still fail it"""
+    if source == target or (pa.types.is_string(target) and pa.types.is_nested(source)):
+        return True
+    try:
+        pa.array([], type=source).cast(target)
+        return True
+    except CAST_ERRORS:
+        return False
+
+def widen_type(registered: pa.DataType, seen: pa.DataType) -> pa.DataType:
+    """
+    The type both can be cast to: nulls take the other type, numbers widen and structs merge their fields,
+    anything else becomes string with nested values kept as JSON text
+    """
+    if pa.types.is_null(registered):
+        return seen
+    if pa.types.is_null(seen):
+        return registered
+    try:
+        widened = pa.unify_schemas(
+            [pa.schema([pa.field("field", registered)]), pa.schema([pa.field("field", seen)])],
+            promote_options="permissive"
+        ).field("field").type
+    except CAST_ERRORS:
+        return pa.string()
+    return widened if castable(registered, widened) and castable(seen, widened) else pa.string()
+
+class SchemaRegistry:
+    """
+    Canonical Arrow schema of the Carbon Black events, one field per name with its columns in alphabetical order,
+    plus the fields each event type has been seen with. conform() evolves it when records bring new fields, or
+    values the registered type cannot hold, and marks it changed so the caller stores the next version
+    """
+
+    def __init__(self, schema: pa.Schema = None, event_types: Dict[str, Iterable[str]] = None, version: int = 0):
+        self.schema = schema.remove_metadata() if schema is not None else pa.schema([])
+        self.event_types = {event_type: set(fields) for event_type, fields in (event_types or {}).items()}
+        self.version = version
+        self.changed = False
+
+    def event_schema(self, event_type: str) -> pa.Schema:
+        """Canonical fields of one event type"""
+        fields = self.event_types.get(event_type, set())
+        return pa.schema([field for field in self.schema if field.name in fields])
+
+    def register_fields(self, fields: Iterable[pa.Field]):
+        registered = {field.name: field.type for field in self.schema}
+        self.set_field_types({
+            field.name: field.type if field.name not in registered else widen_type(registered[field.name], field.type)
+            for field in fields
+        })
+
+    def set_field_types(self, types: Dict[str, pa.DataType]):
+        registered = {field.name: field.type for field in self.schema}
+        types = {name: field_type for name, field_type in types.items() if registered.get(name) != field_type}
+        if not types:
+            return
+        registered.update(types)
+        self.schema = pa.schema(sorted(registered.items()))
+        self.changed = True
+
+    def register_event_types(self, table: pa.Table, new_fields: Set[str]):
+        """Records which fields each event type carries, only worked out when the table brings new fields or event types"""
+        if EVENT_TYPE_FIELD not in table.column_names:
+            return
+        event_types = [event_type for event_type in pc.unique(table[EVENT_TYPE_FIELD]).to_pylist() if event_type is not None]
+        if not new_fields and all(event_type in self.event_types for event_type in event_types):
+            return
+
+        columns = [name for name in table.column_names if name != EVENT_TYPE_FIELD]
+        counts = table.group_by(EVENT_TYPE_FIELD).aggregate([(name, "count") for name in columns]).to_pylist()
+        for row in counts:
+            event_type = row[EVENT_TYPE_FIELD]
+            if event_type is None:
+                continue
+            fields = {EVENT_TYPE_FIELD} | {name for name in columns if row[f"{name}_count"]}
+            if not fields <= self.event_types.get(event_type, set()):
+                self.event_types.setdefault(event_type, set()).update(fields)
+                self.changed = True
+
+    def conform(self, table: pa.Table) -> pa.Table:
+        """
+        The table with the canonical schema: columns of the registered type are reused as they are, others are cast
+        and registered fields the table lacks become null columns. A field is only widened once the column was cast to
+        the new type, values that fail the cast widen it to string
+        """
+        new_fields = set()
+        widened = {}
+        columns = {}
+        for field in table.schema:
+            index = self.schema.get_field_index(field.name)
+            if index == -1:
+                new_fields.add(field.name)
+                widened[field.name] = field.type
+                columns[field.name] = table[field.name]
+                continue
+            registered = self.schema.field(index).type
+            try:
+                columns[field.name] = cast_column(table[field.name], registered)
+                continue
+            except CAST_ERRORS:
+                pass
+            target = widen_type(registered, field.type)
+            try:
+                columns[field.name] = cast_column(table[field.name], target)
+            except CAST_ERRORS:
+                target = pa.string()
+                columns[field.name] = cast_column(table[field.name], target)
+            widened[field.name] = target
+
+        self.set_field_types(widened)
+        self.register_event_types(table, new_fields)
+
+        return pa.Table.from_arrays(
+            [columns[field.name] if field.name in columns else pa.nulls(table.num_rows, type=field.type) for field in self.schema],
+            schema=self.schema
+        )
+
+    def conform_tables(self, tables: List[pa.Table]) -> List[pa.Table]:
+        """conform()s every table, the earlier ones again when a later one widened a type, so they all share one schema"""
+        tables = [self.conform(table) for table in tables]
+        while any(table.schema != self.schema for table in tables):
+            tables = [table if table.schema == self.schema else self.conform(table) for table in tables]
+        return tables
+
+    def merge(self, other: "SchemaRegistry"):
+        """Folds in the fields and event types another process registered"""
+        self.register_fields(other.schema)
+        for event_type, fields in other.event_types.items():
+            if not fields <= self.event_types.get(event_type, set()):
+                self.event_types.setdefault(event_type, set()).update(fields)
+                self.changed = True
+
+    def serialize(self) -> bytes:
+        metadata = {
+            "cb_schema_version": str(self.version),
+            "cb_event_types": json.dumps({event_type: sorted(fields) for event_type, fields in sorted(self.event_types.items())})
+        }
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, self.schema.with_metadata(metadata)) as writer:
+            writer.write_table(self.schema.empty_table())
+        return sink.getvalue().to_pybytes()
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> "SchemaRegistry":
+        schema = pa.ipc.open_file(pa.py_buffer(data)).schema
+        metadata = schema.metadata or {}
+        return cls(
+            schema,
+            json.loads(metadata.get(b"cb_event_types", b"{}")),
+            int(metadata.get(b"cb_schema_version", b"0"))
+        )
+
+class SharedSchemaRegistry:
+    """
+    Lets the processes of a pool evolve one registry together through a multiprocessing Manager: each process
+    conforms to its own copy, pulls what the others published before it conforms and publishes its changes right away
+    """
+
+    def __init__(self, manager, registry: SchemaRegistry):
+        self.state = manager.dict(stamp=0, data=registry.serialize())
+        self.lock = manager.Lock()
+        self.stamp = 0
+
+    def registry(self) -> SchemaRegistry:
+        return SchemaRegistry.deserialize(self.state["data"])
+
+    def pull(self, registry: SchemaRegistry):
+        """Merges what was published since the last pull, registry.changed keeps tracking only its own changes"""
+        stamp = self.state["stamp"]
+        if stamp == self.stamp:
+            return
+        changed = registry.changed
+        registry.merge(self.registry())
+        registry.changed = changed
+        self.stamp = stamp
+
+    def publish(self, registry: SchemaRegistry):
+        if not registry.changed:
+            return
+        with self.lock:
+            self.pull(registry)
+            self.stamp = self.state["stamp"] + 1
+            self.state.update(stamp=self.stamp, data=registry.serialize())
+        registry.changed = False
+
+# -------- storage -------- #
+def version_name(version: int) -> str:
+    return f"v{version:06}.arrow"
+
+def latest_version_name(s3, bucket: str, prefix: str, local_dir: str = None) -> Optional[str]:
+    if local_dir:
+        directory = path.join(local_dir, prefix)
+        names = listdir(directory) if path.isdir(directory) else []
+    else:
+        names = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            names.extend(obj["Key"][len(prefix):] for obj in page.get("Contents", []))
+    versions = sorted(name for name in names if name.startswith("v") and name.endswith(".arrow"))
+    return versions[-1] if versions else None
+
+def load_schema_registry(s3, bucket: str, prefix: str = SCHEMA_REGISTRY_PREFIX, local_dir: str = None) -> SchemaRegistry:
+    """The latest stored version, or an empty registry that the first records evolve"""
+    name = latest_version_name(s3, bucket, prefix, local_dir)
+    if name is None:
+        return SchemaRegistry()
+    if local_dir:
+        with open(path.join(local_dir, prefix, name), "rb") as registry_file:
+            data = registry_file.read()
+    else:
+        data = s3.get_object(Bucket=bucket, Key=f"{prefix}{name}")["Body"].read()
+    return SchemaRegistry.deserialize(data)
+
+def save_schema_registry(registry: SchemaRegistry, s3, bucket: str, prefix: str = SCHEMA_REGISTRY_PREFIX, local_dir: str = None) -> int:
+    """
+    Stores the registry as the next version when it changed. Versions are written only if absent, so when another
+    run stored the same version first its changes are merged in and the next version is tried
+    """
+    if not registry.changed:
+        return registry.version
+
+    for _ in range(SCHEMA_REGISTRY_SAVE_ATTEMPTS):
+        latest = load_schema_registry(s3, bucket, prefix, local_dir)
+        registry.merge(latest)
+        registry.version = latest.version + 1
+        name = version_name(registry.version)
+        try:
+            if local_dir:
+                directory = path.join(local_dir, prefix)
+                makedirs(directory, exist_ok=True)
+                with open(path.join(directory, name), "xb") as registry_file:
+                    registry_file.write(registry.serialize())
+            else:
+                s3.put_object(Bucket=bucket, Key=f"{prefix}{name}", Body=registry.serialize(), IfNoneMatch="*")
+        except FileExistsError:
+            continue
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict"):
+                continue
+            raise
+        registry.changed = False
+        logger.info("Stored schema registry version %s with %s fields and %s event types", registry.version, len(registry.schema), len(registry.event_types))
+        return registry.version
+
+    raise RuntimeError(f"Could not store a new schema registry version under {prefix} after {SCHEMA_REGISTRY_SAVE_ATTEMPTS} attempts")
+
+# EOF